@@ -0,0 +1,168 @@
+import json
+import os
+import pickle
+import sqlite3
+from typing import Iterator
+
+from scrapy import Request, Spider
+from scrapy.utils.request import request_from_dict
+
+from app.partitions import SerpPartition
+
+
+class CrawlCheckpoint:
+    """Progress of a SERP crawl kept in a local sqlite file.
+
+    Holds the SERP partitions with their number of pages, the pages whose
+    listings were all scheduled and the listing requests whose car is not
+    stored yet, so a crawl restarted by pm2 resumes where it stopped.
+
+    Listing requests and done pages are buffered and written by flush() in
+    one transaction, requests first, so a page is never stored as done
+    without its listings. A killed process loses the progress since the last
+    flush, and fetches those pages again.
+    """
+
+    def __init__(self, path: str) -> None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.path = path
+        # Autocommit, the WAL journal keeps the commit per write cheap
+        self.connection = sqlite3.connect(path, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS serp_partitions (
+                key TEXT PRIMARY KEY,
+                filters TEXT NOT NULL,
+                last_page INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS done_serp_pages (
+                partition TEXT NOT NULL,
+                page INTEGER NOT NULL,
+                PRIMARY KEY (partition, page)
+            );
+            CREATE TABLE IF NOT EXISTS pending_requests (
+                listing TEXT PRIMARY KEY,
+                request BLOB NOT NULL
+            );
+            """
+        )
+        # Keyed by listing, a phone request replaces its detail request
+        # before either is pickled
+        self.new_requests: dict[str, tuple[Request, Spider]] = {}
+        self.new_done_pages: set[tuple[str, int]] = set()
+
+    def serp_partitions(self, start_page: int) -> list[SerpPartition]:
+        done_pages: dict[str, set[int]] = {}
+        for key, page in self.connection.execute(
+            "SELECT partition, page FROM done_serp_pages"
+        ):
+            done_pages.setdefault(key, set()).add(page)
+
+        return [
+            SerpPartition(
+                json.loads(filters),
+                next_page=start_page,
+                last_page=last_page,
+                done_pages=done_pages.get(key, set()),
+            )
+            for key, filters, last_page in self.connection.execute(
+                "SELECT key, filters, last_page FROM serp_partitions"
+            )
+        ]
+
+    def save_serp_partitions(self, partitions: list[SerpPartition]) -> None:
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO serp_partitions (key, filters, last_page) "
+            "VALUES (?, ?, ?)",
+            [
+                (partition.key, json.dumps(partition.filters), partition.last_page)
+                for partition in partitions
+            ],
+        )
+
+    def split_serp_partition(
+        self, partition: SerpPartition, children: list[SerpPartition]
+    ) -> None:
+        # In one transaction, a resumed crawl must not split the parent again
+        # over the progress of its children
+        self.connection.execute("BEGIN")
+        self.connection.execute(
+            "DELETE FROM serp_partitions WHERE key = ?", (partition.key,)
+        )
+        self.save_serp_partitions(children)
+        self.connection.execute("COMMIT")
+
+    def mark_serp_page_done(self, partition: str, page: int) -> None:
+        self.new_done_pages.add((partition, page))
+
+    def save_request(self, listing: str, request: Request, spider: Spider) -> None:
+        # A phone request replaces the detail request of the same listing,
+        # the car scraped so far travels in its cb_kwargs
+        self.new_requests[listing] = (request, spider)
+
+    def remove_requests(self, listings: list[str]) -> None:
+        for listing in listings:
+            self.new_requests.pop(listing, None)
+        self.connection.executemany(
+            "DELETE FROM pending_requests WHERE listing = ?",
+            [(listing,) for listing in listings],
+        )
+
+    def flush(self) -> None:
+        if not self.new_requests and not self.new_done_pages:
+            return
+
+        rows = [
+            (
+                listing,
+                pickle.dumps(
+                    request.to_dict(spider=spider), protocol=pickle.HIGHEST_PROTOCOL
+                ),
+            )
+            for listing, (request, spider) in self.new_requests.items()
+        ]
+        self.connection.execute("BEGIN")
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO pending_requests (listing, request) VALUES (?, ?)",
+            rows,
+        )
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO done_serp_pages (partition, page) VALUES (?, ?)",
+            list(self.new_done_pages),
+        )
+        self.connection.execute("COMMIT")
+        self.new_requests = {}
+        self.new_done_pages = set()
+
+    def pending_count(self) -> int:
+        return self.connection.execute(
+            "SELECT count(*) FROM pending_requests"
+        ).fetchone()[0]
+
+    def pending_requests(self, spider: Spider) -> Iterator[Request]:
+        # Fetched up front, resuming a request writes to the same table
+        rows = self.connection.execute(
+            "SELECT request FROM pending_requests"
+        ).fetchall()
+        for (data,) in rows:
+            yield request_from_dict(pickle.loads(data), spider=spider)
+
+    def clear(self) -> None:
+        self.new_requests = {}
+        self.new_done_pages = set()
+        self.connection.executescript(
+            """
+            DELETE FROM serp_partitions;
+            DELETE FROM done_serp_pages;
+            DELETE FROM pending_requests;
+            """
+        )
+
+    def close(self) -> None:
+        self.flush()
+        self.connection.close()
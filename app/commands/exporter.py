@@ -1,27 +1,65 @@
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import replace
+from datetime import datetime, timedelta
 from functools import cached_property
-import json
 from logging import getLogger
+import multiprocessing
 import os
-from typing import Any
+import time
+from typing import Iterator
 
 from scrapy.commands import ScrapyCommand
 from scrapy.utils.project import get_project_settings
-from sqlalchemy import select
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import (
+    ColumnElement,
+    Connection,
+    RowMapping,
+    Select,
+    func,
+    select,
+)
 from app.database.models import Car
 
+from app.export import (
+    COMPRESSIONS,
+    COPY_FORMAT,
+    EXPORT_FORMATS,
+    WRITERS,
+    ExportManifest,
+    ExportShard,
+    ShardResult,
+    copy_csv,
+    export_file_name,
+    file_sha256,
+    load_watermark,
+    open_export_file,
+    save_watermark,
+    split_id_range,
+)
 from app.utils import get_engine
 
 
 class Exporter(ScrapyCommand):
     chunk_size: int = 1000
+    export_columns = (
+        Car.url,
+        Car.title,
+        Car.price_usd,
+        Car.odometer,
+        Car.username,
+        Car.image_url,
+        Car.images_count,
+        Car.car_number,
+        Car.car_vin,
+        Car.phone_number,
+        Car.created_at,
+        Car.updated_at,
+    )
 
     def __init__(self):
         super().__init__()
         self.settings = get_project_settings()
-        self.engine = get_engine(self.settings["DB_URL"])
-        self.session = sessionmaker(self.engine)
+        self.engine = get_engine(self.settings, "exporter")
         self.logger = getLogger(self.__class__.__name__)
         self.logger.setLevel(self.settings["LOG_LEVEL"])
         self.timestamp = datetime.now()
@@ -36,42 +74,208 @@ class Exporter(ScrapyCommand):
     def short_desc(self) -> str:
         return "Export cars data"
 
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument(
+            "--format",
+            dest="export_format",
+            choices=EXPORT_FORMATS,
+            default="json",
+            help=f"output format, {COPY_FORMAT} streams CSV straight from Postgres "
+            "(default: json)",
+        )
+        parser.add_argument(
+            "--compress",
+            dest="compression",
+            choices=list(COMPRESSIONS),
+            default="none",
+            help="output compression (default: none)",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="number of processes exporting id-range shards in parallel, "
+            "0 uses every CPU core (default: 1)",
+        )
+        parser.add_argument(
+            "--delta",
+            action="store_true",
+            help="export only cars inserted or modified since the last "
+            "successful export",
+        )
+
+    @property
+    def column_names(self) -> list[str]:
+        return [column.key for column in self.export_columns]
+
     def run(self, args, opts):
-        self.logger.info(f"Starting export to {self.export_path}")
-        offset = 0
+        workers = opts.workers or os.cpu_count() or 1
+        state_file = self.settings["EXPORT_STATE_FILE"]
 
-        with self.session() as session:
-            while True:
-                stmt = select(Car).limit(self.chunk_size).offset(offset)
-                cars = session.execute(stmt).scalars().all()
-                if not cars:
-                    self.logger.info("Export completed")
-                    break
+        updated_since = None
+        if opts.delta:
+            updated_since = load_watermark(state_file)
+            if updated_since is None:
+                self.logger.warning("No watermark found, exporting all cars")
+            else:
+                # Upserts stamp updated_at with their transaction start time,
+                # so a batch committed just after the previous watermark was
+                # taken may carry an older timestamp. Overlapping the window
+                # re-exports a few rows instead of losing them
+                updated_since -= timedelta(
+                    seconds=self.settings.getfloat("EXPORT_DELTA_OVERLAP")
+                )
 
-                self.export_cars(cars, offset)
+        with self.engine.connect() as connection:
+            watermark = connection.execute(select(func.localtimestamp())).scalar_one()
 
-                offset += self.chunk_size
+        self.logger.info(
+            f"Starting {'delta' if updated_since else 'full'} export "
+            f"to {self.export_path} ({workers} workers)"
+        )
 
-    def export_cars(self, cars: list[Car], offset: int) -> None:
-        cars_dicts = [self.car_to_dict(car) for car in cars]
+        started_at = time.perf_counter()
+        base_shard = ExportShard(
+            file_path=os.path.join(
+                self.export_path,
+                export_file_name("exported_cars", opts.export_format, opts.compression),
+            ),
+            export_format=opts.export_format,
+            compression=opts.compression,
+            updated_since=updated_since,
+            # A full export is a snapshot of the whole table, cars upserted
+            # while it runs included; the next delta exports them again
+            updated_until=watermark if opts.delta else None,
+        )
+        shards = self.build_shards(base_shard, workers)
+        manifest = ExportManifest(
+            created_at=self.timestamp,
+            export_format=opts.export_format,
+            compression=opts.compression,
+            updated_since=updated_since,
+            watermark=watermark,
+        )
+
+        if len(shards) == 1:
+            manifest.shards.append(export_shard(shards[0]))
+        else:
+            # Every shard opens its own connection in a fresh interpreter,
+            # "spawn" keeps the parent's pooled connections out of the children
+            with ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+            ) as executor:
+                manifest.shards.extend(executor.map(export_shard, shards))
 
-        export_file_path = os.path.join(
-            self.export_path, f"exported_cars_{offset}_{offset+self.chunk_size}.json"
+        manifest_path = manifest.write(self.export_path)
+        save_watermark(state_file, watermark)
+
+        elapsed = time.perf_counter() - started_at
+        self.logger.info(
+            f"Export completed: {manifest.total_rows} cars in {len(shards)} files "
+            f"in {elapsed:.1f}s, manifest {manifest_path}"
         )
-        with open(export_file_path, mode="w+", encoding="utf-8") as f:
-            json.dump(cars_dicts, f, indent=4, ensure_ascii=False)
-
-    def car_to_dict(self, car: Car) -> dict[str, Any]:
-        return {
-            "url": car.url,
-            "title": car.title,
-            "price_usd": car.price_usd,
-            "odometer": car.odometer,
-            "username": car.username,
-            "image_url": car.image_url,
-            "images_count": car.images_count,
-            "car_number": car.car_number,
-            "car_vin": car.car_vin,
-            "phone_number": car.phone_number,
-            "created_at": str(car.created_at),
-        }
+
+    def build_shards(self, base_shard: ExportShard, workers: int) -> list[ExportShard]:
+        if workers <= 1:
+            return [base_shard]
+
+        with self.engine.connect() as connection:
+            min_id, max_id = connection.execute(
+                select(func.min(Car.id), func.max(Car.id)).where(
+                    *self.shard_filters(base_shard)
+                )
+            ).one()
+
+        if min_id is None:
+            return [base_shard]
+
+        name, extension = os.path.basename(base_shard.file_path).split(".", 1)
+        return [
+            replace(
+                base_shard,
+                file_path=os.path.join(
+                    os.path.dirname(base_shard.file_path),
+                    f"{name}_{number:03d}.{extension}",
+                ),
+                lower_id=lower_id,
+                upper_id=upper_id,
+            )
+            for number, (lower_id, upper_id) in enumerate(
+                split_id_range(min_id, max_id, workers)
+            )
+        ]
+
+    def export_to(self, shard: ExportShard) -> int:
+        file = open_export_file(shard.file_path, shard.compression)
+        with self.engine.connect() as connection:
+            if shard.export_format == COPY_FORMAT:
+                with file:
+                    return copy_csv(connection, self.build_select(shard), file)
+
+            writer = WRITERS[shard.export_format](file, self.column_names)
+            try:
+                return sum(
+                    writer.write_rows(chunk)
+                    for chunk in self.iter_chunks(connection, shard)
+                )
+            finally:
+                writer.close()
+
+    def shard_filters(self, shard: ExportShard) -> list[ColumnElement[bool]]:
+        filters = []
+        if shard.upper_id is not None:
+            filters.append(Car.id < shard.upper_id)
+        if shard.updated_since is not None:
+            filters.append(Car.updated_at > shard.updated_since)
+        if shard.updated_until is not None:
+            filters.append(Car.updated_at <= shard.updated_until)
+        return filters
+
+    def build_select(self, shard: ExportShard) -> Select:
+        stmt = select(*self.export_columns).where(*self.shard_filters(shard))
+        if shard.lower_id is not None:
+            stmt = stmt.where(Car.id >= shard.lower_id)
+        return stmt.order_by(Car.id)
+
+    def iter_chunks(
+        self, connection: Connection, shard: ExportShard
+    ) -> Iterator[list[RowMapping]]:
+        last_id = shard.lower_id - 1 if shard.lower_id is not None else 0
+        filters = self.shard_filters(shard)
+
+        # Walk the table by primary key instead of LIMIT/OFFSET so every chunk
+        # is an index range scan no matter how deep into the table it is
+        while True:
+            started_at = time.perf_counter()
+            stmt = (
+                select(Car.id, *self.export_columns)
+                .where(Car.id > last_id, *filters)
+                .order_by(Car.id)
+                .limit(self.chunk_size)
+            )
+            cars = connection.execute(stmt).mappings().all()
+            if not cars:
+                return
+
+            self.logger.debug(
+                f"Fetched {len(cars)} cars after id {last_id} "
+                f"in {time.perf_counter() - started_at:.3f}s"
+            )
+            yield cars
+            last_id = cars[-1]["id"]
+
+
+def export_shard(shard: ExportShard) -> ShardResult:
+    exporter = Exporter()
+    rows = exporter.export_to(shard)
+    exporter.engine.dispose()
+
+    return ShardResult(
+        file=os.path.basename(shard.file_path),
+        rows=rows,
+        bytes=os.path.getsize(shard.file_path),
+        sha256=file_sha256(shard.file_path),
+        lower_id=shard.lower_id,
+        upper_id=shard.upper_id,
+    )
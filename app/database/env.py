@@ -1,12 +1,11 @@
 from logging.config import fileConfig
 
-from sqlalchemy import engine_from_config
-from sqlalchemy import pool
-
 from alembic import context
+from scrapy.settings import Settings
 
 from app.database.models.base import Base
 from app.settings import DB_URL
+from app.utils import get_engine
 
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
@@ -25,6 +24,18 @@ target_metadata = Base.metadata
 
 config.set_main_option("sqlalchemy.url", DB_URL)
 
+# Partitions are created at runtime, see app.database.partitions, and are
+# not part of the metadata
+PARTITIONED_TABLES = ("car_price_history",)
+
+
+def include_name(name, type_, parent_names) -> bool:
+    if type_ == "table":
+        return not any(
+            name.startswith(f"{table}_") for table in PARTITIONED_TABLES
+        )
+    return True
+
 
 def run_migrations_offline() -> None:
     """Run migrations in 'offline' mode.
@@ -45,6 +56,7 @@ def run_migrations_offline() -> None:
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
         compare_type=True,
+        include_name=include_name,
     )
 
     with context.begin_transaction():
@@ -58,19 +70,31 @@ def run_migrations_online() -> None:
     and associate a connection with the context.
 
     """
-    connectable = engine_from_config(
-        config.get_section(config.config_ini_section, {}),
-        prefix="sqlalchemy.",
-        poolclass=pool.NullPool,
-    )
+    # A caller migrating another database, e.g. benchmarks.load, passes its
+    # own connection
+    connection = config.attributes.get("connection")
+    if connection is not None:
+        run_migrations_on(connection)
+        return
+
+    settings = Settings()
+    settings.setmodule("app.settings", priority="project")
+    connectable = get_engine(settings, "migrations")
 
     with connectable.connect() as connection:
-        context.configure(
-            connection=connection, target_metadata=target_metadata, compare_type=True
-        )
+        run_migrations_on(connection)
 
-        with context.begin_transaction():
-            context.run_migrations()
+
+def run_migrations_on(connection) -> None:
+    context.configure(
+        connection=connection,
+        target_metadata=target_metadata,
+        compare_type=True,
+        include_name=include_name,
+    )
+
+    with context.begin_transaction():
+        context.run_migrations()
 
 
 if context.is_offline_mode():
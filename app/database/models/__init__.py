@@ -1 +1,3 @@
 from .car import Car
+from .car_price_history import CarPriceHistory
+from .frontier_request import FrontierRequest
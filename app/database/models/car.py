@@ -1,5 +1,12 @@
-from sqlalchemy import Column
-from sqlalchemy.dialects.postgresql import VARCHAR, INTEGER, BIGINT, TEXT, SMALLINT
+from sqlalchemy import Column, text
+from sqlalchemy.dialects.postgresql import (
+    VARCHAR,
+    INTEGER,
+    BIGINT,
+    TEXT,
+    SMALLINT,
+    TIMESTAMP,
+)
 
 from app.database.models.base import Base
 from app.database.models.mixins import PrimaryKeyMixin, TimestampMixin
@@ -18,3 +25,18 @@ class Car(PrimaryKeyMixin, TimestampMixin, Base):
     car_number = Column(VARCHAR(length=255), nullable=True, index=False, unique=False)
     car_vin = Column(VARCHAR(length=255), nullable=True, index=False, unique=False)
     phone_number = Column(BIGINT(), nullable=True, index=False, unique=False)
+    # When phone_number was last fetched from /users/phones/, unlike
+    # last_seen_at not moved by crawls that took the phone from the cache
+    phone_fetched_at = Column(TIMESTAMP, nullable=True, index=False, unique=False)
+    last_seen_at = Column(
+        TIMESTAMP,
+        nullable=False,
+        index=False,
+        unique=False,
+        server_default=text("CURRENT_TIMESTAMP"),
+    )
+
+    # Free space on every page for last_seen_at updates of unchanged cars. No
+    # index covers last_seen_at, so a new row version that fits on the same
+    # page is a HOT update and leaves the indexes alone
+    __table_args__ = {"postgresql_with": {"fillfactor": 90}}
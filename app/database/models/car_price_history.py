@@ -0,0 +1,40 @@
+from sqlalchemy import Column, Index, text
+from sqlalchemy.dialects.postgresql import BIGINT, INTEGER, TIMESTAMP
+
+from app.database.models.base import Base
+
+
+class CarPriceHistory(Base):
+    """A price a car was seen at, appended whenever the price changes.
+
+    Range partitioned by month of recorded_at, see app.database.partitions,
+    so a query over a time window only reads the partitions it covers. The
+    partition key has to be part of the primary key.
+    """
+
+    __tablename__ = "car_price_history"
+
+    id = Column(BIGINT(), primary_key=True, autoincrement=True)
+    # cars.id, without a foreign key so the bulk insert does not look up
+    # every car again
+    car_id = Column(BIGINT(), nullable=False, index=False, unique=False)
+    price_usd = Column(INTEGER(), nullable=False, index=False, unique=False)
+    odometer = Column(BIGINT(), nullable=True, index=False, unique=False)
+    recorded_at = Column(
+        TIMESTAMP,
+        primary_key=True,
+        nullable=False,
+        server_default=text("CURRENT_TIMESTAMP"),
+    )
+
+    __table_args__ = (
+        # Price trend of one car
+        Index("ix_public_car_price_history_car_id", "car_id", "recorded_at"),
+        # Rows are appended in recorded_at order, a BRIN index stays tiny
+        Index(
+            "ix_public_car_price_history_recorded_at",
+            "recorded_at",
+            postgresql_using="brin",
+        ),
+        {"postgresql_partition_by": "RANGE (recorded_at)"},
+    )
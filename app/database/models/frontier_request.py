@@ -0,0 +1,52 @@
+from sqlalchemy import Column, Index, UniqueConstraint, text
+from sqlalchemy.dialects.postgresql import (
+    BYTEA,
+    INTEGER,
+    SMALLINT,
+    TIMESTAMP,
+    VARCHAR,
+)
+
+from app.database.models.base import Base
+from app.database.models.mixins import PrimaryKeyMixin
+
+
+class FrontierRequest(PrimaryKeyMixin, Base):
+    """A request of a distributed crawl, claimed by one worker at a time."""
+
+    __tablename__ = "frontier_requests"
+
+    crawl = Column(VARCHAR(length=255), nullable=False, index=False, unique=False)
+    fingerprint = Column(BYTEA(), nullable=False, index=False, unique=False)
+    priority = Column(
+        INTEGER(), nullable=False, index=False, unique=False, server_default=text("0")
+    )
+    # Pickled Request.to_dict()
+    request = Column(BYTEA(), nullable=False, index=False, unique=False)
+    attempts = Column(
+        SMALLINT(), nullable=False, index=False, unique=False, server_default=text("0")
+    )
+    leased_by = Column(VARCHAR(length=255), nullable=True, index=False, unique=False)
+    lease_expires_at = Column(TIMESTAMP, nullable=True, index=False, unique=False)
+    done_at = Column(TIMESTAMP, nullable=True, index=False, unique=False)
+    created_at = Column(
+        TIMESTAMP,
+        nullable=False,
+        index=False,
+        unique=False,
+        server_default=text("CURRENT_TIMESTAMP"),
+    )
+
+    __table_args__ = (
+        UniqueConstraint(
+            "crawl", "fingerprint", name="uq_public_frontier_requests_fingerprint"
+        ),
+        # Claims scan the open requests of a crawl in priority order
+        Index(
+            "ix_public_frontier_requests_open",
+            "crawl",
+            priority.desc(),
+            "id",
+            postgresql_where=done_at.is_(None),
+        ),
+    )
@@ -9,3 +9,10 @@ class TimestampMixin:
         nullable=False,
         server_default=text("CURRENT_TIMESTAMP"),
     )
+    updated_at = Column(
+        "updated_at",
+        TIMESTAMP,
+        nullable=False,
+        index=True,
+        server_default=text("CURRENT_TIMESTAMP"),
+    )
@@ -0,0 +1,68 @@
+from datetime import date
+
+from sqlalchemy import Connection, func, select, text
+
+
+def month_start(day: date, months: int = 0) -> date:
+    month = day.year * 12 + day.month - 1 + months
+    return date(month // 12, month % 12 + 1, 1)
+
+
+def month_partition_name(table: str, month: date) -> str:
+    return f"{table}_y{month.year}m{month.month:02d}"
+
+
+def default_partition_name(table: str) -> str:
+    return f"{table}_default"
+
+
+def create_month_partitions(
+    connection: Connection, table: str, column: str, first_month: date, months: int
+) -> None:
+    """Create the monthly range partitions of table by column missing from
+    first_month on.
+
+    Rows outside every monthly partition land in the DEFAULT partition created
+    by the migration. Postgres refuses a partition for a range the DEFAULT
+    partition already holds rows of, so a missing partition is created as a
+    plain table, those rows are moved into it and it is attached in the same
+    transaction. Workers opening at the same time serialize on an advisory
+    lock.
+    """
+    connection.execute(select(func.pg_advisory_xact_lock(func.hashtext(table))))
+    default = default_partition_name(table)
+    for offset in range(months):
+        start = month_start(first_month, offset)
+        end = month_start(start, 1)
+        partition = month_partition_name(table, start)
+        exists = connection.execute(
+            select(func.to_regclass(f"public.{partition}"))
+        ).scalar()
+        if exists is not None:
+            continue
+
+        # Taken before the move, so no row of the range can be inserted into
+        # the DEFAULT partition until the new one is attached
+        connection.execute(
+            text(f"LOCK TABLE public.{default} IN ACCESS EXCLUSIVE MODE")
+        )
+        connection.execute(
+            text(
+                f"CREATE TABLE public.{partition} "
+                f"(LIKE public.{table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"
+            )
+        )
+        connection.execute(
+            text(
+                f"WITH moved AS (DELETE FROM public.{default} "
+                f"WHERE {column} >= :start AND {column} < :end RETURNING *) "
+                f"INSERT INTO public.{partition} SELECT * FROM moved"
+            ),
+            {"start": start, "end": end},
+        )
+        connection.execute(
+            text(
+                f"ALTER TABLE public.{table} ATTACH PARTITION public.{partition} "
+                f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+            )
+        )
@@ -0,0 +1,27 @@
+"""set cars fillfactor
+
+Revision ID: 0a9d3e7c5b42
+Revises: f2c8d6a4b9e1
+Create Date: 2026-10-18 18:11:27.604915
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0a9d3e7c5b42"
+down_revision: Union[str, None] = "f2c8d6a4b9e1"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Applies to pages written from now on, VACUUM FULL or pg_repack rewrites
+    # the existing ones
+    op.execute("ALTER TABLE public.cars SET (fillfactor = 90)")
+
+
+def downgrade() -> None:
+    op.execute("ALTER TABLE public.cars RESET (fillfactor)")
@@ -0,0 +1,47 @@
+"""added cars updated_at column
+
+Revision ID: a3c5e1f0b7d2
+Revises: 6d1fd49e8fb0
+Create Date: 2026-10-18 09:12:41.503318
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision: str = "a3c5e1f0b7d2"
+down_revision: Union[str, None] = "6d1fd49e8fb0"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "cars",
+        sa.Column(
+            "updated_at",
+            postgresql.TIMESTAMP(),
+            server_default=sa.text("CURRENT_TIMESTAMP"),
+            nullable=False,
+        ),
+        schema="public",
+    )
+    # Existing rows have not changed since they were inserted as far as we know
+    op.execute("UPDATE public.cars SET updated_at = created_at")
+    op.create_index(
+        op.f("ix_public_cars_updated_at"),
+        "cars",
+        ["updated_at"],
+        unique=False,
+        schema="public",
+    )
+
+
+def downgrade() -> None:
+    op.drop_index(
+        op.f("ix_public_cars_updated_at"), table_name="cars", schema="public"
+    )
+    op.drop_column("cars", "updated_at", schema="public")
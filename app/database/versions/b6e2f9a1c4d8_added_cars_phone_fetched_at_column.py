@@ -0,0 +1,32 @@
+"""added cars phone_fetched_at column
+
+Revision ID: b6e2f9a1c4d8
+Revises: 0a9d3e7c5b42
+Create Date: 2026-10-18 21:02:45.381907
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision: str = "b6e2f9a1c4d8"
+down_revision: Union[str, None] = "0a9d3e7c5b42"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Left empty: last_seen_at says nothing about when a phone was fetched,
+    # so every cached phone is fetched once more after the upgrade
+    op.add_column(
+        "cars",
+        sa.Column("phone_fetched_at", postgresql.TIMESTAMP(), nullable=True),
+        schema="public",
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("cars", "phone_fetched_at", schema="public")
@@ -0,0 +1,36 @@
+"""added cars last_seen_at column
+
+Revision ID: c81f4d2a9e37
+Revises: a3c5e1f0b7d2
+Create Date: 2026-10-18 11:40:03.118452
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision: str = "c81f4d2a9e37"
+down_revision: Union[str, None] = "a3c5e1f0b7d2"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "cars",
+        sa.Column(
+            "last_seen_at",
+            postgresql.TIMESTAMP(),
+            server_default=sa.text("CURRENT_TIMESTAMP"),
+            nullable=False,
+        ),
+        schema="public",
+    )
+    op.execute("UPDATE public.cars SET last_seen_at = updated_at")
+
+
+def downgrade() -> None:
+    op.drop_column("cars", "last_seen_at", schema="public")
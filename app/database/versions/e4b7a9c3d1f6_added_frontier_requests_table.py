@@ -0,0 +1,65 @@
+"""added frontier_requests table
+
+Revision ID: e4b7a9c3d1f6
+Revises: c81f4d2a9e37
+Create Date: 2026-10-18 13:05:41.502317
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision: str = "e4b7a9c3d1f6"
+down_revision: Union[str, None] = "c81f4d2a9e37"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "frontier_requests",
+        sa.Column("id", sa.BIGINT(), autoincrement=True, nullable=False),
+        sa.Column("crawl", sa.VARCHAR(length=255), nullable=False),
+        sa.Column("fingerprint", postgresql.BYTEA(), nullable=False),
+        sa.Column(
+            "priority", sa.INTEGER(), server_default=sa.text("0"), nullable=False
+        ),
+        sa.Column("request", postgresql.BYTEA(), nullable=False),
+        sa.Column(
+            "attempts", sa.SMALLINT(), server_default=sa.text("0"), nullable=False
+        ),
+        sa.Column("leased_by", sa.VARCHAR(length=255), nullable=True),
+        sa.Column("lease_expires_at", postgresql.TIMESTAMP(), nullable=True),
+        sa.Column("done_at", postgresql.TIMESTAMP(), nullable=True),
+        sa.Column(
+            "created_at",
+            postgresql.TIMESTAMP(),
+            server_default=sa.text("CURRENT_TIMESTAMP"),
+            nullable=False,
+        ),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint(
+            "crawl", "fingerprint", name="uq_public_frontier_requests_fingerprint"
+        ),
+        schema="public",
+    )
+    op.create_index(
+        "ix_public_frontier_requests_open",
+        "frontier_requests",
+        ["crawl", sa.text("priority DESC"), "id"],
+        unique=False,
+        schema="public",
+        postgresql_where=sa.text("done_at IS NULL"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_index(
+        "ix_public_frontier_requests_open",
+        table_name="frontier_requests",
+        schema="public",
+    )
+    op.drop_table("frontier_requests", schema="public")
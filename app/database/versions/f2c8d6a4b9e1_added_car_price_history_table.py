@@ -0,0 +1,82 @@
+"""added car_price_history table
+
+Revision ID: f2c8d6a4b9e1
+Revises: e4b7a9c3d1f6
+Create Date: 2026-10-18 16:42:08.913574
+
+"""
+from datetime import date
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision: str = "f2c8d6a4b9e1"
+down_revision: Union[str, None] = "e4b7a9c3d1f6"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "car_price_history",
+        sa.Column("id", sa.BIGINT(), autoincrement=True, nullable=False),
+        sa.Column("car_id", sa.BIGINT(), nullable=False),
+        sa.Column("price_usd", sa.INTEGER(), nullable=False),
+        sa.Column("odometer", sa.BIGINT(), nullable=True),
+        sa.Column(
+            "recorded_at",
+            postgresql.TIMESTAMP(),
+            server_default=sa.text("CURRENT_TIMESTAMP"),
+            nullable=False,
+        ),
+        sa.PrimaryKeyConstraint("id", "recorded_at"),
+        schema="public",
+        postgresql_partition_by="RANGE (recorded_at)",
+    )
+    op.create_index(
+        "ix_public_car_price_history_car_id",
+        "car_price_history",
+        ["car_id", "recorded_at"],
+        unique=False,
+        schema="public",
+    )
+    op.create_index(
+        "ix_public_car_price_history_recorded_at",
+        "car_price_history",
+        ["recorded_at"],
+        unique=False,
+        schema="public",
+        postgresql_using="brin",
+    )
+
+    # CarDBPipeline creates the partitions of the following months when a
+    # spider opens, the DEFAULT partition only catches what falls outside
+    today = date.today()
+    for offset in range(2):
+        month = today.year * 12 + today.month - 1 + offset
+        start = date(month // 12, month % 12 + 1, 1)
+        end = date((month + 1) // 12, (month + 1) % 12 + 1, 1)
+        op.execute(
+            f"CREATE TABLE public.car_price_history_y{start.year}m{start.month:02d} "
+            "PARTITION OF public.car_price_history "
+            f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+        )
+    op.execute(
+        "CREATE TABLE public.car_price_history_default "
+        "PARTITION OF public.car_price_history DEFAULT"
+    )
+
+    # Seed the history with the price every stored car has now, otherwise it
+    # would only show up after its first change
+    op.execute(
+        "INSERT INTO public.car_price_history (car_id, price_usd, odometer) "
+        "SELECT id, price_usd, odometer FROM public.cars"
+    )
+
+
+def downgrade() -> None:
+    # Dropping the partitioned table drops its partitions and their indexes
+    op.drop_table("car_price_history", schema="public")
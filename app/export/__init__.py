@@ -0,0 +1,19 @@
+from .manifest import (
+    ExportManifest,
+    ExportShard,
+    ShardResult,
+    file_sha256,
+    load_watermark,
+    save_watermark,
+    split_id_range,
+)
+from .writers import (
+    COMPRESSIONS,
+    COPY_FORMAT,
+    EXPORT_FORMATS,
+    WRITERS,
+    CarsWriter,
+    copy_csv,
+    export_file_name,
+    open_export_file,
+)
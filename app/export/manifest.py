@@ -0,0 +1,99 @@
+import hashlib
+import json
+import os
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from typing import Any
+
+
+@dataclass
+class ExportShard:
+    file_path: str
+    export_format: str
+    compression: str
+    # Half-open id range [lower_id, upper_id), None means unbounded
+    lower_id: int | None = None
+    upper_id: int | None = None
+    # Half-open updated_at window (updated_since, updated_until]
+    updated_since: datetime | None = None
+    updated_until: datetime | None = None
+
+
+@dataclass
+class ShardResult:
+    file: str
+    rows: int
+    bytes: int
+    sha256: str
+    lower_id: int | None
+    upper_id: int | None
+
+
+@dataclass
+class ExportManifest:
+    created_at: datetime
+    export_format: str
+    compression: str
+    # Cars modified in (updated_since, watermark] are included, a full export
+    # has no lower bound
+    updated_since: datetime | None = None
+    watermark: datetime | None = None
+    shards: list[ShardResult] = field(default_factory=list)
+
+    @property
+    def total_rows(self) -> int:
+        return sum(shard.rows for shard in self.shards)
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "created_at": self.created_at.isoformat(),
+            "format": self.export_format,
+            "compression": self.compression,
+            "delta": self.updated_since is not None,
+            "updated_since": _isoformat(self.updated_since),
+            "watermark": _isoformat(self.watermark),
+            "total_rows": self.total_rows,
+            "files": [asdict(shard) for shard in self.shards],
+        }
+
+    def write(self, directory: str) -> str:
+        manifest_path = os.path.join(directory, "manifest.json")
+        with open(manifest_path, mode="w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, indent=4)
+        return manifest_path
+
+
+def split_id_range(min_id: int, max_id: int, shards: int) -> list[tuple[int, int]]:
+    step = -(-(max_id - min_id + 1) // shards)
+    return [
+        (lower_id, min(lower_id + step, max_id + 1))
+        for lower_id in range(min_id, max_id + 1, step)
+    ]
+
+
+def file_sha256(file_path: str) -> str:
+    with open(file_path, mode="rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def load_watermark(state_file: str) -> datetime | None:
+    try:
+        with open(state_file, encoding="utf-8") as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return None
+
+    return datetime.fromisoformat(state["watermark"])
+
+
+def save_watermark(state_file: str, watermark: datetime) -> None:
+    # Written to a temporary file first so a crash never leaves a truncated
+    # state behind
+    tmp_file = f"{state_file}.tmp"
+    with open(tmp_file, mode="w", encoding="utf-8") as f:
+        json.dump({"watermark": watermark.isoformat()}, f)
+    os.replace(tmp_file, state_file)
+
+
+def _isoformat(value: datetime | None) -> str | None:
+    return value.isoformat() if value is not None else None
@@ -0,0 +1,512 @@
+import html
+import re
+from dataclasses import dataclass
+from functools import cached_property
+from typing import Any, Callable
+
+from lxml import etree
+
+from app import metrics
+
+DIGIT_REGEX = re.compile(r"\d")
+NUMBER_REGEX = re.compile(r"\d+")
+TAG_REGEX = re.compile(r"<(/?)([a-zA-Z][a-zA-Z0-9]*)[^>]*>")
+# Elements without an end tag, left out when nesting is counted
+VOID_TAGS = frozenset(
+    (
+        "area",
+        "base",
+        "br",
+        "col",
+        "embed",
+        "hr",
+        "img",
+        "input",
+        "link",
+        "meta",
+        "source",
+        "track",
+        "wbr",
+    )
+)
+
+
+def compile_xpath(expr: str) -> etree.XPath:
+    # smart_strings=False returns plain str instead of results that keep a
+    # reference to their element, and with it the whole tree, alive
+    return etree.XPath(expr, smart_strings=False)
+
+
+def strip(value: str) -> str:
+    return value.strip()
+
+
+def digits(value: str) -> str:
+    matches = DIGIT_REGEX.findall(value)
+    if not matches:
+        raise ValueError(f"Could not extract digits from {value}")
+    return "".join(matches)
+
+
+def first_number(value: str) -> int:
+    match = NUMBER_REGEX.search(value)
+    if match is None:
+        raise ValueError(f"Could not extract number from {value}")
+    return int(match.group(0))
+
+
+def unmasked(value: str) -> str | None:
+    if "xxxx" in value:
+        return None
+    return value.strip()
+
+
+@dataclass(frozen=True)
+class Container:
+    """An element a group of fields is looked up in, resolved once per page."""
+
+    name: str
+    xpath: etree.XPath
+    parent: str | None = None
+
+
+@dataclass(frozen=True)
+class Path:
+    """One step of a field fallback chain.
+
+    Matches of xpath across every container element are concatenated like a
+    parsel SelectorList does. The first match is passed to parse, or the
+    number of matches when count is set.
+    """
+
+    xpath: etree.XPath
+    container: str | None = None
+    parse: Callable[[Any], Any] | None = None
+    count: bool = False
+
+
+@dataclass(frozen=True)
+class Scan:
+    """A regex matched against the raw page text in place of a path.
+
+    Group 1 of the first match is passed to parse, HTML entities decoded
+    unless the value is the text of a script element. With a container the
+    match is only searched inside the first element of it, from its opening
+    markup in CONTAINER_OPENINGS to its end tag; a page where the element is
+    not found falls back to the paths.
+    """
+
+    pattern: re.Pattern
+    parse: Callable[[Any], Any] | None = None
+    unescape: bool = True
+    container: str | None = None
+
+
+@dataclass(frozen=True)
+class Field:
+    """A value tried along its paths until one of them matches.
+
+    ScannedCarPage tries the scans first. marker is a string every path needs
+    in the page to match, a page without it misses the field without parsing.
+    """
+
+    name: str
+    paths: tuple[Path, ...]
+    required: bool = False
+    marker: str | None = None
+    scans: tuple[Scan, ...] = ()
+
+
+def path(
+    expr: str,
+    container: str | None = None,
+    parse: Callable[[Any], Any] | None = None,
+    count: bool = False,
+) -> Path:
+    return Path(compile_xpath(expr), container, parse, count)
+
+
+def scan(
+    expr: str,
+    parse: Callable[[Any], Any] | None = None,
+    unescape: bool = True,
+    container: str | None = None,
+) -> Scan:
+    return Scan(re.compile(expr, re.DOTALL), parse, unescape, container)
+
+
+CONTAINERS = {
+    container.name: container
+    for container in (
+        Container("aside", compile_xpath("//aside")),
+        Container("aside_section", compile_xpath("//aside/section")),
+        Container(
+            "holder_manager",
+            compile_xpath('./div[contains(@class, "holder-manager")]'),
+            parent="aside",
+        ),
+        Container(
+            "seller_info",
+            compile_xpath(
+                '//section[@id="userInfoBlock"]/div/div[@class="seller_info_area"]'
+            ),
+        ),
+        Container("photos_block", compile_xpath('//div[@id="photosBlock"]')),
+        Container(
+            "carousel",
+            compile_xpath('./div[contains(@class, "carousel")]'),
+            parent="photos_block",
+        ),
+        Container(
+            "preview_gallery",
+            compile_xpath('./div[contains(@class, "preview-gallery")]'),
+            parent="photos_block",
+        ),
+        Container(
+            "vin_checked",
+            compile_xpath(
+                '//main[@class="auto-content"]/div/div[contains(@class, "vin-checked")]'
+            ),
+        ),
+        Container(
+            "security_script",
+            compile_xpath("//script[@data-hash and @data-expires]"),
+        ),
+    )
+}
+
+# Start tags of the containers scans are bounded to, matching the elements
+# their xpath in CONTAINERS selects. The opening of a container with a parent
+# is only looked for among the children of the parent element
+CONTAINER_OPENINGS = {
+    "aside": re.compile(r"<aside\b[^>]*>"),
+    "holder_manager": re.compile(r'<div class="[^"]*holder-manager[^"]*"[^>]*>'),
+    "seller_info": re.compile(
+        r'<section id="userInfoBlock"[^>]*>\s*<div[^>]*>\s*'
+        r'<div class="seller_info_area">'
+    ),
+    "photos_block": re.compile(r'<div id="photosBlock"[^>]*>'),
+    "carousel": re.compile(r'<div class="[^"]*carousel[^"]*"[^>]*>'),
+    "preview_gallery": re.compile(r'<div class="[^"]*preview-gallery[^"]*"[^>]*>'),
+    "vin_checked": re.compile(
+        r'<main class="auto-content">.*?<div class="[^"]*vin-checked[^"]*"[^>]*>',
+        re.DOTALL,
+    ),
+}
+
+CAR_JSON = Field(
+    "car_json",
+    (path('//script[@id="ldJson2"]/text()'),),
+    marker="ldJson2",
+    scans=(scan(r'<script[^>]*\sid="ldJson2"[^>]*>(.*?)</script>', unescape=False),),
+)
+TITLE = Field(
+    "title",
+    (
+        path(
+            '//div[contains(@class, "heading")]/h1[contains(@class, "head")]/@title',
+            parse=strip,
+        ),
+    ),
+    required=True,
+)
+PRICE = Field(
+    "price",
+    (
+        path(
+            "./span[contains(@class, @green)]/text()",
+            container="aside_section",
+            parse=digits,
+        ),
+        path(
+            './div[contains(@class, "price_value")]/strong/text()',
+            container="aside_section",
+            parse=digits,
+        ),
+    ),
+    required=True,
+)
+USERNAME = Field(
+    "username",
+    (
+        path(
+            './div[contains(@class, "seller_info_name")]/text()',
+            container="seller_info",
+            parse=strip,
+        ),
+        path(
+            './h4[@class="seller_info_name"]/a/text()',
+            container="seller_info",
+            parse=strip,
+        ),
+    ),
+    marker="seller_info_name",
+    scans=(
+        scan(
+            r'<div class="seller_info_name[^"]*">([^<]*?\S[^<]*)<',
+            parse=strip,
+            container="seller_info",
+        ),
+        scan(
+            r'<h4 class="seller_info_name"><a[^>]*>([^<]*?\S[^<]*)<',
+            parse=strip,
+            container="seller_info",
+        ),
+    ),
+)
+IMAGE_URL = Field(
+    "image_url",
+    (
+        path(
+            './div/div[contains(@class, "photo")]/picture/source/@srcset',
+            container="carousel",
+        ),
+    ),
+    marker="photosBlock",
+    scans=(
+        scan(
+            r'<div class="photo-[^"]*"><picture><source srcset="([^"]*)"',
+            container="carousel",
+        ),
+    ),
+)
+IMAGES_COUNT = Field(
+    "images_count",
+    (
+        path(
+            './div[@class="action_disp_all_block"]/a/text()',
+            container="preview_gallery",
+            parse=first_number,
+        ),
+        path(
+            './div[contains(@class, "carousel-inner")]/div[contains(@class, "photo") and not(contains(@class, "phone-in-photo"))]',
+            container="carousel",
+            count=True,
+        ),
+    ),
+    # Counting the carousel needs the tree, pages without the link build it
+    scans=(
+        scan(
+            r'<div class="action_disp_all_block"><a[^>]*>([^<]+)<',
+            parse=first_number,
+            container="preview_gallery",
+        ),
+    ),
+)
+CAR_NUMBER = Field(
+    "car_number",
+    (
+        path(
+            './/span[contains(@class, "state-num")]/text()',
+            container="vin_checked",
+            parse=strip,
+        ),
+    ),
+    marker="state-num",
+    scans=(
+        scan(
+            r'<span class="state-num[^"]*">([^<]*?\S[^<]*)<',
+            parse=strip,
+            container="vin_checked",
+        ),
+    ),
+)
+CAR_VIN = Field(
+    "car_vin",
+    (
+        path(
+            './/span[@class="label-vin"]/text()',
+            container="vin_checked",
+            parse=unmasked,
+        ),
+    ),
+    marker="label-vin",
+    scans=(
+        scan(
+            r'<span class="label-vin">([^<]+)<',
+            parse=unmasked,
+            container="vin_checked",
+        ),
+    ),
+)
+SECURITY_HASH = Field(
+    "security_hash",
+    (path("./@data-hash", container="security_script"),),
+    marker="data-hash",
+    scans=(scan(r'<script[^>]*\sdata-hash="([^"]*)"[^>]*\sdata-expires="'),),
+)
+SECURITY_EXPIRES = Field(
+    "security_expires",
+    (path("./@data-expires", container="security_script"),),
+    marker="data-expires",
+    scans=(scan(r'<script[^>]*\sdata-hash="[^"]*"[^>]*\sdata-expires="([^"]*)"'),),
+)
+CAR_ID = Field(
+    "car_id",
+    (path("//body/@data-auto-id"),),
+    required=True,
+    marker="data-auto-id",
+    scans=(scan(r'<body[^>]*\sdata-auto-id="([^"]*)"'),),
+)
+PHONE_BUTTON = Field(
+    "phone_button",
+    (
+        path(
+            './div/a[contains(@class, "phone-btn")]/@href',
+            container="holder_manager",
+        ),
+    ),
+    marker="phone-btn",
+    scans=(
+        scan(
+            r'<a class="phone-btn[^"]*" href="([^"]*)"',
+            container="holder_manager",
+        ),
+    ),
+)
+
+
+def nesting_depth(text: str, start: int, end: int) -> int:
+    """Elements opened and not closed again between start and end of text."""
+    depth = 0
+    for tag in TAG_REGEX.finditer(text, start, end):
+        if tag.group(2).lower() not in VOID_TAGS:
+            depth += -1 if tag.group(1) else 1
+    return depth
+
+
+def closing_tag(text: str, start: int, end: int) -> int | None:
+    """Index of the end tag closing the element whose content starts at start."""
+    depth = 0
+    for tag in TAG_REGEX.finditer(text, start, end):
+        if tag.group(2).lower() in VOID_TAGS:
+            continue
+        if not tag.group(1):
+            depth += 1
+        elif depth:
+            depth -= 1
+        else:
+            return tag.start()
+    return None
+
+
+class CarPage:
+    """Detail page fields extracted from its lxml tree, sharing containers."""
+
+    def __init__(self, root: etree._Element) -> None:
+        self.root = root
+        self.containers: dict[str, list[etree._Element]] = {}
+
+    def container(self, name: str | None) -> list[etree._Element]:
+        if name is None:
+            return [self.root]
+
+        elements = self.containers.get(name)
+        if elements is None:
+            container = CONTAINERS[name]
+            elements = [
+                element
+                for context in self.container(container.parent)
+                for element in container.xpath(context)
+            ]
+            self.containers[name] = elements
+        return elements
+
+    def extract(self, field: Field) -> Any:
+        for field_path in field.paths:
+            contexts = self.container(field_path.container)
+            if field_path.count:
+                return sum(len(field_path.xpath(context)) for context in contexts)
+
+            for context in contexts:
+                values = field_path.xpath(context)
+                if values:
+                    return self.parsed(field, field_path.parse, values[0])
+
+        return self.missing(field)
+
+    def parsed(
+        self, field: Field, parse: Callable[[Any], Any] | None, value: Any
+    ) -> Any:
+        if parse is None:
+            return value
+        try:
+            return parse(value)
+        except ValueError:
+            metrics.FIELD_FAILURES.labels(field.name, "unparsable").inc()
+            raise
+
+    def missing(self, field: Field) -> None:
+        metrics.FIELD_FAILURES.labels(field.name, "missing").inc()
+        if field.required:
+            raise ValueError(f"Could not extract {field.name} from page")
+        return None
+
+
+class ScannedCarPage(CarPage):
+    """CarPage looking fields up in the raw page text first.
+
+    The lxml tree is only built, once, for a field none of its scans matched
+    although its marker is there. Scans are written against the synthetic
+    pages of benchmarks/fixtures, where benchmarks.extraction checks they
+    agree with the tree; markup auto.ria serves differently falls through to
+    the tree or misses the field.
+    """
+
+    def __init__(self, text: str, build_root: Callable[[], etree._Element]) -> None:
+        self.text = text
+        self.build_root = build_root
+        self.containers = {}
+        # Text between the start and end tag of a container, None when it is
+        # missing or its end cannot be found
+        self.spans: dict[str, tuple[int, int] | None] = {}
+
+    @cached_property
+    def root(self) -> etree._Element:
+        return self.build_root()
+
+    def extract(self, field: Field) -> Any:
+        if field.marker is not None and field.marker not in self.text:
+            return self.missing(field)
+
+        for field_scan in field.scans:
+            start, end = 0, len(self.text)
+            if field_scan.container is not None:
+                span = self.span(field_scan.container)
+                if span is None:
+                    continue
+                start, end = span
+            match = field_scan.pattern.search(self.text, start, end)
+            if match is not None:
+                value = match.group(1)
+                if field_scan.unescape:
+                    value = html.unescape(value)
+                return self.parsed(field, field_scan.parse, value)
+
+        if "root" not in self.__dict__:
+            metrics.DETAIL_PAGE_TREES.labels(field.name).inc()
+        return super().extract(field)
+
+    def span(self, name: str) -> tuple[int, int] | None:
+        if name in self.spans:
+            return self.spans[name]
+
+        start, end = 0, len(self.text)
+        parent = CONTAINERS[name].parent
+        if parent is not None:
+            parent_span = self.span(parent)
+            if parent_span is None:
+                self.spans[name] = None
+                return None
+            start, end = parent_span
+
+        span = None
+        for opening in CONTAINER_OPENINGS[name].finditer(self.text, start, end):
+            if parent is not None and nesting_depth(self.text, start, opening.start()):
+                continue
+            element_end = closing_tag(self.text, opening.end(), end)
+            if element_end is not None:
+                span = (opening.end(), element_end)
+            break
+        self.spans[name] = span
+        return span
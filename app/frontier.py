@@ -0,0 +1,508 @@
+import os
+import pickle
+import socket
+import time
+from collections import deque
+from datetime import timedelta
+from logging import getLogger
+
+from itemadapter import ItemAdapter
+from scrapy import Request, Spider, signals
+from scrapy.core.scheduler import BaseScheduler
+from scrapy.http import Response
+from scrapy.utils.request import request_from_dict
+from sqlalchemy import Engine, exists, func, or_, select, update
+from sqlalchemy.dialects.postgresql import insert
+from twisted.internet import defer, task, threads
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
+
+from app.database.models import FrontierRequest
+from app.signals import cars_saved, listing_dropped
+from app.utils import get_engine
+
+
+class FrontierScheduler(BaseScheduler):
+    """Scheduler sharing its requests with other workers through Postgres.
+
+    Every scheduled request is inserted into frontier_requests, deduplicated
+    by fingerprint within the crawl. Workers claim batches of open requests
+    with FOR UPDATE SKIP LOCKED and hold a lease on them, renewed while they
+    are downloaded. A request is done once its response is received, and a
+    listing request (meta["listing"]) only once the next request of the
+    listing is queued, CarDBPipeline committed its car or the listing was
+    dropped without one. The lease of a crashed worker expires and its
+    requests are claimed again, up to FRONTIER_MAX_ATTEMPTS claims per
+    request.
+
+    Every query runs on a single database thread, in the order it was
+    queued, so the reactor never waits for Postgres. Claimed requests are
+    handed to the engine from a buffer that is refilled in the background
+    once it runs below half a batch.
+
+    Timestamps are taken from the database clock, so workers on different
+    machines agree on when a lease expires.
+    """
+
+    def __init__(
+        self,
+        crawler,
+        engine: Engine,
+        crawl: str,
+        batch_size: int,
+        lease_ttl: float,
+        max_attempts: int,
+        poll_interval: float,
+    ) -> None:
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.engine = engine
+        self.logger = getLogger(self.__class__.__name__)
+        self.crawl_name = crawl
+        self.batch_size = max(batch_size, 1)
+        self.lease_ttl = timedelta(seconds=lease_ttl)
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+
+        self.spider: Spider | None = None
+        self.crawl: str = ""
+        # Requests claimed by this worker and not handed to the engine yet
+        self.claimed: deque[Request] = deque()
+        # A claim is queued or running, the next one waits for it
+        self.claiming = False
+        # Ids whose lease is renewed, from the claim until the request leaves
+        # the downloader
+        self.leased_ids: set[int] = set()
+        # Rows waiting to be inserted, keyed by fingerprint to collapse
+        # duplicates within one batch
+        self.new_rows: dict[bytes, dict] = {}
+        self.new_rows_dont_filter: dict[bytes, dict] = {}
+        # Inserts queued or running, their rows are not claimable yet. Each
+        # one fires with whether its rows were inserted
+        self.inserts: set[defer.Deferred] = set()
+        self.done_ids: set[int] = set()
+        # Ids of the detail and phone requests of listings whose car is not
+        # stored yet, keyed by listing url
+        self.listing_ids: dict[str, list[int]] = {}
+        # An empty claim is retried, and open requests are looked for, at
+        # most every poll_interval
+        self.claimed_at = 0.0
+        self.claim_empty = False
+        self.checked_at = 0.0
+        self.frontier_open = True
+        self.flush_task: task.LoopingCall | None = None
+        self.lease_task: task.LoopingCall | None = None
+
+        # One thread keeps the queries in order: rows are inserted before
+        # the claim or the done update queued after them
+        self.db_pool = ThreadPool(
+            minthreads=1, maxthreads=1, name=self.__class__.__name__
+        )
+        self.pending_queries: set[defer.Deferred] = set()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        scheduler = cls(
+            crawler,
+            engine=get_engine(settings, "crawler"),
+            crawl=settings.get("FRONTIER_CRAWL") or time.strftime("%Y%m%d"),
+            batch_size=settings.getint("FRONTIER_BATCH_SIZE", 64),
+            lease_ttl=settings.getfloat("FRONTIER_LEASE_TTL", 300),
+            max_attempts=settings.getint("FRONTIER_MAX_ATTEMPTS", 10),
+            poll_interval=settings.getfloat("FRONTIER_POLL_INTERVAL", 5),
+        )
+        crawler.signals.connect(
+            scheduler.response_received, signal=signals.response_received
+        )
+        crawler.signals.connect(
+            scheduler.request_left_downloader,
+            signal=signals.request_left_downloader,
+        )
+        crawler.signals.connect(scheduler.listings_saved, signal=cars_saved)
+        crawler.signals.connect(scheduler.listing_dropped, signal=listing_dropped)
+        crawler.signals.connect(scheduler.item_dropped, signal=signals.item_dropped)
+        crawler.signals.connect(scheduler.item_dropped, signal=signals.item_error)
+        return scheduler
+
+    def open(self, spider: Spider) -> None:
+        self.spider = spider
+        self.crawl = f"{spider.name}:{self.crawl_name}"
+        self.fingerprinter = self.crawler.request_fingerprinter
+        self.logger.info(f"Worker {self.worker} joined frontier crawl {self.crawl}")
+
+        self.db_pool.start()
+        self.flush_task = task.LoopingCall(self.flush)
+        self.flush_task.start(1, now=False).addErrback(self.loop_failed, "flush")
+        self.lease_task = task.LoopingCall(self.renew_leases)
+        self.lease_task.start(
+            self.lease_ttl.total_seconds() / 3, now=False
+        ).addErrback(self.loop_failed, "lease renewal")
+
+    @defer.inlineCallbacks
+    def close(self, reason: str):
+        for looping_call in (self.flush_task, self.lease_task):
+            if looping_call is not None and looping_call.running:
+                looping_call.stop()
+
+        yield self.flush()
+        yield defer.DeferredList(list(self.pending_queries))
+        # Claimed requests the engine never got are handed back right away
+        # instead of waiting for their lease to expire
+        unused_ids = [request.meta["frontier_id"] for request in self.claimed]
+        if unused_ids:
+            yield self.run_query("release", self.release, unused_ids)
+        self.db_pool.stop()
+        self.engine.dispose()
+
+    def run_query(self, name: str, query, *args) -> defer.Deferred:
+        from twisted.internet import reactor
+
+        queried = threads.deferToThreadPool(reactor, self.db_pool, query, *args)
+        queried.addErrback(self.query_failed, name)
+        self.pending_queries.add(queried)
+        queried.addBoth(self.forget_query, queried)
+        return queried
+
+    def forget_query(self, result, queried: defer.Deferred):
+        self.pending_queries.discard(queried)
+        return result
+
+    def query_failed(self, failure: Failure, name: str) -> Failure:
+        self.logger.error(
+            f"Frontier {name} failed: {failure.value}",
+            exc_info=(failure.type, failure.value, failure.getTracebackObject()),
+        )
+        return failure
+
+    def loop_failed(self, failure: Failure, name: str) -> None:
+        self.logger.error(
+            f"Frontier {name} stopped: {failure.value}",
+            exc_info=(failure.type, failure.value, failure.getTracebackObject()),
+        )
+
+    def __len__(self) -> int:
+        # Requests held by this worker only, not the whole frontier
+        return len(self.claimed) + len(self.new_rows) + len(self.new_rows_dont_filter)
+
+    def has_pending_requests(self) -> bool:
+        if self.claimed or self.new_rows or self.new_rows_dont_filter or self.inserts:
+            return True
+
+        # Open requests leased by other workers keep this one alive, their
+        # lease may expire and leave them to be claimed here. The answer
+        # arrives later, until then the last one stands
+        if time.monotonic() - self.checked_at >= self.poll_interval:
+            self.checked_at = time.monotonic()
+            checked = self.run_query("open requests check", self.any_open)
+            checked.addCallbacks(self.on_checked, lambda _: None)
+        return self.frontier_open
+
+    def any_open(self) -> bool:
+        with self.engine.connect() as connection:
+            return connection.execute(
+                select(exists().where(*self.open_filters()))
+            ).scalar_one()
+
+    def on_checked(self, frontier_open: bool) -> None:
+        self.frontier_open = frontier_open
+        if not frontier_open:
+            self.wake_engine()
+
+    def enqueue_request(self, request: Request) -> bool:
+        fingerprint = self.fingerprinter.fingerprint(request)
+        row = {
+            "crawl": self.crawl,
+            "fingerprint": fingerprint,
+            "priority": request.priority,
+            "request": pickle.dumps(
+                request.to_dict(spider=self.spider), protocol=pickle.HIGHEST_PROTOCOL
+            ),
+        }
+        if request.dont_filter:
+            self.new_rows_dont_filter[fingerprint] = row
+        else:
+            self.new_rows.setdefault(fingerprint, row)
+
+        listing = request.meta.get("listing")
+        if listing:
+            # The phone request carries the car on, the detail request is
+            # done as soon as it is inserted, which flush() does first
+            self.done_ids.update(self.listing_ids.pop(listing, ()))
+
+        self.stats.inc_value("frontier/enqueued")
+        if len(self.new_rows) + len(self.new_rows_dont_filter) >= self.batch_size:
+            self.flush_new_rows()
+        return True
+
+    def next_request(self) -> Request | None:
+        if len(self.claimed) <= self.batch_size // 2:
+            self.prefetch()
+        if self.claimed:
+            return self.claimed.popleft()
+        return None
+
+    def response_received(
+        self, response: Response, request: Request, spider: Spider
+    ) -> None:
+        frontier_id = request.meta.get("frontier_id")
+        if frontier_id is None:
+            return
+
+        listing = request.meta.get("listing")
+        if listing:
+            self.listing_ids.setdefault(listing, []).append(frontier_id)
+        else:
+            self.done_ids.add(frontier_id)
+
+    def listings_saved(self, urls: list[str]) -> None:
+        for url in urls:
+            self.done_ids.update(self.listing_ids.pop(url, ()))
+
+    def listing_dropped(self, url: str) -> None:
+        self.done_ids.update(self.listing_ids.pop(url, ()))
+
+    def item_dropped(self, item, response: Response, spider: Spider, **kwargs) -> None:
+        # A car dropped or failed by a pipeline is not saved by CarDBPipeline
+        url = ItemAdapter(item).get("url")
+        if url:
+            self.done_ids.update(self.listing_ids.pop(url, ()))
+
+    def request_left_downloader(self, request: Request, spider: Spider) -> None:
+        # A failed download keeps its lease until it expires and the request
+        # is claimed again
+        self.leased_ids.discard(request.meta.get("frontier_id"))
+
+    def open_filters(self) -> list:
+        return [
+            FrontierRequest.crawl == self.crawl,
+            FrontierRequest.done_at.is_(None),
+            FrontierRequest.attempts < self.max_attempts,
+        ]
+
+    def prefetch(self) -> None:
+        if self.claiming:
+            return
+        # Requests found by this worker are claimable right away
+        has_new_rows = bool(self.new_rows or self.new_rows_dont_filter)
+        if (
+            self.claim_empty
+            and not has_new_rows
+            and time.monotonic() - self.claimed_at < self.poll_interval
+        ):
+            return
+
+        self.claiming = True
+        self.flush_new_rows()
+        claimed = self.run_query("claim", self.claim)
+        claimed.addCallbacks(self.on_claimed, lambda _: None)
+        claimed.addBoth(self.claim_finished)
+
+    def claim(self) -> list[tuple[int, int, dict]]:
+        claimable = (
+            select(FrontierRequest.id)
+            .where(
+                *self.open_filters(),
+                or_(
+                    FrontierRequest.lease_expires_at.is_(None),
+                    FrontierRequest.lease_expires_at < func.localtimestamp(),
+                ),
+            )
+            .order_by(FrontierRequest.priority.desc(), FrontierRequest.id)
+            .limit(self.batch_size)
+            .with_for_update(skip_locked=True)
+        )
+        stmt = (
+            update(FrontierRequest)
+            .where(FrontierRequest.id.in_(claimable))
+            .values(
+                leased_by=self.worker,
+                lease_expires_at=func.localtimestamp() + self.lease_ttl,
+                attempts=FrontierRequest.attempts + 1,
+            )
+            .returning(
+                FrontierRequest.id,
+                FrontierRequest.priority,
+                FrontierRequest.attempts,
+                FrontierRequest.request,
+            )
+        )
+        with self.engine.begin() as connection:
+            rows = connection.execute(stmt).all()
+
+        # RETURNING does not keep the order of the subquery
+        return [
+            (frontier_id, attempts, pickle.loads(data))
+            for frontier_id, _, attempts, data in sorted(
+                rows, key=lambda row: (-row.priority, row.id)
+            )
+        ]
+
+    def on_claimed(self, rows: list[tuple[int, int, dict]]) -> None:
+        self.claimed_at = time.monotonic()
+        self.claim_empty = not rows
+        if rows and not self.claimed:
+            self.wake_engine()
+        for frontier_id, attempts, data in rows:
+            request = request_from_dict(data, spider=self.spider)
+            request.meta["frontier_id"] = frontier_id
+            if attempts > 1:
+                self.stats.inc_value("frontier/reclaimed")
+            self.claimed.append(request)
+            self.leased_ids.add(frontier_id)
+        if rows:
+            self.stats.inc_value("frontier/claimed", len(rows))
+
+    def claim_finished(self, _) -> None:
+        self.claiming = False
+
+    def wake_engine(self) -> None:
+        # After an empty next_request the engine only asks again, or looks
+        # for idleness, on its heartbeat every 5 seconds. Scrapy 2.13 made
+        # the slot private
+        engine = self.crawler.engine
+        slot = getattr(engine, "_slot", None) or getattr(engine, "slot", None)
+        if slot is not None:
+            slot.nextcall.schedule()
+
+    def flush(self) -> defer.Deferred:
+        # A listing's request is done once the requests it led to are in the
+        # frontier, so done ids wait for every insert started before them
+        done_ids = self.done_ids
+        self.done_ids = set()
+        self.flush_new_rows()
+        inserted = defer.gatherResults(list(self.inserts))
+        inserted.addCallback(self.flush_done, done_ids)
+        return inserted
+
+    def flush_new_rows(self) -> defer.Deferred:
+        if not self.new_rows and not self.new_rows_dont_filter:
+            return defer.succeed(None)
+
+        new_rows, new_rows_dont_filter = self.new_rows, self.new_rows_dont_filter
+        self.new_rows = {}
+        self.new_rows_dont_filter = {}
+        inserted = self.run_query(
+            "insert", self.insert_rows, new_rows, new_rows_dont_filter
+        )
+        inserted.addCallbacks(
+            self.on_rows_inserted,
+            self.on_insert_failed,
+            errbackArgs=(new_rows, new_rows_dont_filter),
+        )
+        inserted.addBoth(self.insert_finished, inserted)
+        self.inserts.add(inserted)
+        return inserted
+
+    def insert_rows(
+        self, new_rows: dict[bytes, dict], new_rows_dont_filter: dict[bytes, dict]
+    ) -> None:
+        index_elements = [FrontierRequest.crawl, FrontierRequest.fingerprint]
+        with self.engine.begin() as connection:
+            if new_rows:
+                connection.execute(
+                    insert(FrontierRequest)
+                    .values(list(new_rows.values()))
+                    .on_conflict_do_nothing(index_elements=index_elements)
+                )
+            if new_rows_dont_filter:
+                # dont_filter requests, retries among them, reopen a row that
+                # may already be done
+                insert_stmt = insert(FrontierRequest).values(
+                    list(new_rows_dont_filter.values())
+                )
+                connection.execute(
+                    insert_stmt.on_conflict_do_update(
+                        index_elements=index_elements,
+                        set_={
+                            "priority": insert_stmt.excluded.priority,
+                            "request": insert_stmt.excluded.request,
+                            "leased_by": None,
+                            "lease_expires_at": None,
+                            "done_at": None,
+                        },
+                    )
+                )
+
+    def on_rows_inserted(self, _) -> bool:
+        self.claim_empty = False
+        self.frontier_open = True
+        return True
+
+    def insert_finished(self, result: bool, inserted: defer.Deferred) -> bool:
+        self.inserts.discard(inserted)
+        return result
+
+    def on_insert_failed(
+        self,
+        failure: Failure,
+        new_rows: dict[bytes, dict],
+        new_rows_dont_filter: dict[bytes, dict],
+    ) -> bool:
+        # Put back for the next flush, behind rows queued in the meantime
+        self.new_rows = {**new_rows, **self.new_rows}
+        self.new_rows_dont_filter = {
+            **new_rows_dont_filter,
+            **self.new_rows_dont_filter,
+        }
+        return False
+
+    def flush_done(
+        self, inserted: list[bool], done_ids: set[int]
+    ) -> defer.Deferred | None:
+        if not all(inserted):
+            # Marked with the next flush, once the rows put back are inserted
+            self.done_ids.update(done_ids)
+            return None
+        if not done_ids:
+            return None
+
+        marked = self.run_query("done update", self.mark_done, list(done_ids))
+        marked.addCallbacks(
+            lambda _: self.stats.inc_value("frontier/done", len(done_ids)),
+            lambda _: self.done_ids.update(done_ids),
+        )
+        return marked
+
+    def mark_done(self, done_ids: list[int]) -> None:
+        with self.engine.begin() as connection:
+            connection.execute(
+                update(FrontierRequest)
+                .where(FrontierRequest.id.in_(done_ids))
+                .values(done_at=func.localtimestamp(), leased_by=None)
+            )
+
+    def renew_leases(self) -> defer.Deferred:
+        if not self.leased_ids:
+            return defer.succeed(None)
+
+        renewed = self.run_query(
+            "lease renewal", self.extend_leases, list(self.leased_ids)
+        )
+        # Retried on the next tick, well before the leases run out
+        renewed.addErrback(lambda _: None)
+        return renewed
+
+    def extend_leases(self, leased_ids: list[int]) -> None:
+        with self.engine.begin() as connection:
+            connection.execute(
+                update(FrontierRequest)
+                .where(
+                    FrontierRequest.id.in_(leased_ids),
+                    FrontierRequest.leased_by == self.worker,
+                )
+                .values(lease_expires_at=func.localtimestamp() + self.lease_ttl)
+            )
+
+    def release(self, unused_ids: list[int]) -> None:
+        with self.engine.begin() as connection:
+            connection.execute(
+                update(FrontierRequest)
+                .where(FrontierRequest.id.in_(unused_ids))
+                .values(
+                    leased_by=None,
+                    lease_expires_at=None,
+                    attempts=FrontierRequest.attempts - 1,
+                )
+            )
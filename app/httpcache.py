@@ -0,0 +1,188 @@
+import os
+import sqlite3
+import time
+import zlib
+from logging import getLogger
+
+from scrapy import Request, Spider
+from scrapy.extensions.httpcache import RFC2616Policy
+from scrapy.http import Headers, Response
+from scrapy.responsetypes import responsetypes
+from scrapy.settings import BaseSettings
+from scrapy.utils.project import data_path
+from w3lib.http import headers_dict_to_raw, headers_raw_to_dict
+
+
+class DetailPagePolicy(RFC2616Policy):
+    """Caches only the requests whose meta["request_slot"] is in
+    HTTPCACHE_DOWNLOAD_SLOTS and revalidates every cached response.
+
+    A listing can change at any time, so a cached page is never served as
+    fresh. Its ETag/Last-Modified turn the revisit into a conditional
+    request, and on a 304 the stored page is handed to the callback.
+    """
+
+    def __init__(self, settings: BaseSettings) -> None:
+        super().__init__(settings)
+        self.download_slots = set(settings.getlist("HTTPCACHE_DOWNLOAD_SLOTS"))
+
+    def should_cache_request(self, request: Request) -> bool:
+        return (
+            request.meta.get("request_slot") in self.download_slots
+            and super().should_cache_request(request)
+        )
+
+    def should_cache_response(self, response: Response, request: Request) -> bool:
+        # Without a validator a stored page could never be revalidated
+        return (
+            response.status == 200
+            and (b"ETag" in response.headers or b"Last-Modified" in response.headers)
+            and super().should_cache_response(response, request)
+        )
+
+    def is_cached_response_fresh(
+        self, cachedresponse: Response, request: Request
+    ) -> bool:
+        self._set_conditional_validators(request, cachedresponse)
+        return False
+
+
+class CompressedCacheStorage:
+    """HTTP cache entries in a sqlite file, bodies compressed with zlib.
+
+    Entries are evicted when they were last stored more than
+    HTTPCACHE_EXPIRATION_SECS ago, and least recently used first once the
+    compressed bodies outgrow HTTPCACHE_MAX_SIZE bytes. Eviction runs when
+    the spider opens and closes and every evict_interval stores, and is
+    counted under httpcache/evicted_expired and httpcache/evicted_oversized.
+    """
+
+    compression_level: int = 6
+    evict_interval: int = 1000
+
+    def __init__(self, settings: BaseSettings) -> None:
+        self.cachedir = data_path(settings["HTTPCACHE_DIR"], createdir=True)
+        self.expiration_secs = settings.getint("HTTPCACHE_EXPIRATION_SECS")
+        self.max_size = settings.getint("HTTPCACHE_MAX_SIZE")
+        self.logger = getLogger(self.__class__.__name__)
+        self.connection: sqlite3.Connection | None = None
+        self.stores_since_eviction = 0
+
+    def open_spider(self, spider: Spider) -> None:
+        self.fingerprinter = spider.crawler.request_fingerprinter
+        self.stats = spider.crawler.stats
+        path = os.path.join(self.cachedir, f"{spider.name}.sqlite3")
+        self.connection = sqlite3.connect(path, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                fingerprint BLOB PRIMARY KEY,
+                url TEXT NOT NULL,
+                status INTEGER NOT NULL,
+                headers BLOB NOT NULL,
+                body BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                stored_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            """
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed_at "
+            "ON responses (accessed_at)"
+        )
+        self.evict()
+
+    def close_spider(self, spider: Spider) -> None:
+        self.evict()
+        self.connection.close()
+
+    def retrieve_response(self, spider: Spider, request: Request) -> Response | None:
+        fingerprint = self.fingerprinter.fingerprint(request)
+        row = self.connection.execute(
+            "SELECT url, status, headers, body, stored_at FROM responses "
+            "WHERE fingerprint = ?",
+            (fingerprint,),
+        ).fetchone()
+        if row is None:
+            return None
+
+        url, status, raw_headers, compressed_body, stored_at = row
+        if self.is_expired(stored_at):
+            return None
+
+        self.connection.execute(
+            "UPDATE responses SET accessed_at = ? WHERE fingerprint = ?",
+            (time.time(), fingerprint),
+        )
+        headers = Headers(headers_raw_to_dict(raw_headers))
+        body = zlib.decompress(compressed_body)
+        respcls = responsetypes.from_args(headers=headers, url=url, body=body)
+        return respcls(url=url, headers=headers, status=status, body=body)
+
+    def store_response(
+        self, spider: Spider, request: Request, response: Response
+    ) -> None:
+        body = zlib.compress(response.body, self.compression_level)
+        raw_headers = headers_dict_to_raw(response.headers)
+        now = time.time()
+        self.connection.execute(
+            "INSERT OR REPLACE INTO responses "
+            "(fingerprint, url, status, headers, body, size, stored_at, accessed_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                self.fingerprinter.fingerprint(request),
+                response.url,
+                response.status,
+                raw_headers,
+                body,
+                len(body),
+                now,
+                now,
+            ),
+        )
+
+        self.stores_since_eviction += 1
+        if self.stores_since_eviction >= self.evict_interval:
+            self.evict()
+
+    def is_expired(self, stored_at: float) -> bool:
+        return 0 < self.expiration_secs < time.time() - stored_at
+
+    def evict(self) -> None:
+        self.stores_since_eviction = 0
+        expired = 0
+        if self.expiration_secs > 0:
+            expired = self.connection.execute(
+                "DELETE FROM responses WHERE stored_at < ?",
+                (time.time() - self.expiration_secs,),
+            ).rowcount
+
+        oversized = 0
+        if self.max_size > 0:
+            oversized = self.connection.execute(
+                """
+                DELETE FROM responses WHERE fingerprint IN (
+                    SELECT fingerprint FROM (
+                        SELECT
+                            fingerprint,
+                            sum(size) OVER (ORDER BY accessed_at DESC) AS kept_size
+                        FROM responses
+                    )
+                    WHERE kept_size > ?
+                )
+                """,
+                (self.max_size,),
+            ).rowcount
+
+        if expired:
+            self.stats.inc_value("httpcache/evicted_expired", expired)
+        if oversized:
+            self.stats.inc_value("httpcache/evicted_oversized", oversized)
+        if expired or oversized:
+            self.logger.info(
+                f"Evicted {expired} expired and {oversized} least recently used "
+                f"cached responses"
+            )
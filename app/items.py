@@ -1,14 +1,26 @@
-import scrapy
-
-
-class CarItem(scrapy.Item):
-    url = scrapy.Field()
-    title = scrapy.Field()
-    price_usd = scrapy.Field()
-    odometer = scrapy.Field()
-    username = scrapy.Field()
-    image_url = scrapy.Field()
-    images_count = scrapy.Field()
-    car_number = scrapy.Field()
-    car_vin = scrapy.Field()
-    phone_number = scrapy.Field()
+from dataclasses import dataclass, fields
+
+
+@dataclass(slots=True)
+class CarItem:
+    """A car from its detail page to CarDBPipeline.
+
+    The same instance is carried in the cb_kwargs of the phone request and
+    yielded once the phone number is set. Slots keep it a fraction of the
+    size of a dict or a scrapy.Item, which matters with tens of thousands of
+    phone requests queued; itemadapter handles dataclass items natively.
+    """
+
+    url: str
+    title: str | None = None
+    price_usd: int | None = None
+    odometer: int | None = None
+    username: str | None = None
+    image_url: str | None = None
+    images_count: int | None = None
+    car_number: str | None = None
+    car_vin: str | None = None
+    phone_number: int | None = None
+
+
+CAR_ITEM_FIELDS: tuple[str, ...] = tuple(field.name for field in fields(CarItem))
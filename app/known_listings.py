@@ -0,0 +1,110 @@
+import re
+import time
+from datetime import timedelta
+
+from sqlalchemy import Engine, func, select
+
+from app.database.models import Car
+
+CAR_ID_REGEX = re.compile(r"_(\d+)\.html")
+
+
+def get_car_id_from_url(url: str) -> int | None:
+    match = CAR_ID_REGEX.search(url)
+    if match is None:
+        return None
+    return int(match.group(1))
+
+
+class KnownListingsIndex:
+    """Prices of listings stored within the revisit TTL, keyed by car id.
+
+    Only fresh listings are loaded, so a listing missing from the index has
+    to be fetched either way and no per-entry timestamp is kept.
+    """
+
+    load_chunk_size: int = 10000
+
+    def __init__(self, prices: dict[int, int] | None = None) -> None:
+        self.prices: dict[int, int] = prices or {}
+
+    def __len__(self) -> int:
+        return len(self.prices)
+
+    @classmethod
+    def load(cls, engine: Engine, revisit_ttl: float) -> "KnownListingsIndex":
+        index = cls()
+        stmt = select(Car.url, Car.price_usd).where(
+            Car.last_seen_at > func.localtimestamp() - timedelta(seconds=revisit_ttl)
+        )
+        with engine.connect() as connection:
+            rows = connection.execution_options(
+                yield_per=cls.load_chunk_size
+            ).execute(stmt)
+            for url, price_usd in rows:
+                car_id = get_car_id_from_url(url)
+                if car_id is not None:
+                    index.prices[car_id] = price_usd
+        return index
+
+    def is_fresh(self, url: str, price_usd: int | None) -> bool:
+        if price_usd is None:
+            return False
+
+        car_id = get_car_id_from_url(url)
+        if car_id is None:
+            return False
+
+        return self.prices.get(car_id) == price_usd
+
+
+class PhoneNumberCache:
+    """Phone numbers of stored listings keyed by car id, backed by the
+    cars.phone_number column. An entry expires ttl seconds after the phone
+    was fetched from /users/phones/, however often the listing is crawled.
+    """
+
+    load_chunk_size: int = 10000
+
+    def __init__(self, ttl: float = 0) -> None:
+        self.ttl = ttl
+        # car id -> (phone number, monotonic expiry time)
+        self.entries: dict[int, tuple[int, float]] = {}
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    @classmethod
+    def load(cls, engine: Engine, ttl: float) -> "PhoneNumberCache":
+        cache = cls(ttl)
+        age = func.extract("epoch", func.localtimestamp() - Car.phone_fetched_at)
+        stmt = select(Car.url, Car.phone_number, age).where(
+            Car.phone_number.is_not(None),
+            Car.phone_fetched_at > func.localtimestamp() - timedelta(seconds=ttl),
+        )
+        loaded_at = time.monotonic()
+        with engine.connect() as connection:
+            rows = connection.execution_options(
+                yield_per=cls.load_chunk_size
+            ).execute(stmt)
+            for url, phone_number, age_seconds in rows:
+                car_id = get_car_id_from_url(url)
+                if car_id is not None:
+                    expires_at = loaded_at + ttl - float(age_seconds)
+                    cache.entries[car_id] = (phone_number, expires_at)
+        return cache
+
+    def get(self, car_id: int) -> int | None:
+        entry = self.entries.get(car_id)
+        if entry is None:
+            return None
+
+        phone_number, expires_at = entry
+        if expires_at < time.monotonic():
+            del self.entries[car_id]
+            return None
+        return phone_number
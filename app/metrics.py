@@ -0,0 +1,227 @@
+import os
+from logging import getLogger
+from typing import Iterator
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    write_to_textfile,
+)
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.registry import Collector
+from scrapy import Spider, signals
+from scrapy.exceptions import NotConfigured
+from twisted.internet import task
+from twisted.web import resource, server
+
+# Callbacks and database writes mostly take milliseconds, below the
+# prometheus_client default of 5ms
+SECONDS_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+
+CALLBACK_SECONDS = Histogram(
+    "autoria_callback_seconds",
+    "Time spent inside a spider callback per response",
+    ["callback"],
+    buckets=SECONDS_BUCKETS,
+)
+CALLBACK_ERRORS = Counter(
+    "autoria_callback_errors_total",
+    "Exceptions raised out of a spider callback",
+    ["callback"],
+)
+CALLBACK_OUTPUTS = Counter(
+    "autoria_callback_outputs_total",
+    "Requests and items produced by a spider callback",
+    ["callback", "kind"],
+)
+FIELD_FAILURES = Counter(
+    "autoria_field_failures_total",
+    "Detail page fields no path matched (missing) or failed to parse",
+    ["field", "reason"],
+)
+DETAIL_PAGE_TREES = Counter(
+    "autoria_detail_page_trees_total",
+    "Detail pages parsed into a tree, by the field the text scan could not settle",
+    ["field"],
+)
+DB_FLUSH_SECONDS = Histogram(
+    "autoria_db_flush_seconds",
+    "Time CarDBPipeline spent writing and committing one batch",
+    buckets=SECONDS_BUCKETS,
+)
+DB_FLUSH_ROWS = Counter(
+    "autoria_db_flush_rows_total",
+    "Rows CarDBPipeline wrote, by outcome",
+    ["outcome"],
+)
+DB_POOL_WAIT_SECONDS = Histogram(
+    "autoria_db_pool_wait_seconds",
+    "Time a checkout waited for a pooled database connection, by engine profile",
+    ["profile"],
+    buckets=SECONDS_BUCKETS,
+)
+DB_POOL_TIMEOUTS = Counter(
+    "autoria_db_pool_timeouts_total",
+    "Checkouts that gave up waiting for a pooled database connection",
+    ["profile"],
+)
+DB_POOL_CHECKED_OUT = Gauge(
+    "autoria_db_pool_checked_out",
+    "Database connections in use, by engine profile",
+    ["profile"],
+)
+
+
+def get_scheduler(engine):
+    # ExecutionEngine.scheduler is Scrapy 2.19+, earlier versions keep it on
+    # the engine slot
+    slot = getattr(engine, "slot", None)
+    return slot.scheduler if slot is not None else getattr(engine, "scheduler", None)
+
+
+class CrawlerCollector(Collector):
+    """Scheduler queue depth, active downloads and the numeric Scrapy stats of
+    a crawler, read when the registry is collected."""
+
+    def __init__(self, crawler) -> None:
+        self.crawler = crawler
+
+    def collect(self) -> Iterator[GaugeMetricFamily]:
+        engine = self.crawler.engine
+        scheduler = get_scheduler(engine) if engine is not None else None
+        if scheduler is not None and hasattr(scheduler, "__len__"):
+            yield GaugeMetricFamily(
+                "autoria_scheduler_queue_size",
+                "Requests waiting in the scheduler",
+                value=len(scheduler),
+            )
+        if engine is not None:
+            yield GaugeMetricFamily(
+                "autoria_downloader_active_requests",
+                "Requests being downloaded",
+                value=len(engine.downloader.active),
+            )
+
+        stats = GaugeMetricFamily(
+            "autoria_scrapy_stat",
+            "Numeric values of the Scrapy stats collector",
+            labels=["stat"],
+        )
+        for key, value in self.crawler.stats.get_stats().items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                stats.add_metric([key], value)
+        yield stats
+
+
+class MetricsResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, registry: CollectorRegistry) -> None:
+        super().__init__()
+        self.registry = registry
+
+    def render_GET(self, request) -> bytes:
+        # On the reactor thread, the crawler stats are not read mid-update
+        request.setHeader(b"Content-Type", CONTENT_TYPE_LATEST.encode())
+        return generate_latest(self.registry)
+
+
+class MetricsExporter:
+    """Exposes the prometheus_client registry with the crawler's gauges.
+
+    Served over HTTP on METRICS_HOST:METRICS_PORT for scraping, and written
+    to METRICS_FILE every METRICS_INTERVAL seconds for the node_exporter
+    textfile collector.
+    """
+
+    def __init__(
+        self,
+        crawler,
+        host: str,
+        port: int,
+        path: str,
+        interval: float,
+        registry: CollectorRegistry = REGISTRY,
+    ) -> None:
+        self.crawler = crawler
+        self.host = host
+        self.port = port
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+        self.collector = CrawlerCollector(crawler)
+        self.logger = getLogger(self.__class__.__name__)
+        self.write_task: task.LoopingCall | None = None
+        self.listening_port = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool("METRICS_ENABLED"):
+            raise NotConfigured
+
+        exporter = cls(
+            crawler,
+            host=settings.get("METRICS_HOST", "127.0.0.1"),
+            port=settings.getint("METRICS_PORT"),
+            path=settings.get("METRICS_FILE", ""),
+            interval=settings.getfloat("METRICS_INTERVAL", 15),
+        )
+        if not exporter.port and not exporter.path:
+            raise NotConfigured("Neither METRICS_PORT nor METRICS_FILE is set")
+
+        crawler.signals.connect(exporter.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(exporter.spider_closed, signal=signals.spider_closed)
+        return exporter
+
+    def spider_opened(self, spider: Spider) -> None:
+        from twisted.internet import reactor
+
+        self.registry.register(self.collector)
+        if self.port:
+            self.listening_port = reactor.listenTCP(
+                self.port,
+                server.Site(MetricsResource(self.registry)),
+                interface=self.host,
+            )
+            self.logger.info(f"Serving metrics on http://{self.host}:{self.port}/")
+
+        if self.path:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.write_task = task.LoopingCall(self.write)
+            self.write_task.start(self.interval, now=False)
+
+    def spider_closed(self, spider: Spider) -> None:
+        if self.write_task is not None and self.write_task.running:
+            self.write_task.stop()
+        if self.path:
+            self.write()
+        if self.listening_port is not None:
+            self.listening_port.stopListening()
+        self.registry.unregister(self.collector)
+
+    def write(self) -> None:
+        # Written to a temporary file and renamed into place
+        write_to_textfile(self.path, self.registry)
@@ -3,101 +3,337 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
-from scrapy import signals
+import time
+from dataclasses import dataclass
+from logging import getLogger
+
+from scrapy import Request, signals
+from scrapy.exceptions import NotConfigured
 
 # useful for handling different item types with a single interface
-from itemadapter import is_item, ItemAdapter
+from itemadapter import is_item
+
+from app import metrics
+from app.signals import listing_dropped
 
 
 class SrcSpiderMiddleware:
-    # Not all methods need to be defined. If a method is not defined,
-    # scrapy acts as if the spider middleware does not modify the
-    # passed objects.
+    """Records the time spent in every spider callback, its outputs and its
+    exceptions in app.metrics.
+
+    Only the time inside the callback generator counts, the consumers of
+    its requests and items run between two outputs and are left out.
+    """
 
     @classmethod
     def from_crawler(cls, crawler):
-        # This method is used by Scrapy to create your spiders.
         s = cls()
         crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
         return s
 
-    def process_spider_input(self, response, spider):
-        # Called for each response that goes through the spider
-        # middleware and into the spider.
+    def process_spider_output(self, response, result, spider):
+        callback = self.get_callback_name(response, spider)
+        elapsed = 0.0
+        iterator = iter(result)
+        while True:
+            started_at = time.perf_counter()
+            try:
+                output = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.perf_counter() - started_at
 
-        # Should return None or raise an exception.
-        return None
+            self.count_output(callback, output)
+            yield output
 
-    def process_spider_output(self, response, result, spider):
-        # Called with the results returned from the Spider, after
-        # it has processed the response.
+        metrics.CALLBACK_SECONDS.labels(callback).observe(elapsed)
 
-        # Must return an iterable of Request, or item objects.
-        for i in result:
-            yield i
+    async def process_spider_output_async(self, response, result, spider):
+        # Used instead of process_spider_output when an earlier middleware or
+        # the spider produces an async iterable
+        callback = self.get_callback_name(response, spider)
+        elapsed = 0.0
+        iterator = result.__aiter__()
+        while True:
+            started_at = time.perf_counter()
+            try:
+                output = await iterator.__anext__()
+            except StopAsyncIteration:
+                break
+            finally:
+                elapsed += time.perf_counter() - started_at
 
-    def process_spider_exception(self, response, exception, spider):
-        # Called when a spider or process_spider_input() method
-        # (from other spider middleware) raises an exception.
+            self.count_output(callback, output)
+            yield output
+
+        metrics.CALLBACK_SECONDS.labels(callback).observe(elapsed)
 
-        # Should return either None or an iterable of Request or item objects.
-        pass
+    def process_spider_exception(self, response, exception, spider):
+        metrics.CALLBACK_ERRORS.labels(self.get_callback_name(response, spider)).inc()
+        return None
 
-    def process_start_requests(self, start_requests, spider):
-        # Called with the start requests of the spider, and works
-        # similarly to the process_spider_output() method, except
-        # that it doesn’t have a response associated.
+    def count_output(self, callback: str, output) -> None:
+        kind = "item" if is_item(output) else "request"
+        metrics.CALLBACK_OUTPUTS.labels(callback, kind).inc()
 
-        # Must return only requests (not items).
-        for r in start_requests:
-            yield r
+    def get_callback_name(self, response, spider) -> str:
+        # Requests without a callback go to the spider's parse method
+        callback = response.request.callback if response.request else None
+        return callback.__name__ if callback is not None else "parse"
 
     def spider_opened(self, spider):
         spider.logger.info("Spider opened: %s" % spider.name)
 
 
-class SrcDownloaderMiddleware:
-    # Not all methods need to be defined. If a method is not defined,
-    # scrapy acts as if the downloader middleware does not modify the
-    # passed objects.
+class ListingSpiderMiddleware:
+    """Sends listing_dropped for a listing whose callback raised or ended
+    without an item or a further request of the listing.
+
+    The frontier keeps a listing open until its car is saved, a detail page
+    that is gone or could not be parsed would otherwise never be done.
+    """
+
+    def __init__(self, crawler) -> None:
+        self.crawler = crawler
 
     @classmethod
     def from_crawler(cls, crawler):
-        # This method is used by Scrapy to create your spiders.
-        s = cls()
-        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
-        return s
+        if not crawler.settings.getbool("FRONTIER_ENABLED"):
+            raise NotConfigured
+        return cls(crawler)
+
+    def process_spider_output(self, response, result, spider):
+        listing = response.meta.get("listing")
+        carried = False
+        for output in result:
+            carried = carried or self.carries_listing(output)
+            yield output
+
+        if listing and not carried:
+            self.drop(listing)
 
-    def process_request(self, request, spider):
-        # Called for each request that goes through the downloader
-        # middleware.
+    async def process_spider_output_async(self, response, result, spider):
+        listing = response.meta.get("listing")
+        carried = False
+        async for output in result:
+            carried = carried or self.carries_listing(output)
+            yield output
 
-        # Must either:
-        # - return None: continue processing this request
-        # - or return a Response object
-        # - or return a Request object
-        # - or raise IgnoreRequest: process_exception() methods of
-        #   installed downloader middleware will be called
+        if listing and not carried:
+            self.drop(listing)
+
+    def process_spider_exception(self, response, exception, spider):
+        listing = response.meta.get("listing")
+        if listing:
+            self.drop(listing)
         return None
 
+    def carries_listing(self, output) -> bool:
+        return is_item(output) or bool(
+            isinstance(output, Request) and output.meta.get("listing")
+        )
+
+    def drop(self, listing: str) -> None:
+        self.crawler.stats.inc_value("frontier/listings_dropped")
+        self.crawler.signals.send_catch_log(listing_dropped, url=listing)
+
+
+@dataclass
+class ThrottleState:
+    """Concurrency and delay the controller settled on for one download slot."""
+
+    concurrency: int
+    delay: float
+    latency: float = 0.0
+    successes: int = 0
+    decreased_at: float = 0.0
+
+
+class AdaptiveThrottleMiddleware:
+    """AIMD controller of the concurrency and delay of every download slot.
+
+    While it is enabled the spider puts SERP, detail and phone requests in
+    separate slots via meta["download_slot"], each one is tuned on its own. A window of fast
+    successful responses first shortens a backoff delay, then adds one
+    concurrent request; a latency above the target takes one away. A
+    throttling response or a download error halves the concurrency and
+    doubles the delay, honouring Retry-After. Throttled requests are
+    rescheduled and wait out the raised delay of their slot.
+    """
+
+    # Weight of the latest download latency in the moving average
+    latency_smoothing: float = 0.2
+    # Share of a backoff delay kept after every window of fast responses
+    delay_decay: float = 0.75
+    # Delays below this are dropped, the slot runs back at full speed
+    min_delay: float = 0.01
+
+    def __init__(
+        self,
+        crawler,
+        start_concurrency: int,
+        max_concurrency: int,
+        start_delay: float,
+        backoff_delay: float,
+        max_delay: float,
+        target_latency: float,
+        throttle_http_codes: list[int],
+        max_retries: int,
+    ) -> None:
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.logger = getLogger(self.__class__.__name__)
+        self.start_concurrency = max(start_concurrency, 1)
+        self.max_concurrency = max(max_concurrency, self.start_concurrency)
+        self.start_delay = start_delay
+        self.backoff_delay = backoff_delay
+        self.max_delay = max_delay
+        self.target_latency = target_latency
+        self.throttle_http_codes = set(throttle_http_codes)
+        self.max_retries = max_retries
+        self.states: dict[str, ThrottleState] = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool("ADAPTIVE_THROTTLE_ENABLED"):
+            raise NotConfigured
+        if settings.getbool("AUTOTHROTTLE_ENABLED"):
+            raise NotConfigured("AutoThrottle already controls the download delay")
+
+        return cls(
+            crawler,
+            start_concurrency=settings.getint("CONCURRENT_REQUESTS_PER_DOMAIN"),
+            max_concurrency=settings.getint(
+                "ADAPTIVE_THROTTLE_MAX_CONCURRENCY",
+                settings.getint("CONCURRENT_REQUESTS"),
+            ),
+            start_delay=settings.getfloat("DOWNLOAD_DELAY"),
+            backoff_delay=settings.getfloat("ADAPTIVE_THROTTLE_BACKOFF_DELAY", 1),
+            max_delay=settings.getfloat("ADAPTIVE_THROTTLE_MAX_DELAY", 60),
+            target_latency=settings.getfloat("ADAPTIVE_THROTTLE_TARGET_LATENCY", 2),
+            throttle_http_codes=settings.getlist(
+                "ADAPTIVE_THROTTLE_HTTP_CODES", [429, 403]
+            ),
+            max_retries=settings.getint("ADAPTIVE_THROTTLE_MAX_RETRIES", 5),
+        )
+
     def process_response(self, request, response, spider):
-        # Called with the response returned from the downloader.
+        key = request.meta.get("download_slot")
+        if key is None:
+            return response
+
+        state = self.get_state(key)
+        if response.status in self.throttle_http_codes:
+            self.stats.inc_value(f"adaptive_throttle/{key}/throttled")
+            self.back_off(key, state, self.get_retry_after(response))
+            return self.requeue(request, response, key)
 
-        # Must either;
-        # - return a Response object
-        # - return a Request object
-        # - or raise IgnoreRequest
+        self.on_success(key, state, request.meta.get("download_latency"))
         return response
 
     def process_exception(self, request, exception, spider):
-        # Called when a download handler or a process_request()
-        # (from other downloader middleware) raises an exception.
+        key = request.meta.get("download_slot")
+        if key is not None:
+            # Retried by RetryMiddleware, only the pace is adjusted here
+            self.stats.inc_value(f"adaptive_throttle/{key}/errors")
+            self.back_off(key, self.get_state(key))
+        return None
 
-        # Must either:
-        # - return None: continue processing this exception
-        # - return a Response object: stops process_exception() chain
-        # - return a Request object: stops process_exception() chain
-        pass
+    def get_state(self, key: str) -> ThrottleState:
+        state = self.states.get(key)
+        if state is None:
+            state = ThrottleState(self.start_concurrency, self.start_delay)
+            self.states[key] = state
+        return state
 
-    def spider_opened(self, spider):
-        spider.logger.info("Spider opened: %s" % spider.name)
+    def get_retry_after(self, response) -> float:
+        value = response.headers.get(b"Retry-After")
+        if value is None:
+            return 0.0
+        try:
+            return float(value)
+        except ValueError:
+            # An HTTP date, the doubled delay is used instead
+            return 0.0
+
+    def on_success(self, key: str, state: ThrottleState, latency: float | None) -> None:
+        if latency is not None:
+            if state.latency:
+                state.latency += self.latency_smoothing * (latency - state.latency)
+            else:
+                state.latency = latency
+
+        state.successes += 1
+        # One window is as many responses as there are requests in flight
+        if state.successes < state.concurrency:
+            return
+        state.successes = 0
+
+        if state.latency > self.target_latency:
+            state.concurrency = max(state.concurrency - 1, 1)
+        elif state.delay > 0:
+            delay = state.delay * self.delay_decay
+            state.delay = delay if delay >= self.min_delay else 0
+        elif state.concurrency < self.max_concurrency:
+            state.concurrency += 1
+        else:
+            return
+
+        self.logger.debug(
+            f"Slot {key}: concurrency {state.concurrency}, delay {state.delay:.2f}s, "
+            f"latency {state.latency:.2f}s"
+        )
+        self.apply(key, state)
+
+    def back_off(self, key: str, state: ThrottleState, retry_after: float = 0) -> None:
+        now = time.monotonic()
+        # Responses already in flight report the same overload, the slot is
+        # only slowed down once per round trip
+        if now - state.decreased_at < max(state.latency, state.delay, 1):
+            return
+        state.decreased_at = now
+        state.successes = 0
+
+        state.concurrency = max(state.concurrency // 2, 1)
+        state.delay = min(
+            max(state.delay * 2, self.backoff_delay, retry_after), self.max_delay
+        )
+        self.logger.info(
+            f"Slot {key} throttled: concurrency {state.concurrency}, "
+            f"delay {state.delay:.2f}s"
+        )
+        self.apply(key, state)
+
+    def apply(self, key: str, state: ThrottleState) -> None:
+        downloader = self.crawler.engine.downloader
+        # Slots idle for a while are garbage collected, a recreated slot
+        # starts from the per-slot settings
+        downloader.per_slot_settings[key] = {
+            **downloader.per_slot_settings.get(key, {}),
+            "concurrency": state.concurrency,
+            "delay": state.delay,
+        }
+        slot = downloader.slots.get(key)
+        if slot is not None:
+            slot.concurrency = state.concurrency
+            slot.delay = state.delay
+
+        self.stats.set_value(f"adaptive_throttle/{key}/concurrency", state.concurrency)
+        self.stats.set_value(f"adaptive_throttle/{key}/delay", state.delay)
+
+    def requeue(self, request, response, key: str):
+        retries = request.meta.get("throttle_retries", 0)
+        if retries >= self.max_retries:
+            self.stats.inc_value(f"adaptive_throttle/{key}/gave_up")
+            self.logger.warning(
+                f"Gave up on {request.url} throttled {retries + 1} times "
+                f"(status {response.status})"
+            )
+            return response
+
+        self.stats.inc_value(f"adaptive_throttle/{key}/requeued")
+        retry_request = request.replace(dont_filter=True)
+        retry_request.meta["throttle_retries"] = retries + 1
+        return retry_request
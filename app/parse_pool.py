@@ -0,0 +1,96 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict
+from typing import Any
+
+from scrapy import Spider
+from scrapy.http import HtmlResponse, TextResponse
+from scrapy.utils.log import configure_logging
+
+from app import metrics
+from app.items import CarItem
+
+# Counters incremented while extracting a page, counted in the worker and
+# added to the crawler's registry with the result
+WORKER_COUNTERS = (metrics.FIELD_FAILURES, metrics.DETAIL_PAGE_TREES)
+# Settings the workers log with, into the same file as the crawler
+LOG_SETTINGS = (
+    "LOG_ENABLED",
+    "LOG_LEVEL",
+    "LOG_FILE",
+    "LOG_ENCODING",
+    "LOG_FORMAT",
+    "LOG_DATEFORMAT",
+)
+
+# The spider instance of a worker process, its methods do the extraction
+worker_spider: Spider | None = None
+
+
+def init_worker(
+    spidercls: type[Spider], spider_kwargs: dict[str, Any], log_settings: dict
+) -> None:
+    global worker_spider
+    configure_logging({**log_settings, "LOG_FILE_APPEND": True})
+    worker_spider = spidercls(**spider_kwargs)
+
+
+def extract_car(
+    url: str, body: bytes, encoding: str
+) -> tuple[dict[str, Any], list[tuple[int, dict[str, str], float]]]:
+    response = HtmlResponse(url, body=body, encoding=encoding)
+    extracted = worker_spider.extract_car(response)
+    # Sent back as a plain dict, the CarItem is rebuilt on the reactor side
+    extracted["car"] = asdict(extracted["car"])
+
+    # By the index of the counter in WORKER_COUNTERS
+    counts = []
+    for index, counter in enumerate(WORKER_COUNTERS):
+        for family in counter.collect():
+            counts.extend(
+                (index, sample.labels, sample.value)
+                for sample in family.samples
+                if sample.name.endswith("_total") and sample.value
+            )
+        counter.clear()
+    return extracted, counts
+
+
+class ParsePool:
+    """Detail pages extracted by worker processes, off the reactor thread.
+
+    Every worker builds its own instance of the spider class with
+    spider_kwargs and runs extract_car on the raw body; the reactor only
+    pickles the body over and the plain dict back.
+    """
+
+    def __init__(
+        self,
+        spider: Spider,
+        workers: int,
+        spider_kwargs: dict[str, Any] | None = None,
+    ) -> None:
+        log_settings = {name: spider.settings[name] for name in LOG_SETTINGS}
+        # "spawn" keeps the reactor, its threads and pooled connections out
+        # of the workers
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker,
+            initargs=(type(spider), spider_kwargs or {}, log_settings),
+        )
+
+    async def extract_car(self, response: TextResponse) -> dict[str, Any]:
+        extracted, counts = await asyncio.wrap_future(
+            self.executor.submit(
+                extract_car, response.url, response.body, response.encoding
+            )
+        )
+        for index, labels, value in counts:
+            WORKER_COUNTERS[index].labels(**labels).inc(value)
+        extracted["car"] = CarItem(**extracted["car"])
+        return extracted
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
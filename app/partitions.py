@@ -0,0 +1,70 @@
+from dataclasses import dataclass, field
+from typing import Any
+from urllib.parse import urlencode
+
+# SERP query parameters bounding a partition's USD price band
+PRICE_FROM = "price.USD.gte"
+PRICE_TO = "price.USD.lte"
+
+
+def partition_key(filters: dict[str, Any]) -> str:
+    return urlencode(sorted(filters.items()))
+
+
+@dataclass
+class SerpPartition:
+    """A slice of the SERP search space paginated on its own.
+
+    filters are the query parameters of the search, {} is the unfiltered
+    listing. A partition whose pagination reaches the page cap is replaced by
+    two partitions halving its price band, so no listing is left behind the
+    last reachable page.
+    """
+
+    filters: dict[str, Any]
+    next_page: int = 1
+    last_page: int | None = None
+    done_pages: set[int] = field(default_factory=set)
+
+    @property
+    def key(self) -> str:
+        return partition_key(self.filters)
+
+    def take_page(self, start_page: int) -> int | None:
+        """Next page to request, None while the first page is in flight or
+        once every page was released."""
+        if self.last_page is None:
+            if self.next_page != start_page:
+                return None
+            self.next_page += 1
+            return start_page
+
+        while self.next_page <= self.last_page:
+            page_number = self.next_page
+            self.next_page += 1
+            if page_number not in self.done_pages:
+                return page_number
+        return None
+
+    def split(self, max_price: int, start_page: int) -> list["SerpPartition"]:
+        """The two halves of the price band, [] when it cannot be narrowed."""
+        price_from = int(self.filters.get(PRICE_FROM, 0))
+        price_to = self.filters.get(PRICE_TO)
+        if price_to is None:
+            # The open-ended band is cut at max_price first, few listings
+            # cost more
+            middle = max(max_price, price_from * 2)
+        else:
+            price_to = int(price_to)
+            if price_from >= price_to:
+                return []
+            middle = (price_from + price_to) // 2
+
+        lower = {**self.filters, PRICE_FROM: price_from, PRICE_TO: middle}
+        upper = {**self.filters, PRICE_FROM: middle + 1}
+        if price_to is not None:
+            upper[PRICE_TO] = price_to
+        return [
+            SerpPartition(lower, next_page=start_page),
+            SerpPartition(upper, next_page=start_page),
+        ]
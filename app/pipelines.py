@@ -1,47 +1,416 @@
-from logging import Logger, getLogger
+import time
+from collections import Counter
+from datetime import date
+from logging import getLogger
+from typing import Any
+
+from itemadapter import ItemAdapter
+from scrapy.signalmanager import SignalManager
+from scrapy.statscollectors import StatsCollector
+from sqlalchemy import Engine, case, func, or_, select, update
+from sqlalchemy.exc import DataError, IntegrityError
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.dialects.postgresql import insert
+from twisted.internet import defer, task, threads
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
 
-from app.database.models import Car
-from app.items import CarItem
+from app import metrics
+from app.signals import cars_saved, phone_fetched
+from app.database.models import Car, CarPriceHistory
+from app.database.partitions import create_month_partitions
+from app.items import CAR_ITEM_FIELDS, CarItem
 from app.utils import get_engine
 
 
 class CarDBPipeline:
-    def __init__(self, db_url: str, log_level: str = "INFO") -> None:
-        self.engine = get_engine(db_url)
+    # Postgres caps a single statement at 65535 bind parameters, every row
+    # binds its fields, phone_fetched_at and its url once more for the
+    # previous prices
+    max_rows_per_statement: int = 65535 // (len(CAR_ITEM_FIELDS) + 2)
+    # Columns overwritten by a re-crawl, updated_at only moves when one changes
+    tracked_columns: tuple[str, ...] = (
+        "title",
+        "price_usd",
+        "odometer",
+        "username",
+        "image_url",
+        "images_count",
+        "car_number",
+        "car_vin",
+        "phone_number",
+    )
+    # Months of car_price_history partitions kept ready from the current one
+    partition_months: int = 3
+    # Seconds between checks for the partitions of a month just begun, a crawl
+    # running for longer than partition_months still never writes into the
+    # DEFAULT partition
+    partition_interval: float = 3600
+
+    def __init__(
+        self,
+        engine: Engine,
+        log_level: str = "INFO",
+        batch_size: int = 1,
+        batch_interval: float = 0,
+        writer_threads: int = 1,
+        writer_max_pending: int = 2,
+        stats: StatsCollector | None = None,
+        signals: SignalManager | None = None,
+    ) -> None:
+        self.engine = engine
         self.session = sessionmaker(self.engine)
         self.logger = getLogger(self.__class__.__name__)
         self.logger.setLevel(log_level)
+        self.stats = stats
+        self.signals = signals
+
+        self.batch_size = max(batch_size, 1)
+        self.batch_interval = batch_interval
+        # Keyed by url so that a listing seen twice within one batch is
+        # collapsed into a single row, otherwise ON CONFLICT would fail with
+        # "command cannot affect row a second time"
+        self.buffer: dict[str, CarItem] = {}
+        # Urls of cars whose phone_number was just fetched, see phone_fetched
+        self.fetched_phones: set[str] = set()
+        self.last_flush_at = time.monotonic()
+        self.flush_task: task.LoopingCall | None = None
+        self.partition_task: task.LoopingCall | None = None
+
+        # Writes run on a dedicated thread pool so a slow commit never blocks
+        # the reactor. The semaphore bounds the number of flushes queued or
+        # running; once it is exhausted process_item stops returning
+        # immediately, which pushes back on the scraper
+        self.writer_pool = ThreadPool(
+            minthreads=1,
+            maxthreads=max(writer_threads, 1),
+            name=self.__class__.__name__,
+        )
+        self.writer_slots = defer.DeferredSemaphore(max(writer_max_pending, 1))
+        self.pending_flushes: set[defer.Deferred] = set()
 
     @classmethod
     def from_crawler(cls, crawler):
-        return cls(
-            db_url=crawler.settings.get("DB_URL"),
+        pipeline = cls(
+            engine=get_engine(crawler.settings, "crawler"),
             log_level=crawler.settings.get("LOG_LEVEL"),
+            batch_size=crawler.settings.getint("DB_BATCH_SIZE", 1),
+            batch_interval=crawler.settings.getfloat("DB_BATCH_INTERVAL", 0),
+            writer_threads=crawler.settings.getint("DB_WRITER_THREADS", 1),
+            writer_max_pending=crawler.settings.getint("DB_WRITER_MAX_PENDING", 2),
+            stats=crawler.stats,
+            signals=crawler.signals,
         )
+        crawler.signals.connect(pipeline.phone_fetched, signal=phone_fetched)
+        return pipeline
 
-    def process_item(self, item, spider) -> CarItem:
-        with self.session() as session:
-            car_dict = dict(item)
-
-            insert_stmt = insert(Car).values(car_dict)
-            upsert_stmt = insert_stmt.on_conflict_do_update(
-                index_elements=[Car.url],
-                set_={
-                    "title": insert_stmt.excluded.title,
-                    "price_usd": insert_stmt.excluded.price_usd,
-                    "odometer": insert_stmt.excluded.odometer,
-                    "username": insert_stmt.excluded.username,
-                    "image_url": insert_stmt.excluded.image_url,
-                    "images_count": insert_stmt.excluded.images_count,
-                    "car_number": insert_stmt.excluded.car_number,
-                    "car_vin": insert_stmt.excluded.car_vin,
-                    "phone_number": insert_stmt.excluded.phone_number,
-                },
+    def open_spider(self, spider) -> None:
+        # This month and the following ones, so a crawl running past the end
+        # of the month still writes to a monthly partition
+        self.create_partitions()
+
+        self.writer_pool.start()
+        self.partition_task = task.LoopingCall(self.create_partitions_later)
+        self.partition_task.start(self.partition_interval, now=False)
+        self.last_flush_at = time.monotonic()
+        if self.batch_size > 1 and self.batch_interval > 0:
+            self.flush_task = task.LoopingCall(self.flush_if_due)
+            self.flush_task.start(self.batch_interval, now=False)
+
+    @defer.inlineCallbacks
+    def close_spider(self, spider):
+        if self.flush_task is not None and self.flush_task.running:
+            self.flush_task.stop()
+        if self.partition_task is not None and self.partition_task.running:
+            self.partition_task.stop()
+
+        self.flush()
+        # Wait for every queued batch, not only the last one, before the
+        # writer threads are stopped
+        yield defer.DeferredList(list(self.pending_flushes))
+        self.writer_pool.stop()
+
+    def create_partitions(self) -> None:
+        with self.engine.begin() as connection:
+            create_month_partitions(
+                connection,
+                CarPriceHistory.__tablename__,
+                CarPriceHistory.recorded_at.name,
+                date.today(),
+                months=self.partition_months,
             )
-            session.execute(upsert_stmt)
-            session.commit()
-        self.logger.info(f"Saved to database {item['title']} {item['url']} ")
 
+    def create_partitions_later(self) -> defer.Deferred:
+        from twisted.internet import reactor
+
+        # On a writer thread, a partition is only missing once a month
+        created = threads.deferToThreadPool(
+            reactor, self.writer_pool, self.create_partitions
+        )
+        created.addErrback(self.on_partitions_failed)
+        return created
+
+    def on_partitions_failed(self, failure: Failure) -> None:
+        self.logger.error(
+            f"Could not create {CarPriceHistory.__tablename__} partitions: "
+            f"{failure.value}",
+            exc_info=(failure.type, failure.value, failure.getTracebackObject()),
+        )
+
+    def phone_fetched(self, url: str) -> None:
+        self.fetched_phones.add(url)
+
+    def process_item(self, item, spider) -> CarItem | defer.Deferred:
+        if isinstance(item, CarItem):
+            car = item
+        else:
+            adapter = ItemAdapter(item)
+            car = CarItem(**{field: adapter.get(field) for field in CAR_ITEM_FIELDS})
+        self.buffer[car.url] = car
+
+        if len(self.buffer) < self.batch_size:
+            self.flush_if_due()
+            return item
+
+        writers_busy = self.writer_slots.tokens == 0
+        flushed = self.flush()
+        if writers_busy:
+            flushed.addCallback(lambda _: item)
+            return flushed
         return item
+
+    def flush_if_due(self) -> defer.Deferred | None:
+        if (
+            self.batch_interval > 0
+            and time.monotonic() - self.last_flush_at >= self.batch_interval
+        ):
+            return self.flush()
+        return None
+
+    def flush(self) -> defer.Deferred:
+        from twisted.internet import reactor
+
+        self.last_flush_at = time.monotonic()
+        if not self.buffer:
+            return defer.succeed(None)
+
+        cars = list(self.buffer.values())
+        self.buffer = {}
+        fetched = {car.url for car in cars if car.url in self.fetched_phones}
+        self.fetched_phones -= fetched
+
+        flushed = self.writer_slots.run(
+            threads.deferToThreadPool,
+            reactor,
+            self.writer_pool,
+            self.write_batch,
+            cars,
+            fetched,
+        )
+        flushed.addCallbacks(
+            self.on_batch_written,
+            self.on_batch_failed,
+            callbackArgs=(cars,),
+            errbackArgs=(cars,),
+        )
+
+        self.pending_flushes.add(flushed)
+        flushed.addBoth(self.forget_flush, flushed)
+        return flushed
+
+    def forget_flush(self, result: Any, flushed: defer.Deferred) -> Any:
+        self.pending_flushes.discard(flushed)
+        return result
+
+    def write_batch(
+        self, cars: list[CarItem], fetched: set[str]
+    ) -> tuple[float, Counter[str], list[str]]:
+        started_at = time.perf_counter()
+        # Rows are only built here, on a writer thread. Every row of a
+        # multi-row VALUES clause must carry the same columns. Sorted by url,
+        # so concurrent writers lock overlapping cars in the same order and
+        # cannot deadlock; ON CONFLICT locks a row even when its WHERE skips
+        # it, the UPDATE of unchanged cars only touches rows already locked
+        rows = [
+            self.build_row(car, car.url in fetched)
+            for car in sorted(cars, key=lambda car: car.url)
+        ]
+        try:
+            outcomes = self.upsert_cars(rows)
+            failed = []
+        except (IntegrityError, DataError) as e:
+            # A single car breaking a constraint rolls the whole statement
+            # back, only that car is lost when they are written one by one
+            self.logger.warning(
+                f"Could not save {len(rows)} cars in one batch ({e.orig}), "
+                f"saving them one by one"
+            )
+            outcomes, failed = self.upsert_one_by_one(rows)
+        return time.perf_counter() - started_at, outcomes, failed
+
+    def upsert_one_by_one(
+        self, rows: list[dict[str, Any]]
+    ) -> tuple[Counter[str], list[str]]:
+        outcomes: Counter[str] = Counter(inserted=0, changed=0, unchanged=0)
+        failed = []
+        for row in rows:
+            try:
+                outcomes.update(self.upsert_cars([row]))
+            except (IntegrityError, DataError) as e:
+                self.logger.error(f"Could not save {row['url']} to database: {e.orig}")
+                failed.append(row["url"])
+        return outcomes, failed
+
+    def build_row(self, car: CarItem, phone_fetched: bool) -> dict[str, Any]:
+        row = {field: getattr(car, field) for field in CAR_ITEM_FIELDS}
+        # The database clock, like last_seen_at and the phone cache expiry
+        row["phone_fetched_at"] = func.localtimestamp() if phone_fetched else None
+        return row
+
+    def on_batch_written(
+        self, result: tuple[float, Counter[str], list[str]], cars: list[CarItem]
+    ) -> None:
+        elapsed, outcomes, failed = result
+        if failed:
+            failed_urls = set(failed)
+            cars = [car for car in cars if car.url not in failed_urls]
+            metrics.DB_FLUSH_ROWS.labels("failed").inc(len(failed))
+            if self.stats is not None:
+                self.stats.inc_value("db/rows_failed", len(failed))
+
+        rows_per_second = len(cars) / elapsed if elapsed else float("inf")
+        metrics.DB_FLUSH_SECONDS.observe(elapsed)
+        for outcome, count in outcomes.items():
+            metrics.DB_FLUSH_ROWS.labels(outcome).inc(count)
+        if self.stats is not None:
+            self.stats.inc_value("db/flushes")
+            self.stats.inc_value("db/rows_written", len(cars))
+            for outcome, count in outcomes.items():
+                self.stats.inc_value(f"db/rows_{outcome}", count)
+            self.stats.inc_value("db/flush_time", elapsed)
+        if self.signals is not None and cars:
+            self.signals.send_catch_log(
+                cars_saved, urls=[car.url for car in cars]
+            )
+
+        if len(cars) == 1:
+            self.logger.info(
+                f"Saved to database {cars[0].title} {cars[0].url} "
+                f"({rows_per_second:.1f} rows/s)"
+            )
+        elif cars:
+            self.logger.info(
+                f"Saved to database {len(cars)} cars in {elapsed:.3f}s "
+                f"({outcomes['inserted']} new, {outcomes['changed']} changed, "
+                f"{outcomes['unchanged']} unchanged, {len(failed)} failed, "
+                f"{rows_per_second:.1f} rows/s)"
+            )
+
+    def on_batch_failed(self, failure: Failure, cars: list[CarItem]) -> None:
+        metrics.DB_FLUSH_ROWS.labels("failed").inc(len(cars))
+        if self.stats is not None:
+            self.stats.inc_value("db/flush_errors")
+            self.stats.inc_value("db/rows_failed", len(cars))
+
+        self.logger.error(
+            f"Could not save {len(cars)} cars to database: {failure.value}",
+            exc_info=(failure.type, failure.value, failure.getTracebackObject()),
+        )
+
+    def upsert_cars(self, cars: list[dict[str, Any]]) -> Counter[str]:
+        outcomes: Counter[str] = Counter(inserted=0, changed=0, unchanged=0)
+        with self.session() as session:
+            for offset in range(0, len(cars), self.max_rows_per_statement):
+                chunk = cars[offset : offset + self.max_rows_per_statement]
+                written = session.execute(
+                    self.with_price_history(self.build_upsert(chunk), chunk)
+                ).all()
+
+                # Rows the upsert left alone are not returned, they are only
+                # marked as seen, with one statement for the whole chunk
+                written_urls = {row.url for row in written}
+                unchanged = [
+                    car["url"] for car in chunk if car["url"] not in written_urls
+                ]
+                if unchanged:
+                    session.execute(
+                        update(Car)
+                        .where(Car.url.in_(unchanged))
+                        .values(last_seen_at=func.now())
+                    )
+
+                inserted = sum(row.inserted for row in written)
+                outcomes["inserted"] += inserted
+                outcomes["changed"] += len(written) - inserted
+                outcomes["unchanged"] += len(unchanged)
+            session.commit()
+        return outcomes
+
+    def build_upsert(self, cars: list[dict[str, Any]]):
+        """Insert new cars and update those whose tracked columns changed.
+
+        A conflicting row that is the same as stored is not updated at all:
+        an update writes a new row version, and its indexes, even when no
+        value changes, and a re-crawl finds most cars unchanged. A phone
+        fetched again only moves phone_fetched_at, not updated_at.
+        """
+        insert_stmt = insert(Car).values(cars)
+        changed = or_(
+            *[
+                Car.__table__.c[column].is_distinct_from(insert_stmt.excluded[column])
+                for column in self.tracked_columns
+            ]
+        )
+
+        # A phone fetched again, once the cache expired it, restarts its TTL
+        # even when the number is the same
+        phone_fetched = insert_stmt.excluded.phone_fetched_at.is_not(None)
+
+        set_ = {column: insert_stmt.excluded[column] for column in self.tracked_columns}
+        set_["updated_at"] = case((changed, func.now()), else_=Car.updated_at)
+        set_["last_seen_at"] = func.now()
+        set_["phone_fetched_at"] = func.coalesce(
+            insert_stmt.excluded.phone_fetched_at, Car.phone_fetched_at
+        )
+
+        return insert_stmt.on_conflict_do_update(
+            index_elements=[Car.url], set_=set_, where=or_(changed, phone_fetched)
+        ).returning(Car.id, Car.url, Car.price_usd, Car.odometer)
+
+    def with_price_history(self, upsert, cars: list[dict[str, Any]]):
+        """Append the new and changed prices of the upsert to the price history.
+
+        Both run as one statement returning the url of every row the upsert
+        wrote and whether it was inserted. The upsert is a data-modifying CTE
+        and every CTE of a statement sees the same snapshot, so previous still
+        holds the rows from before the upsert.
+        """
+        previous = (
+            select(Car.url, Car.price_usd)
+            .where(Car.url.in_([car["url"] for car in cars]))
+            .cte("previous")
+        )
+        upserted = upsert.cte("upserted")
+        written = upserted.outerjoin(previous, previous.c.url == upserted.c.url)
+        changed = (
+            select(upserted.c.id, upserted.c.price_usd, upserted.c.odometer)
+            .select_from(written)
+            .where(
+                or_(
+                    previous.c.url.is_(None),
+                    previous.c.price_usd.is_distinct_from(upserted.c.price_usd),
+                )
+            )
+        )
+        history = (
+            insert(CarPriceHistory)
+            .from_select(["car_id", "price_usd", "odometer"], changed)
+            .cte("history")
+        )
+        # Data-modifying CTEs are only allowed at the top level, and run
+        # whether or not the statement reads them
+        return (
+            select(upserted.c.url, previous.c.url.is_(None).label("inserted"))
+            .select_from(written)
+            .add_cte(previous, upserted, history)
+        )
@@ -21,6 +21,42 @@ CONCURRENT_REQUESTS = int(os.getenv("CONCURRENT_REQUESTS", "16"))
 # The download delay setting will honor only one of:
 CONCURRENT_REQUESTS_PER_DOMAIN = int(os.getenv("CONCURRENT_REQUESTS_PER_DOMAIN", "8"))
 
+# SERP pages in flight at once; further pages are only released while fewer
+# than SERP_RELEASE_THRESHOLD detail/phone requests wait in the scheduler
+SERP_WINDOW = int(os.getenv("SERP_WINDOW", "4"))
+SERP_RELEASE_THRESHOLD = int(os.getenv("SERP_RELEASE_THRESHOLD", "100"))
+# Deepest SERP page the site serves; a search with that many pages is split
+# into price bands until every band fits (0 never splits)
+SERP_PAGE_CAP = int(os.getenv("SERP_PAGE_CAP", "100"))
+# Look detail page fields up in the raw response text, parsing the page into a
+# tree only for fields the text scan cannot settle
+DETAIL_PAGE_SCAN = os.getenv("DETAIL_PAGE_SCAN", "True")
+# Worker processes detail pages are extracted in, leaving the reactor thread to
+# I/O and scheduling (0 extracts on the reactor thread)
+DETAIL_PARSE_WORKERS = int(os.getenv("DETAIL_PARSE_WORKERS", "0"))
+
+# Tune concurrency and delay of the SERP, detail and phone download slots from
+# their latency and throttling responses, starting from
+# CONCURRENT_REQUESTS_PER_DOMAIN and DOWNLOAD_DELAY. Off by default, it sets
+# the Scrapy downloader slots directly
+ADAPTIVE_THROTTLE_ENABLED = os.getenv("ADAPTIVE_THROTTLE_ENABLED", "False")
+ADAPTIVE_THROTTLE_MAX_CONCURRENCY = int(
+    os.getenv("ADAPTIVE_THROTTLE_MAX_CONCURRENCY", str(CONCURRENT_REQUESTS))
+)
+# Average download latency in seconds above which a slot sheds concurrency
+ADAPTIVE_THROTTLE_TARGET_LATENCY = float(
+    os.getenv("ADAPTIVE_THROTTLE_TARGET_LATENCY", "2")
+)
+# Delay in seconds a throttled slot backs off to at least, doubled on every
+# further throttling response up to ADAPTIVE_THROTTLE_MAX_DELAY
+ADAPTIVE_THROTTLE_BACKOFF_DELAY = float(
+    os.getenv("ADAPTIVE_THROTTLE_BACKOFF_DELAY", "1")
+)
+ADAPTIVE_THROTTLE_MAX_DELAY = float(os.getenv("ADAPTIVE_THROTTLE_MAX_DELAY", "60"))
+# Responses treated as rate limiting, their requests are rescheduled
+ADAPTIVE_THROTTLE_HTTP_CODES = [429, 403]
+ADAPTIVE_THROTTLE_MAX_RETRIES = int(os.getenv("ADAPTIVE_THROTTLE_MAX_RETRIES", "5"))
+
 # Disable cookies (enabled by default)
 # COOKIES_ENABLED = False
 
@@ -34,19 +70,59 @@ CONCURRENT_REQUESTS_PER_DOMAIN = int(os.getenv("CONCURRENT_REQUESTS_PER_DOMAIN",
 # }
 
 # Enable or disable spider middlewares
-# SPIDER_MIDDLEWARES = {
-#    "src.middlewares.SrcSpiderMiddleware": 543,
-# }
+SPIDER_MIDDLEWARES = {
+    # Closest to the spider, so only the callbacks themselves are timed
+    "app.middlewares.SrcSpiderMiddleware": 950,
+    # Sees the exceptions of HttpErrorMiddleware (50), only with the frontier
+    "app.middlewares.ListingSpiderMiddleware": 900,
+}
+
+# Share SERP pages and listings with other workers through the
+# frontier_requests table instead of the in-memory scheduler. Workers of one
+# crawl use the same FRONTIER_CRAWL (default: today's date)
+FRONTIER_ENABLED = os.getenv("FRONTIER_ENABLED", "False")
+FRONTIER_CRAWL = os.getenv("FRONTIER_CRAWL", "")
+# Requests a worker claims at once
+FRONTIER_BATCH_SIZE = int(os.getenv("FRONTIER_BATCH_SIZE", "64"))
+# Seconds a claim is held without renewal before other workers reclaim it
+FRONTIER_LEASE_TTL = float(os.getenv("FRONTIER_LEASE_TTL", "300"))
+# Claims of a request before it is given up on
+FRONTIER_MAX_ATTEMPTS = int(os.getenv("FRONTIER_MAX_ATTEMPTS", "10"))
+# Seconds between looks for new or expired requests once the frontier is empty
+FRONTIER_POLL_INTERVAL = float(os.getenv("FRONTIER_POLL_INTERVAL", "5"))
 
 # Enable or disable downloader middlewares
-# DOWNLOADER_MIDDLEWARES = {
-#    "src.middlewares.SrcDownloaderMiddleware": 543,
-# }
+DOWNLOADER_MIDDLEWARES = {
+    # Sees throttling responses before RetryMiddleware (550) does
+    "app.middlewares.AdaptiveThrottleMiddleware": 560,
+}
 
 # Enable or disable extensions
-# EXTENSIONS = {
-#    "scrapy.extensions.telnet.TelnetConsole": None,
-# }
+EXTENSIONS = {
+    "app.metrics.MetricsExporter": 500,
+    "app.profiling.SamplingProfiler": 500,
+}
+
+# Expose callback latency, field extraction failures, queue depth and DB flush
+# latency in the Prometheus text format, over HTTP on METRICS_HOST:METRICS_PORT
+# (0 disables it) and/or written to METRICS_FILE every METRICS_INTERVAL seconds
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "False")
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_FILE = os.getenv("METRICS_FILE", "")
+METRICS_INTERVAL = float(os.getenv("METRICS_INTERVAL", "15"))
+
+# Sample the reactor thread's stack every PROFILING_INTERVAL seconds into a
+# collapsed stack file under PROFILING_DIR (flamegraph.pl, speedscope), for
+# PROFILING_DURATION seconds after PROFILING_START_DELAY (0: the whole run).
+# Only PROFILING_RUN_RATE of the runs are profiled; `-a profiling=True`
+# profiles the run regardless
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "False")
+PROFILING_RUN_RATE = float(os.getenv("PROFILING_RUN_RATE", "1"))
+PROFILING_INTERVAL = float(os.getenv("PROFILING_INTERVAL", "0.01"))
+PROFILING_START_DELAY = float(os.getenv("PROFILING_START_DELAY", "0"))
+PROFILING_DURATION = float(os.getenv("PROFILING_DURATION", "0"))
+PROFILING_DIR = "logs"
 
 # Configure item pipelines
 # ITEM_PIPELINES = {
@@ -65,19 +141,27 @@ CONCURRENT_REQUESTS_PER_DOMAIN = int(os.getenv("CONCURRENT_REQUESTS_PER_DOMAIN",
 # Enable showing throttling stats for every response received:
 # AUTOTHROTTLE_DEBUG = False
 
-# Enable and configure HTTP caching (disabled by default)
-# HTTPCACHE_ENABLED = True
-# HTTPCACHE_EXPIRATION_SECS = 0
-# HTTPCACHE_DIR = "httpcache"
-# HTTPCACHE_IGNORE_HTTP_CODES = []
-# HTTPCACHE_STORAGE = "scrapy.extensions.httpcache.FilesystemCacheStorage"
+# Enable and configure HTTP caching (disabled by default). Detail pages are
+# kept compressed with their ETag/Last-Modified and every revisit is sent as a
+# conditional request, a 304 hands the stored page to parse_car
+HTTPCACHE_ENABLED = os.getenv("HTTPCACHE_ENABLED", "False")
+HTTPCACHE_POLICY = "app.httpcache.DetailPagePolicy"
+HTTPCACHE_STORAGE = "app.httpcache.CompressedCacheStorage"
+HTTPCACHE_DIR = "httpcache"
+HTTPCACHE_DOWNLOAD_SLOTS = ["detail"]
+# Seconds since a page was last stored or revalidated before it is evicted
+HTTPCACHE_EXPIRATION_SECS = int(os.getenv("HTTPCACHE_EXPIRATION_SECS", "1209600"))
+# Bytes of compressed bodies kept, least recently used pages are evicted first
+HTTPCACHE_MAX_SIZE = int(os.getenv("HTTPCACHE_MAX_SIZE", str(2 * 1024**3)))
 
 # Set settings whose default value is deprecated to a future-proof value
 REQUEST_FINGERPRINTER_IMPLEMENTATION = "2.7"
 TWISTED_REACTOR = "twisted.internet.asyncioreactor.AsyncioSelectorReactor"
 FEED_EXPORT_ENCODING = "utf-8"
 
-DB_DRIVER = "postgresql"
+# SQLAlchemy dialect and driver: postgresql (psycopg2) or postgresql+psycopg
+# (psycopg 3, which prepares repeated statements server side)
+DB_DRIVER = os.getenv("DB_DRIVER", "postgresql")
 DB_HOST = os.getenv("DB_HOST", "localhost")
 DB_PORT = int(os.getenv("DB_PORT", 5432))
 DB_USER = os.getenv("DB_USER", "postgres")
@@ -86,6 +170,67 @@ DB_DATABASE = os.getenv("DB_DATABASE", "db_name")
 
 DB_URL = f"{DB_DRIVER}://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_DATABASE}"
 
+# Connection pool of the engines of each role, see app.utils.get_engine:
+# connections kept open (0 opens one per checkout), extra connections opened
+# under load, seconds a checkout waits for a free connection, seconds before a
+# connection is replaced, and executions of a statement on a connection before
+# psycopg 3 prepares it server side (None never prepares, e.g. behind
+# pgbouncer in transaction mode)
+DB_ENGINE_PROFILES = {
+    # CarDBPipeline writer threads, the frontier scheduler and the listing caches
+    "crawler": {
+        "pool_size": int(os.getenv("DB_CRAWLER_POOL_SIZE", "4")),
+        "max_overflow": int(os.getenv("DB_CRAWLER_MAX_OVERFLOW", "2")),
+        "pool_timeout": float(os.getenv("DB_CRAWLER_POOL_TIMEOUT", "30")),
+        "pool_recycle": 1800,
+        "prepare_threshold": 5,
+    },
+    # Every exporter process reads its shard through a single connection
+    "exporter": {
+        "pool_size": 1,
+        "max_overflow": 0,
+        "pool_timeout": 30,
+        "pool_recycle": -1,
+        "prepare_threshold": 2,
+    },
+    # Alembic runs its migrations on one connection
+    "migrations": {
+        "pool_size": 0,
+        "prepare_threshold": None,
+    },
+}
+# Test pooled connections with a round trip before handing them out, so a
+# connection dropped by the server is replaced instead of failing a write
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "True")
+
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
 
+# Seconds a stored listing is not re-fetched while its SERP price is unchanged
+# (0 fetches every listing on every run)
+REVISIT_TTL = float(os.getenv("REVISIT_TTL", "0"))
+# Seconds a stored phone number is reused instead of calling /users/phones/
+# (0 disables the cache)
+PHONE_CACHE_TTL = float(os.getenv("PHONE_CACHE_TTL", "0"))
+
+# sqlite file autoria_serp_spider keeps its progress in, so a crawl restarted
+# by pm2 resumes where it stopped (empty disables checkpoints)
+CHECKPOINT_FILE = os.getenv("CHECKPOINT_FILE", "")
+# Seconds between checkpoint writes, a killed crawl fetches the SERP pages
+# parsed since the last one again
+CHECKPOINT_FLUSH_INTERVAL = float(os.getenv("CHECKPOINT_FLUSH_INTERVAL", "1"))
+
 EXPORT_DIR = "dumps"
+# Watermark of the last successful export, used by `exporter --delta`
+EXPORT_STATE_FILE = os.path.join(EXPORT_DIR, "export_state.json")
+# Seconds the delta window overlaps the previous one to catch late commits
+EXPORT_DELTA_OVERLAP = float(os.getenv("EXPORT_DELTA_OVERLAP", "60"))
+
+# Number of cars CarDBPipeline buffers before writing them with one bulk upsert
+# (1 writes every car as soon as it is scraped)
+DB_BATCH_SIZE = int(os.getenv("DB_BATCH_SIZE", "1"))
+# Maximum number of seconds a buffered car waits before the batch is flushed
+DB_BATCH_INTERVAL = float(os.getenv("DB_BATCH_INTERVAL", "5"))
+# Threads CarDBPipeline writes batches from, keeping commits off the reactor
+DB_WRITER_THREADS = int(os.getenv("DB_WRITER_THREADS", "2"))
+# Batches that may be queued or running before the pipeline applies backpressure
+DB_WRITER_MAX_PENDING = int(os.getenv("DB_WRITER_MAX_PENDING", "4"))
@@ -0,0 +1,13 @@
+# Sent by CarDBPipeline once a batch of cars is committed, with the urls of
+# the cars in it as the urls argument
+cars_saved = object()
+
+# Sent by the spider when a phone number was fetched from /users/phones/
+# while the phone cache is on, with the listing url as the url argument;
+# CarDBPipeline stamps phone_fetched_at of the car so the cache expires it
+phone_fetched = object()
+
+# Sent by ListingSpiderMiddleware when the callback of a listing request ends
+# without a car or a further request of the listing, e.g. a page that is gone
+# or failed to parse, with the listing url as the url argument
+listing_dropped = object()
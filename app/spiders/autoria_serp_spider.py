@@ -1,14 +1,24 @@
 import json
-import re
 import sys
 from typing import Any, Callable, Generator
 
-from scrapy import Spider, Request
+from scrapy import Spider, Request, signals
+from scrapy.exceptions import DontCloseSpider
 from scrapy.http import TextResponse
+from twisted.internet import task
+from twisted.python.failure import Failure
 from furl import furl
 
+from app import extractors
+from app.checkpoints import CrawlCheckpoint
+from app.extractors import CarPage, ScannedCarPage
 from app.items import CarItem
+from app.known_listings import KnownListingsIndex, PhoneNumberCache
+from app.parse_pool import ParsePool
+from app.partitions import SerpPartition, partition_key
 from app.pipelines import CarDBPipeline
+from app.signals import cars_saved, phone_fetched
+from app.utils import get_engine
 
 
 class AutoriaSerpSpider(Spider):
@@ -17,33 +27,377 @@ class AutoriaSerpSpider(Spider):
     base_url: str = "https://auto.ria.com/uk/car/used/"
     mobile_phone_base_url: str = "https://auto.ria.com/users/phones/"
     start_page: int = 1
+    # Seconds a stored listing is not re-fetched while its SERP price is
+    # unchanged, overrides the REVISIT_TTL setting
+    revisit_ttl: float | str | None = None
+    known_listings: KnownListingsIndex = KnownListingsIndex()
+    # Seconds a stored phone number is reused instead of calling
+    # /users/phones/, overrides the PHONE_CACHE_TTL setting
+    phone_cache_ttl: float | str | None = None
+    phone_number_cache: PhoneNumberCache = PhoneNumberCache()
+    # sqlite file the crawl progress is kept in so a restarted crawl resumes,
+    # overrides the CHECKPOINT_FILE setting
+    checkpoint_file: str | None = None
+    checkpoint: CrawlCheckpoint | None = None
+    checkpoint_task: task.LoopingCall | None = None
+    # JSON list of SERP query parameter sets crawled as separate partitions,
+    # e.g. [{"brand.id[0]": 9}, {"price.USD.gte": 0, "price.USD.lte": 5000}]
+    serp_filters: str | list[dict[str, Any]] | None = None
+    serp_partitions: dict[str, SerpPartition]
+    # Profiles this run with SamplingProfiler, overrides the PROFILING_ENABLED
+    # setting and PROFILING_RUN_RATE
+    profiling: bool | str | None = None
+
+    # Listings already found are finished before more SERP pages are fetched
+    serp_priority: int = 0
+    car_priority: int = 10
+    phone_number_priority: int = 20
+    # Slots of SERP, detail and phone requests, in meta["request_slot"] for
+    # the HTTP cache. They are only downloaded in separate download slots
+    # when AdaptiveThrottleMiddleware tunes them, each slot gets its own
+    # CONCURRENT_REQUESTS_PER_DOMAIN and DOWNLOAD_DELAY
+    serp_download_slot: str = "serp"
+    car_download_slot: str = "detail"
+    phone_number_download_slot: str = "phones"
+    split_download_slots: bool = False
+    # SERP pages are released in a sliding window: at most serp_window pages
+    # are in flight, and the window only moves while fewer than
+    # serp_release_threshold detail/phone requests wait in the scheduler
+    serp_window: int = 4
+    serp_release_threshold: int = 100
+    serp_pages_in_flight: int = 0
+    pending_listing_requests: int = 0
+    # A partition with serp_page_cap pages or more is split by price, the
+    # listings past the last page the site serves are out of reach otherwise
+    # (0 never splits)
+    serp_page_cap: int = 0
+    # Upper price bound of the first band cut from an open-ended search
+    serp_max_price: int = 100_000
+    # Detail page fields are looked up in the raw text before parsing the page
+    detail_page_scan: bool = True
+    # Worker processes detail pages are extracted in, off the reactor thread,
+    # overrides the DETAIL_PARSE_WORKERS setting (0 extracts on the reactor)
+    detail_parse_workers: int | str | None = None
+    parse_pool: ParsePool | None = None
 
     custom_settings: dict[str, Any] = {"ITEM_PIPELINES": {CarDBPipeline: 300}}
 
+    @classmethod
+    def update_settings(cls, settings):
+        super().update_settings(settings)
+        if settings.getbool("FRONTIER_ENABLED"):
+            settings.set("SCHEDULER", "app.frontier.FrontierScheduler", "spider")
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        if spider.profiling is not None:
+            crawler.settings.set("PROFILING_ENABLED", spider.profiling, "spider")
+            crawler.settings.set("PROFILING_RUN_RATE", 1, "spider")
+        frontier_enabled = crawler.settings.getbool("FRONTIER_ENABLED")
+        if frontier_enabled:
+            # Pending requests wait in Postgres instead of memory, and only
+            # the worker that parsed the first page could release the rest
+            spider.serp_window = spider.serp_release_threshold = sys.maxsize
+        else:
+            spider.serp_window = crawler.settings.getint(
+                "SERP_WINDOW", spider.serp_window
+            )
+            spider.serp_release_threshold = crawler.settings.getint(
+                "SERP_RELEASE_THRESHOLD", spider.serp_release_threshold
+            )
+        spider.serp_page_cap = crawler.settings.getint(
+            "SERP_PAGE_CAP", spider.serp_page_cap
+        )
+        spider.split_download_slots = crawler.settings.getbool(
+            "ADAPTIVE_THROTTLE_ENABLED"
+        )
+        spider.detail_page_scan = crawler.settings.getbool(
+            "DETAIL_PAGE_SCAN", spider.detail_page_scan
+        )
+        if spider.detail_parse_workers is not None:
+            detail_parse_workers = int(spider.detail_parse_workers)
+        else:
+            detail_parse_workers = crawler.settings.getint("DETAIL_PARSE_WORKERS")
+        if detail_parse_workers > 0:
+            spider.parse_pool = ParsePool(
+                spider,
+                detail_parse_workers,
+                spider_kwargs={"detail_page_scan": spider.detail_page_scan},
+            )
+        serp_filters = spider.serp_filters or [{}]
+        if isinstance(serp_filters, str):
+            serp_filters = json.loads(serp_filters)
+        spider.serp_partitions = {}
+        for filters in serp_filters:
+            spider.add_serp_partition(
+                SerpPartition(filters, next_page=spider.start_page)
+            )
+        crawler.signals.connect(spider.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(spider.spider_idle, signal=signals.spider_idle)
+        crawler.signals.connect(
+            spider.request_scheduled, signal=signals.request_scheduled
+        )
+        crawler.signals.connect(
+            spider.request_reached_downloader,
+            signal=signals.request_reached_downloader,
+        )
+        crawler.signals.connect(spider.request_dropped, signal=signals.request_dropped)
+
+        checkpoint_file = spider.checkpoint_file or crawler.settings.get(
+            "CHECKPOINT_FILE"
+        )
+        if checkpoint_file and frontier_enabled:
+            spider.logger.warning("Checkpoints are disabled, the frontier resumes")
+        elif checkpoint_file:
+            spider.checkpoint = CrawlCheckpoint(checkpoint_file)
+            crawler.signals.connect(spider.forget_saved_listings, signal=cars_saved)
+        return spider
+
+    def spider_opened(self, spider: Spider) -> None:
+        if self.checkpoint is not None:
+            self.checkpoint_task = task.LoopingCall(self.checkpoint.flush)
+            self.checkpoint_task.start(
+                self.settings.getfloat("CHECKPOINT_FLUSH_INTERVAL", 1), now=False
+            )
+
+        if self.revisit_ttl is not None:
+            revisit_ttl = float(self.revisit_ttl)
+        else:
+            revisit_ttl = self.settings.getfloat("REVISIT_TTL")
+
+        if self.phone_cache_ttl is not None:
+            phone_cache_ttl = float(self.phone_cache_ttl)
+        else:
+            phone_cache_ttl = self.settings.getfloat("PHONE_CACHE_TTL")
+
+        if revisit_ttl <= 0 and phone_cache_ttl <= 0:
+            return
+
+        engine = get_engine(self.settings, "crawler")
+
+        if revisit_ttl > 0:
+            self.known_listings = KnownListingsIndex.load(engine, revisit_ttl)
+            self.crawler.stats.set_value(
+                "known_listings/loaded", len(self.known_listings)
+            )
+            self.logger.info(
+                f"Loaded {len(self.known_listings)} listings seen "
+                f"in the last {revisit_ttl:.0f}s"
+            )
+
+        if phone_cache_ttl > 0:
+            self.phone_number_cache = PhoneNumberCache.load(engine, phone_cache_ttl)
+            self.crawler.stats.set_value(
+                "phone_cache/loaded", len(self.phone_number_cache)
+            )
+            self.logger.info(
+                f"Loaded {len(self.phone_number_cache)} cached phone numbers"
+            )
+
+        engine.dispose()
+
+    def closed(self, reason: str) -> None:
+        if self.parse_pool is not None:
+            self.parse_pool.close()
+
+        if self.checkpoint_task is not None and self.checkpoint_task.running:
+            self.checkpoint_task.stop()
+        if self.checkpoint is not None:
+            # Only a crawl that ran out of requests is complete, a shutdown
+            # or a memory limit keeps the progress for the next run
+            if reason == "finished":
+                self.checkpoint.clear()
+            self.checkpoint.close()
+
+        stats = self.crawler.stats
+        lookups = stats.get_value("phone_cache/hits", 0) + stats.get_value(
+            "phone_cache/misses", 0
+        )
+        if lookups:
+            stats.set_value(
+                "phone_cache/hit_ratio",
+                round(stats.get_value("phone_cache/hits", 0) / lookups, 4),
+            )
+
+    def request_scheduled(self, request: Request, spider: Spider) -> None:
+        listing = request.meta.get("listing")
+        if listing:
+            self.pending_listing_requests += 1
+            if self.checkpoint is not None:
+                self.checkpoint.save_request(listing, request, self)
+
+    def request_dropped(self, request: Request, spider: Spider) -> None:
+        # A duplicate is dropped by the scheduler after request_scheduled
+        if request.meta.get("listing"):
+            self.pending_listing_requests -= 1
+
+    def forget_saved_listings(self, urls: list[str]) -> None:
+        # A listing stays pending until its car is committed, cars still
+        # buffered by the pipeline are fetched again after a restart
+        self.checkpoint.remove_requests(urls)
+
+    def request_reached_downloader(self, request: Request, spider: Spider) -> None:
+        if request.meta.get("listing"):
+            self.pending_listing_requests -= 1
+            for serp_request in self.release_serp_pages():
+                self.crawler.engine.crawl(serp_request)
+
+    def spider_idle(self, spider: Spider) -> None:
+        released = False
+        for serp_request in self.release_serp_pages():
+            self.crawler.engine.crawl(serp_request)
+            released = True
+
+        if released:
+            raise DontCloseSpider
+
+    def serp_window_open(self) -> bool:
+        return (
+            self.serp_pages_in_flight < self.serp_window
+            and self.pending_listing_requests < self.serp_release_threshold
+        )
+
+    def release_serp_pages(self) -> list[Request]:
+        # Round robin over the partitions, so they are paginated in parallel
+        serp_requests = []
+        partitions = list(self.serp_partitions.values())
+        while partitions and self.serp_window_open():
+            for partition in list(partitions):
+                if not self.serp_window_open():
+                    break
+
+                page_number = partition.take_page(self.start_page)
+                if page_number is None:
+                    partitions.remove(partition)
+                    continue
+
+                serp_requests.append(
+                    self.build_serp_request(
+                        self.parse_serp,
+                        page_number,
+                        partition.last_page,
+                        partition.filters,
+                    )
+                )
+        return serp_requests
+
+    def add_serp_partition(self, partition: SerpPartition) -> None:
+        self.serp_partitions[partition.key] = partition
+
+    def split_serp_partition(self, partition: SerpPartition) -> bool:
+        children = partition.split(self.serp_max_price, self.start_page)
+        if not children:
+            return False
+
+        del self.serp_partitions[partition.key]
+        for child in children:
+            self.add_serp_partition(child)
+        if self.checkpoint is not None:
+            self.checkpoint.split_serp_partition(partition, children)
+        self.crawler.stats.inc_value("serp_partitions/split")
+        self.logger.debug(
+            f"Split serp partition {partition.key or 'all'} "
+            f"into {', '.join(child.key for child in children)}"
+        )
+        return True
+
+    def serp_failed(self, failure: Failure) -> None:
+        self.serp_pages_in_flight = max(self.serp_pages_in_flight - 1, 0)
+        self.logger.warning(
+            f"Could not download serp page {failure.request.url}: {failure.value}"
+        )
+
+    async def start(self):
+        # Scrapy 2.13 and later only call start(), start_requests() is kept
+        # for older versions
+        for request in self.start_requests():
+            yield request
+
     def start_requests(self) -> Generator[Request, None, None]:
-        yield self.build_serp_request(callback=self.parse_serp)
+        if self.checkpoint is not None:
+            partitions = self.checkpoint.serp_partitions(self.start_page)
+            if partitions:
+                yield from self.resume_requests(partitions)
+                return
+
+            self.checkpoint.save_serp_partitions(list(self.serp_partitions.values()))
+
+        yield from self.release_serp_pages()
+
+    def resume_requests(
+        self, partitions: list[SerpPartition]
+    ) -> Generator[Request, None, None]:
+        self.serp_partitions = {}
+        for partition in partitions:
+            self.add_serp_partition(partition)
+        done_pages = sum(len(partition.done_pages) for partition in partitions)
+        last_pages = sum(partition.last_page or 0 for partition in partitions)
+        self.logger.info(
+            f"Resuming crawl from checkpoint {self.checkpoint.path}: "
+            f"{done_pages} of {last_pages} serp pages done "
+            f"in {len(partitions)} partitions, "
+            f"{self.checkpoint.pending_count()} listing requests pending"
+        )
+
+        for request in self.checkpoint.pending_requests(self):
+            self.crawler.stats.inc_value("checkpoint/resumed_requests")
+            yield request
+        yield from self.release_serp_pages()
 
     def parse_serp(
         self,
         response: TextResponse,
         current_page: int,
         total_pages: int | None = None,
+        partition: dict[str, Any] | None = None,
     ):
+        self.serp_pages_in_flight = max(self.serp_pages_in_flight - 1, 0)
+        key = partition_key(partition or {})
         try:
-            car_urls = self._get_car_urls(response)
-
-            for url in car_urls:
-                yield self.build_car_request(url, self.parse_car)
-
             if current_page == self.start_page:
-                updated_total_pages = self._get_total_pages(response)
+                # Another frontier worker may have split off this partition
+                serp_partition = self.serp_partitions.get(key)
+                if serp_partition is None:
+                    serp_partition = SerpPartition(partition or {})
+                    self.add_serp_partition(serp_partition)
+                serp_partition.next_page = max(
+                    serp_partition.next_page, self.start_page + 1
+                )
 
-                for page_number in range(1, updated_total_pages):
-                    yield self.build_serp_request(
-                        self.parse_serp,
-                        current_page + page_number,
-                        updated_total_pages,
+                last_page = self._get_total_pages(response)
+                if self.serp_page_cap and last_page >= self.serp_page_cap:
+                    # The halves fetch this page's listings again
+                    if self.split_serp_partition(serp_partition):
+                        yield from self.release_serp_pages()
+                        return
+
+                    self.crawler.stats.inc_value("serp_partitions/truncated")
+                    self.logger.warning(
+                        f"Serp partition {key or 'all'} has {last_page} pages, "
+                        f"listings past page {self.serp_page_cap} are out of reach"
                     )
+                    last_page = self.serp_page_cap
+
+                serp_partition.last_page = last_page
+                if self.checkpoint is not None:
+                    self.checkpoint.save_serp_partitions([serp_partition])
+
+            car_cards = self._get_car_cards(response)
+
+            for url, price_usd in car_cards:
+                if self.known_listings.is_fresh(url, price_usd):
+                    self.crawler.stats.inc_value("known_listings/skipped")
+                    continue
+
+                yield self.build_car_request(url, self.car_callback)
+
+            yield from self.release_serp_pages()
+
+            # Reached once every request above has been scheduled
+            if self.checkpoint is not None:
+                self.checkpoint.mark_serp_page_done(key, current_page)
+
             if current_page == total_pages:
                 self.logger.info(f"Parsed all serp pages {total_pages}")
 
@@ -54,70 +408,141 @@ class AutoriaSerpSpider(Spider):
         self,
         response: TextResponse,
     ):
+        yield from self.parse_extracted_car(response, self.extract_car(response))
+
+    async def parse_car_in_pool(self, response: TextResponse):
+        # Requests restored from a checkpoint keep this callback after the
+        # pool was turned off
+        if self.parse_pool is None:
+            extracted = self.extract_car(response)
+        else:
+            extracted = await self.parse_pool.extract_car(response)
+
+        for output in self.parse_extracted_car(response, extracted):
+            yield output
+
+    def extract_car(self, response: TextResponse) -> dict[str, Any]:
+        """Car, security data and car id of a detail page.
+
+        Has no side effects on the spider, so a ParsePool worker can run it.
+        """
+        page = self.get_car_page(response)
+        car = self.get_car_data(response, page)
+        extracted = {"car": car, "security_data": None, "car_id": None}
         try:
-            car = self.get_car_data(response)
+            security_data = self._get_security_data(page)
+            if security_data is None:
+                car.phone_number = self._get_phone_number_from_response(page)
+            else:
+                extracted["car_id"] = self._get_car_id(page)
+                extracted["security_data"] = security_data
 
-            security_data = self._get_security_data(response)
+        except Exception as e:
+            self.logger.warning(
+                f"Unexpected exception parsing car ({response.url}): {e}",
+                exc_info=sys.exc_info(),
+            )
+        return extracted
 
+    def parse_extracted_car(self, response: TextResponse, extracted: dict[str, Any]):
+        car = extracted["car"]
+        security_data = extracted["security_data"]
+        try:
             if security_data is None:
-                car["phone_number"] = self._get_phone_number_from_response(response)
-                yield CarItem(car)
-            else:
-                yield self.build_phone_number_request(
-                    car=car,
-                    callback=self.parse_phone_number,
-                    car_id=self._get_car_id(response),
-                    hash=security_data["hash"],
-                    expires=security_data["expires"],
-                )
+                yield car
+                return
+
+            car_id = extracted["car_id"]
+            if self.phone_number_cache.enabled:
+                phone_number = self.phone_number_cache.get(int(car_id))
+                if phone_number is not None:
+                    self.crawler.stats.inc_value("phone_cache/hits")
+                    car.phone_number = phone_number
+                    yield car
+                    return
+
+                self.crawler.stats.inc_value("phone_cache/misses")
+
+            yield self.build_phone_number_request(
+                car=car,
+                callback=self.parse_phone_number,
+                car_id=car_id,
+                hash=security_data["hash"],
+                expires=security_data["expires"],
+            )
 
         except Exception as e:
             self.logger.warning(
                 f"Unexpected exception parsing car ({response.url}): {e}",
                 exc_info=sys.exc_info(),
             )
-            yield CarItem(car)
+            yield car
 
-    def parse_phone_number(self, response: TextResponse, car: dict[str, Any]):
+    def parse_phone_number(self, response: TextResponse, car: CarItem):
         try:
             phone_number_data = response.json()
-            car["phone_number"] = self._get_phone_number(phone_number_data)
+            car.phone_number = self._get_phone_number(phone_number_data)
+            # Only stamped while the cache is on, a stamp rewrites the row
+            if self.phone_number_cache.enabled and car.phone_number is not None:
+                self.crawler.signals.send_catch_log(phone_fetched, url=car.url)
 
-            yield CarItem(car)
+            yield car
         except Exception as e:
             self.logger.warning(
                 f"Unexpected exception parsing phone number ({response.url}): {e}",
                 exc_info=sys.exc_info(),
             )
-            yield CarItem(car)
+            yield car
 
     def build_serp_request(
         self,
         callback: Callable,
         page_number: int | None = None,
         total_pages: int | None = None,
+        filters: dict[str, Any] | None = None,
     ) -> Request:
         if page_number is None:
             page_number = self.start_page
-        f_url = furl(self.base_url).add({"page": page_number})
+        f_url = furl(self.base_url).add(filters or {}).add({"page": page_number})
+        self.serp_pages_in_flight += 1
         return Request(
             url=f_url.url,
             callback=callback,
+            errback=self.serp_failed,
+            priority=self.serp_priority,
+            meta=self.slot_meta(self.serp_download_slot),
             cb_kwargs={
                 "current_page": page_number,
                 "total_pages": total_pages,
+                "partition": filters or {},
             },
         )
 
+    def slot_meta(self, slot: str) -> dict[str, str]:
+        meta = {"request_slot": slot}
+        if self.split_download_slots:
+            meta["download_slot"] = slot
+        return meta
+
+    @property
+    def car_callback(self) -> Callable:
+        if self.parse_pool is not None:
+            return self.parse_car_in_pool
+        return self.parse_car
+
     def build_car_request(self, url: str, callback: Callable) -> Request:
+        # The listing url identifies the request in the checkpoint, the phone
+        # request of the same listing replaces it there
         return Request(
             url=url,
             callback=callback,
+            priority=self.car_priority,
+            meta={"listing": url, **self.slot_meta(self.car_download_slot)},
         )
 
     def build_phone_number_request(
         self,
-        car: dict[str, Any],
+        car: CarItem,
         callback: Callable,
         car_id: str,
         hash: str,
@@ -126,145 +551,88 @@ class AutoriaSerpSpider(Spider):
         f_url = furl(self.mobile_phone_base_url)
         f_url /= car_id
         f_url.add({"hash": hash, "expires": expires})
-        return Request(f_url.url, callback, cb_kwargs={"car": car})
+        return Request(
+            f_url.url,
+            callback,
+            priority=self.phone_number_priority,
+            meta={
+                "listing": car.url,
+                **self.slot_meta(self.phone_number_download_slot),
+            },
+            cb_kwargs={"car": car},
+        )
 
-    def get_car_data(self, response: TextResponse) -> dict[str, Any]:
-        car_json_data = self._get_car_json(response)
+    def get_car_data(
+        self, response: TextResponse, page: CarPage | None = None
+    ) -> CarItem:
+        if page is None:
+            page = self.get_car_page(response)
+
+        car_json_data = self._get_car_json(page)
         car_vin = car_json_data.get("vehicleIdentificationNumber")
         odometer = car_json_data.get("mileageFromOdometer", {})
         offers = car_json_data.get("offers", {})
-        car_data = {
-            "url": response.url,
-            "title": car_json_data.get("name") or self._get_title(response),
-            "price_usd": int(offers.get("price") or self._get_price(response)),
-            "odometer": odometer.get("value"),
-            "username": self._get_username(response),
-            "image_url": self._get_image_url(response),
-            "images_count": self._get_images_count(response),
-            "car_number": self._get_car_number(response),
-            "car_vin": car_vin or self._get_car_vin(response),
-        }
-        return car_data
-
-    def _get_car_urls(self, response: TextResponse) -> list[str]:
-        return response.xpath(
-            '//div[@id="searchResults"]/section[contains(@class, ticket-item)]/div[@class="content-bar"]/a[@class="m-link-ticket"]/@href'
-        ).getall()
-
-    def _get_total_pages(self, response: TextResponse) -> int:
-        total_pages = (
-            response.xpath(
-                '//div[@id="pagination"]/nav/span[contains(@class, "page-item") and contains(text(), "...")]/following-sibling::span/a/text()'
-            )
-            .get()
-            .replace(" ", "")
-        )
-        return int(total_pages)
-
-    def _get_car_json(self, response: TextResponse) -> dict[str, Any]:
-        car_json_str = response.xpath('//script[@id="ldJson2"]/text()').get()
-        if car_json_str:
-            return json.loads(car_json_str)
-        return {}
-
-    def _get_title(self, response: TextResponse) -> str:
-        title = response.xpath(
-            '//div[contains(@class, "heading")]/h1[contains(@class, "head")]/@title'
-        ).get()
-
-        if title is None:
-            raise ValueError("Could not extract title")
-
-        return title.strip()
-
-    def _get_price(self, response: TextResponse) -> str:
-        price_paths = [
-            "//aside/section/span[contains(@class, @green)]/text()",
-            '//aside/section/div[contains(@class, "price_value")]/strong/text()',
-        ]
-        for path in price_paths:
-            price_str = response.xpath(path).get()
-            if price_str is not None:
-                matches = re.findall(r"\d", price_str)
-                if not matches:
-                    raise ValueError(f"Could not extract price from {price_str}")
-
-                return "".join(matches)
-
-        raise ValueError("Could not extract price from page")
-
-    def _get_username(self, response: TextResponse) -> str | None:
-        path_variations = [
-            '//section[@id="userInfoBlock"]/div/div[@class="seller_info_area"]/div[contains(@class, "seller_info_name")]/text()',
-            '//section[@id="userInfoBlock"]/div/div[@class="seller_info_area"]/h4[@class="seller_info_name"]/a/text()',
-        ]
-        for path in path_variations:
-            username = response.xpath(path).get()
-            if username is not None:
-                return username.strip()
-
-        return None
-
-    def _get_image_url(self, response: TextResponse) -> str | None:
-        carousel_container = response.xpath(
-            '//div[@id="photosBlock"]/div[contains(@class, "carousel")]'
+        return CarItem(
+            url=response.url,
+            title=car_json_data.get("name") or page.extract(extractors.TITLE),
+            price_usd=int(offers.get("price") or page.extract(extractors.PRICE)),
+            odometer=odometer.get("value"),
+            username=page.extract(extractors.USERNAME),
+            image_url=page.extract(extractors.IMAGE_URL),
+            images_count=page.extract(extractors.IMAGES_COUNT),
+            car_number=page.extract(extractors.CAR_NUMBER),
+            car_vin=car_vin or page.extract(extractors.CAR_VIN),
         )
-        image_url = carousel_container.xpath(
-            './div/div[contains(@class, "photo")]/picture/source/@srcset'
-        ).get()
-        return image_url
-
-    def _get_images_count(self, response: TextResponse) -> int:
-        preview_container = response.xpath(
-            '//div[@id="photosBlock"]/div[contains(@class, "preview-gallery")]'
-        )
-        images_count_str = preview_container.xpath(
-            './div[@class="action_disp_all_block"]/a/text()'
-        ).get()
-
-        if images_count_str is not None:
-            match = re.search(r"\d+", images_count_str)
-            if match is None:
-                raise ValueError(
-                    f"Could not extract images count from {images_count_str}"
-                )
 
-            return int(match.group(0))
+    def get_car_page(self, response: TextResponse) -> CarPage:
+        if self.detail_page_scan:
+            return ScannedCarPage(response.text, lambda: response.selector.root)
+        return CarPage(response.selector.root)
 
-        carousel_container = response.xpath(
-            '//div[@id="photosBlock"]/div[contains(@class, "carousel")]'
-        )
-        images = carousel_container.xpath(
-            './div[contains(@class, "carousel-inner")]/div[contains(@class, "photo") and not(contains(@class, "phone-in-photo"))]'
-        ).getall()
-        return len(images)
-
-    def _get_car_number(self, response: TextResponse) -> str | None:
-        car_number_container = response.xpath(
-            '//main[@class="auto-content"]/div/div[contains(@class, "vin-checked")]'
+    def _get_car_cards(self, response: TextResponse) -> list[tuple[str, int | None]]:
+        cards = response.xpath(
+            '//div[@id="searchResults"]/section[contains(@class, ticket-item)]/div[@class="content-bar"]'
         )
-        car_number = car_number_container.xpath(
-            './/span[contains(@class, "state-num")]/text()'
-        ).get()
+        car_cards = []
+        for card in cards:
+            url = card.xpath('./a[@class="m-link-ticket"]/@href').get()
+            if url is not None:
+                car_cards.append((url, self._get_card_price(card)))
+        return car_cards
+
+    def _get_card_price(self, card) -> int | None:
+        price_str = card.xpath(
+            './/div[contains(@class, "price-ticket") and @data-main-currency="USD"]/@data-main-price'
+        ).get() or card.xpath('.//span[@data-currency="USD"]/text()').get()
+
+        if price_str is None:
+            return None
 
-        if car_number is not None:
-            return car_number.strip()
-        return None
+        matches = extractors.DIGIT_REGEX.findall(price_str)
+        if not matches:
+            return None
+        return int("".join(matches))
 
-    def _get_car_vin(self, response: TextResponse) -> str | None:
-        car_vin_container = response.xpath(
-            '//main[@class="auto-content"]/div/div[contains(@class, "vin-checked")]'
-        )
-        car_vin = car_vin_container.xpath('.//span[@class="label-vin"]/text()').get()
+    def _get_total_pages(self, response: TextResponse) -> int:
+        # The last page link, a search with a single page has no pagination
+        pages = [
+            int("".join(matches))
+            for text in response.xpath(
+                '//div[@id="pagination"]/nav/span[contains(@class, "page-item")]/a/text()'
+            ).getall()
+            if (matches := extractors.DIGIT_REGEX.findall(text))
+        ]
+        return max(pages, default=self.start_page)
 
-        if car_vin is not None and "xxxx" not in car_vin:
-            return car_vin.strip()
-        return None
+    def _get_car_json(self, page: CarPage) -> dict[str, Any]:
+        car_json_str = page.extract(extractors.CAR_JSON)
+        if car_json_str:
+            return json.loads(car_json_str)
+        return {}
 
-    def _get_security_data(self, response: TextResponse) -> dict[str, str] | None:
-        security_script = response.xpath("//script[@data-hash and @data-expires]")
-        hash_value = security_script.xpath("./@data-hash").get()
-        expires = security_script.xpath("./@data-expires").get()
+    def _get_security_data(self, page: CarPage) -> dict[str, str] | None:
+        hash_value = page.extract(extractors.SECURITY_HASH)
+        expires = page.extract(extractors.SECURITY_EXPIRES)
 
         if None in [hash_value, expires]:
             self.logger.warning("Could not extract hash or expiration time")
@@ -272,16 +640,13 @@ class AutoriaSerpSpider(Spider):
 
         return {"hash": hash_value, "expires": expires}
 
-    def _get_car_id(self, response: TextResponse) -> str:
-        car_id = response.xpath("//body/@data-auto-id").get()
-        if car_id is None:
-            raise ValueError("Could not extract car id from body")
-        return car_id
+    def _get_car_id(self, page: CarPage) -> str:
+        return page.extract(extractors.CAR_ID)
 
-    def _get_phone_number_from_response(self, response: TextResponse) -> int | None:
-        phone_number_str = response.xpath(
-            '//aside/div[contains(@class, "holder-manager")]/div/a[contains(@class, "phone-btn")]/@href'
-        ).get()
+    def _get_phone_number_from_response(self, page: CarPage) -> int | None:
+        phone_number_str = page.extract(extractors.PHONE_BUTTON)
+        if phone_number_str is None:
+            return None
 
         if phone_number := self._extract_phone_number(phone_number_str):
             return int(phone_number)
@@ -299,7 +664,7 @@ class AutoriaSerpSpider(Spider):
         return None
 
     def _extract_phone_number(self, string) -> str | None:
-        matches = re.findall(r"\d", string)
+        matches = extractors.DIGIT_REGEX.findall(string)
         if not matches:
             self.logger.warning(f"Could not extract phone number from {string}")
             return None
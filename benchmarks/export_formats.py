@@ -0,0 +1,54 @@
+"""Compares exporter throughput and output size for every format/compression.
+
+Runs against the database configured in the project settings:
+
+    python -m benchmarks.export_formats
+"""
+import argparse
+import importlib.util
+import os
+import tempfile
+import time
+
+from app.commands.exporter import Exporter
+from app.export import COMPRESSIONS, EXPORT_FORMATS, ExportShard, export_file_name
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--format", nargs="+", default=EXPORT_FORMATS)
+    parser.add_argument("--compress", nargs="+", default=list(COMPRESSIONS))
+    args = parser.parse_args()
+
+    compressions = args.compress
+    if "zstd" in compressions and importlib.util.find_spec("zstandard") is None:
+        print("zstandard is not installed, skipping zstd")
+        compressions = [c for c in compressions if c != "zstd"]
+
+    exporter = Exporter()
+    print(
+        f"{'format':<8} {'compress':<8} {'rows':>10} {'seconds':>9} "
+        f"{'rows/s':>10} {'MiB':>9}"
+    )
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for export_format in args.format:
+            for compression in compressions:
+                file_path = os.path.join(
+                    tmp_dir, export_file_name("bench", export_format, compression)
+                )
+                started_at = time.perf_counter()
+                rows = exporter.export_to(
+                    ExportShard(file_path, export_format, compression)
+                )
+                elapsed = time.perf_counter() - started_at
+                size = os.path.getsize(file_path) / 2**20
+                print(
+                    f"{export_format:<8} {compression:<8} {rows:>10} {elapsed:>9.2f} "
+                    f"{rows / elapsed:>10.0f} {size:>9.2f}"
+                )
+                os.remove(file_path)
+
+
+if __name__ == "__main__":
+    main()
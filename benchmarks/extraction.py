@@ -0,0 +1,366 @@
+"""Offline extraction benchmark over the fixture corpus in benchmarks/fixtures.
+
+Runs parse_serp, parse_car and parse_phone_number against saved SERP pages,
+detail pages and phone JSON responses, checks the output against
+golden.json and reports pages/s, per-field extraction time, peak memory and
+the memory a car takes as CarItem compared with the dict and scrapy.Item it
+used to be. Detail pages are run and timed per field both with the raw text
+scan of ScannedCarPage and with the lxml tree alone, and through a ParsePool
+of WORKERS processes (default: one per core):
+
+    python -m benchmarks.extraction [-n ITERATIONS] [-w WORKERS]
+
+Exits with status 1 when any output differs from the golden values.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Iterable
+
+import scrapy
+from itemadapter import ItemAdapter
+from scrapy import Request
+from scrapy.http import HtmlResponse, TextResponse
+from scrapy.utils.test import get_crawler
+
+from app import extractors
+from app.extractors import CarPage, ScannedCarPage
+from app.items import CAR_ITEM_FIELDS, CarItem
+from app.spiders.autoria_serp_spider import AutoriaSerpSpider
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+
+DETAIL_FIELDS = (
+    extractors.CAR_JSON,
+    extractors.TITLE,
+    extractors.PRICE,
+    extractors.USERNAME,
+    extractors.IMAGE_URL,
+    extractors.IMAGES_COUNT,
+    extractors.CAR_NUMBER,
+    extractors.CAR_VIN,
+    extractors.SECURITY_HASH,
+    extractors.SECURITY_EXPIRES,
+    extractors.CAR_ID,
+    extractors.PHONE_BUTTON,
+)
+# Golden car of every detail page fixture, the input of parse_phone_number
+GOLDEN_CARS: dict[str, dict[str, Any]] = {}
+# Cars built per representation when comparing their memory
+ITEM_MEMORY_COPIES = 10000
+
+
+class ScrapyCarItem(scrapy.Item):
+    """The scrapy.Item cars were before CarItem, kept for comparison."""
+
+    fields = {field: scrapy.Field() for field in CAR_ITEM_FIELDS}
+
+
+def read_fixture(*path: str) -> bytes:
+    with open(os.path.join(FIXTURES_DIR, *path), mode="rb") as f:
+        return f.read()
+
+
+def build_spider(settings: dict[str, Any] | None = None) -> AutoriaSerpSpider:
+    crawler = get_crawler(AutoriaSerpSpider, settings)
+    return AutoriaSerpSpider.from_crawler(crawler)
+
+
+def serp_cases(golden: dict[str, Any]) -> list[tuple[HtmlResponse, dict[str, Any]]]:
+    return [
+        (
+            HtmlResponse(expected["url"], body=read_fixture("serp", name)),
+            expected,
+        )
+        for name, expected in golden["serp"].items()
+    ]
+
+
+def car_cases(golden: dict[str, Any]) -> list[tuple[HtmlResponse, dict[str, Any]]]:
+    return [
+        (
+            HtmlResponse(expected["url"], body=read_fixture("cars", name)),
+            expected,
+        )
+        for name, expected in golden["cars"].items()
+    ]
+
+
+def phone_cases(golden: dict[str, Any]) -> list[tuple[TextResponse, dict[str, Any]]]:
+    return [
+        (
+            TextResponse(
+                expected["url"],
+                body=read_fixture("phones", name),
+                headers={"Content-Type": "application/json"},
+            ),
+            expected,
+        )
+        for name, expected in golden["phones"].items()
+    ]
+
+
+def fresh(response: TextResponse) -> TextResponse:
+    # A copy has no cached selector, so every run pays for parsing the body
+    return response.replace()
+
+
+def run_serp(spider: AutoriaSerpSpider, response: TextResponse, expected) -> list:
+    return list(
+        spider.parse_serp(
+            fresh(response), expected["current_page"], expected["total_pages"]
+        )
+    )
+
+
+def run_car(spider: AutoriaSerpSpider, response: TextResponse, expected) -> list:
+    return list(spider.parse_car(fresh(response)))
+
+
+def run_phone(spider: AutoriaSerpSpider, response: TextResponse, expected) -> list:
+    car = CarItem(**GOLDEN_CARS[expected["car_file"]])
+    return list(spider.parse_phone_number(fresh(response), car=car))
+
+
+def check_serp(output: list, expected: dict[str, Any]) -> list[str]:
+    car_urls = [
+        request.url for request in output if request.callback.__name__ == "parse_car"
+    ]
+    serp_requests = [
+        request for request in output if request.callback.__name__ == "parse_serp"
+    ]
+    errors = []
+    if car_urls != expected["car_urls"]:
+        errors.append(f"car urls {car_urls} != {expected['car_urls']}")
+    if len(serp_requests) != expected["serp_requests"]:
+        errors.append(
+            f"{len(serp_requests)} serp requests != {expected['serp_requests']}"
+        )
+    return errors
+
+
+def check_car(output: list, expected: dict[str, Any]) -> list[str]:
+    if len(output) != 1:
+        return [f"expected one result, got {len(output)}"]
+
+    result = output[0]
+    if "phone_request" in expected:
+        if not isinstance(result, Request):
+            return [f"expected a phone request, got {result!r}"]
+        errors = []
+        if result.url != expected["phone_request"]:
+            errors.append(f"phone request {result.url} != {expected['phone_request']}")
+        car = ItemAdapter(result.cb_kwargs["car"]).asdict()
+        if car != expected["car"]:
+            errors.append(f"car {car} != {expected['car']}")
+        return errors
+
+    if isinstance(result, Request):
+        return [f"expected a car item, got request {result.url}"]
+    car = ItemAdapter(result).asdict()
+    if car != expected["car"]:
+        return [f"car {car} != {expected['car']}"]
+    return []
+
+
+def check_phone(output: list, expected: dict[str, Any]) -> list[str]:
+    if len(output) != 1:
+        return [f"expected one result, got {len(output)}"]
+
+    car = ItemAdapter(output[0]).asdict()
+    if car.get("phone_number") != expected["phone_number"]:
+        return [f"phone number {car.get('phone_number')} != {expected['phone_number']}"]
+    return []
+
+
+def measure(
+    name: str,
+    cases: list,
+    run: Callable,
+    check: Callable,
+    iterations: int,
+    settings: dict[str, Any] | None = None,
+) -> bool:
+    ok = True
+    spider = build_spider(settings)
+    # Golden values assume a spider that starts from the first SERP page
+    check_spider = build_spider(settings)
+    for response, expected in cases:
+        for error in check(run(check_spider, response, expected), expected):
+            print(f"MISMATCH {name} {response.url}: {error}")
+            ok = False
+
+    started_at = time.perf_counter()
+    for _ in range(iterations):
+        for response, expected in cases:
+            run(spider, response, expected)
+    elapsed = time.perf_counter() - started_at
+
+    # Traced separately, tracemalloc slows allocations down several times
+    tracemalloc.start()
+    for response, expected in cases:
+        run(spider, response, expected)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    pages = iterations * len(cases)
+    print(
+        f"{name:<20} {pages:>8} {pages / elapsed:>10.1f} "
+        f"{elapsed / pages * 1000:>10.3f} {peak / 2**20:>10.2f}"
+    )
+    return ok
+
+
+def measure_pool(cases: list, iterations: int, workers: int) -> bool:
+    spider = build_spider({"DETAIL_PARSE_WORKERS": workers, "LOG_ENABLED": False})
+
+    async def run(response: TextResponse) -> list:
+        return [output async for output in spider.parse_car_in_pool(fresh(response))]
+
+    async def run_all(repeat: int) -> list[list]:
+        return await asyncio.gather(
+            *(run(response) for _ in range(repeat) for response, _ in cases)
+        )
+
+    ok = True
+    # Also starts the workers, which is left out of the timing
+    outputs = asyncio.run(run_all(1))
+    for (response, expected), output in zip(cases, outputs):
+        for error in check_car(output, expected):
+            print(f"MISMATCH parse_car (pool) {response.url}: {error}")
+            ok = False
+
+    started_at = time.perf_counter()
+    asyncio.run(run_all(iterations))
+    elapsed = time.perf_counter() - started_at
+    spider.parse_pool.close()
+
+    pages = iterations * len(cases)
+    print(
+        f"{f'parse_car ({workers} proc)':<20} {pages:>8} {pages / elapsed:>10.1f} "
+        f"{elapsed / pages * 1000:>10.3f} {'':>10}"
+    )
+    return ok
+
+
+def time_field(
+    pages: list[Callable[[], CarPage]], field: extractors.Field, iterations: int
+) -> float:
+    started_at = time.perf_counter()
+    for _ in range(iterations):
+        for page in pages:
+            # A fresh page per call charges container lookups to the field
+            try:
+                page().extract(field)
+            except ValueError:
+                pass
+    return (time.perf_counter() - started_at) / (iterations * len(pages)) * 1e6
+
+
+def measure_fields(cases: Iterable[tuple[TextResponse, Any]], iterations: int) -> None:
+    responses = [response for response, _ in cases]
+    roots = [fresh(response).selector.root for response in responses]
+    tree_pages = [lambda root=root: CarPage(root) for root in roots]
+    # The tree a scan falls back to is parsed again, and charged to the field
+    scanned_pages = [
+        lambda response=response: ScannedCarPage(
+            response.text, lambda: fresh(response).selector.root
+        )
+        for response in responses
+    ]
+    print(f"\n{'field':<20} {'tree us':>10} {'scan us':>10}")
+    for field in DETAIL_FIELDS:
+        print(
+            f"{field.name:<20} {time_field(tree_pages, field, iterations):>10.1f} "
+            f"{time_field(scanned_pages, field, iterations):>10.1f}"
+        )
+
+
+def measure_item_memory(cars: list[dict[str, Any]]) -> None:
+    # Values are shared between copies, only the containers are measured
+    representations: list[tuple[str, Callable[[dict[str, Any]], Any]]] = [
+        ("dict", dict),
+        ("scrapy.Item", ScrapyCarItem),
+        ("CarItem", lambda car: CarItem(**car)),
+    ]
+    print(f"\n{'car as':<20} {'bytes/item':>10}")
+    for name, build in representations:
+        tracemalloc.start()
+        items = [build(cars[i % len(cars)]) for i in range(ITEM_MEMORY_COPIES)]
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del items
+        print(f"{name:<20} {size / ITEM_MEMORY_COPIES:>10.0f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--iterations", type=int, default=50)
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="processes parse_car_in_pool runs on (0 skips it)",
+    )
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+
+    with open(os.path.join(FIXTURES_DIR, "golden.json"), encoding="utf-8") as f:
+        golden = json.load(f)
+    GOLDEN_CARS.update(
+        (name, expected["car"]) for name, expected in golden["cars"].items()
+    )
+
+    print(
+        f"{'callback':<20} {'pages':>8} {'pages/s':>10} {'ms/page':>10} "
+        f"{'peak MiB':>10}"
+    )
+    results = [
+        measure(
+            "parse_serp",
+            serp_cases(golden),
+            run_serp,
+            check_serp,
+            args.iterations,
+        ),
+        measure(
+            "parse_car",
+            car_cases(golden),
+            run_car,
+            check_car,
+            args.iterations,
+        ),
+        measure(
+            "parse_car (tree)",
+            car_cases(golden),
+            run_car,
+            check_car,
+            args.iterations,
+            {"DETAIL_PAGE_SCAN": False},
+        ),
+        measure(
+            "parse_phone_number",
+            phone_cases(golden),
+            run_phone,
+            check_phone,
+            args.iterations,
+        ),
+    ]
+    if args.workers > 0:
+        results.append(measure_pool(car_cases(golden), args.iterations, args.workers))
+    measure_fields(car_cases(golden), args.iterations)
+    measure_item_memory(list(GOLDEN_CARS.values()))
+
+    if not all(results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
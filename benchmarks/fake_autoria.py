@@ -0,0 +1,398 @@
+"""A local stand-in for auto.ria.com to load test the crawler against.
+
+Serves LISTINGS synthetic listings: SERP pages with #pagination, honouring
+the price.USD.gte/price.USD.lte filters and the deepest page the site serves,
+detail pages rendered from the fixture pages in benchmarks/fixtures/cars with
+their ldJson2 data and data-hash/data-expires script, and /users/phones/
+JSON checked against that hash. Detail pages carry an ETag and a
+Last-Modified header and are answered with a 304 when the request's
+If-None-Match or If-Modified-Since still matches. Every response is delayed
+by --latency plus up to --jitter seconds, --error-rate of them fail with a
+503, and requests above --rate-limit per second are answered with
+--throttle-status:
+
+    python -m benchmarks.fake_autoria [--port 8770] [--listings 5000]
+
+--seed and --changed-rate reprice a share of the listings, to re-crawl a
+database with the same listings at partly new prices.
+"""
+import argparse
+import bisect
+import email.utils
+import hashlib
+import json
+import os
+import random
+import re
+import time
+from dataclasses import dataclass
+from logging import getLogger
+
+from twisted.internet import reactor
+from twisted.web import resource, server
+
+from benchmarks.extraction import FIXTURES_DIR
+
+PRICE_FROM = "price.USD.gte"
+PRICE_TO = "price.USD.lte"
+SERP_PAGE_SIZE = 20
+FIRST_LISTING_ID = 40_000_000
+# Detail page fragments replaced per listing, \x00name\x00 marks a value
+DETAIL_FRAGMENTS = (
+    (r'<body data-auto-id="\d+"', '<body data-auto-id="\x00car_id\x00"'),
+    (
+        r'<script class="js-user-secure-\d+" data-hash="[^"]*" data-expires="\d+">',
+        '<script class="js-user-secure-\x00car_id\x00" data-hash="\x00hash\x00" '
+        'data-expires="\x00expires\x00">',
+    ),
+    (
+        r'(<script type="application/ld\+json" id="ldJson2">).*?(</script>)',
+        "\\1\x00ld_json\x00\\2",
+    ),
+    (
+        r'<h1 class="head" title="[^"]*">[^<]*</h1>',
+        '<h1 class="head" title="\x00title\x00">\x00title\x00</h1>',
+    ),
+    (r'(<span class="price_value"[^>]*>)[^<]*(</span>)', "\\1\x00price\x00 $\\2"),
+    (
+        r'(<div class="price_value"><strong class="">)[^<]*(</strong>)',
+        "\\1\x00price\x00 $\\2",
+    ),
+    (r'(<span class="label-vin">)[^<]*(</span>)', "\\1\x00vin\x00\\2"),
+)
+SERP_CARD = (
+    '<section class="ticket-item "><div class="hide" data-id="{car_id}"></div>'
+    '<div class="content-bar"><a class="m-link-ticket" href="{url}"></a>'
+    '<div class="ticket-photo"><picture><source srcset="https://cdn.riastatic.com/x/'
+    '{car_id}.webp"></picture></div><div class="content"><div class="head-ticket">'
+    '<div class="item ticket-title"><a class="address" href="{url}">'
+    '<span class="blue bold">{title}</span></a></div></div>'
+    '<div class="price-ticket" data-main-price="{price_usd}" data-main-currency="USD">'
+    '<span class="bold size22 green" data-currency="USD">{price}</span> '
+    '<span data-currency="USD">$</span></div></div></div></section>'
+)
+SERP_PAGE_LINK = (
+    '<span class="page-item mhide"><a class="page-link" href="?page={page}">'
+    "{page}</a></span>"
+)
+
+
+@dataclass(slots=True)
+class Listing:
+    car_id: int
+    template: "DetailTemplate"
+    title: str
+    price_usd: int
+    odometer: int
+    vin: str
+
+    @property
+    def security_hash(self) -> str:
+        return hashlib.sha1(str(self.car_id).encode()).hexdigest()[:12]
+
+    @property
+    def etag(self) -> str:
+        # Of the listing, not of the page, whose data-expires changes on
+        # every render
+        version = f"{self.car_id}:{self.title}:{self.price_usd}:{self.odometer}"
+        return f'"{hashlib.sha1(version.encode()).hexdigest()[:16]}"'
+
+
+class DetailTemplate:
+    """A fixture detail page with its per listing fragments as placeholders."""
+
+    def __init__(self, name: str, html: str) -> None:
+        # The slug of the fixture file name, e.g. bmw_x5
+        self.slug = name.rsplit("_", 1)[0]
+        self.model = re.search(r'<h1 class="head" title="(.*?) \d{4}"', html)[1]
+
+        for pattern, replacement in DETAIL_FRAGMENTS:
+            html = re.sub(pattern, replacement, html)
+        # Braces of the page itself are escaped before the markers become
+        # str.format() fields
+        html = html.replace("{", "{{").replace("}", "}}")
+        self.html = re.sub("\x00(\\w+)\x00", r"{\1}", html)
+
+    def render(self, listing: Listing, expires: int) -> str:
+        ld_json = json.dumps(
+            {
+                "@context": "https://schema.org",
+                "@type": "Product",
+                "name": listing.title,
+                "vehicleIdentificationNumber": listing.vin,
+                "mileageFromOdometer": {
+                    "@type": "QuantitativeValue",
+                    "value": listing.odometer,
+                    "unitCode": "KMT",
+                },
+                "offers": {
+                    "@type": "Offer",
+                    "price": listing.price_usd,
+                    "priceCurrency": "USD",
+                },
+            },
+            ensure_ascii=False,
+        )
+        return self.html.format(
+            car_id=listing.car_id,
+            hash=listing.security_hash,
+            expires=expires,
+            ld_json=ld_json,
+            title=listing.title,
+            price=format_price(listing.price_usd),
+            vin=listing.vin,
+        )
+
+
+def format_price(price_usd: int) -> str:
+    return f"{price_usd:,}".replace(",", " ")
+
+
+def load_templates() -> list[DetailTemplate]:
+    directory = os.path.join(FIXTURES_DIR, "cars")
+    templates = []
+    for name in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, name), encoding="utf-8") as f:
+            templates.append(DetailTemplate(os.path.splitext(name)[0], f.read()))
+    return templates
+
+
+def build_listings(count: int, seed: int, changed_rate: float) -> list[Listing]:
+    templates = load_templates()
+    # Prices are fixed per listing, a seed only moves changed_rate of them
+    base = random.Random(0)
+    moved = random.Random(seed)
+    listings = []
+    for index in range(count):
+        car_id = FIRST_LISTING_ID + index
+        template = templates[index % len(templates)]
+        price_usd = base.randrange(1_000, 80_000)
+        if seed and moved.random() < changed_rate:
+            price_usd = max(500, price_usd + moved.randrange(-3_000, 3_000, 100))
+        listings.append(
+            Listing(
+                car_id=car_id,
+                template=template,
+                title=f"{template.model} {2005 + index % 19}",
+                price_usd=price_usd,
+                odometer=base.randrange(0, 400) * 1_000,
+                vin=f"WBA{car_id:014d}",
+            )
+        )
+    # The SERP lists the cheapest first, so a price band is a contiguous range
+    return sorted(listings, key=lambda listing: (listing.price_usd, listing.car_id))
+
+
+class RateLimiter:
+    """Token bucket of rate requests per second, a burst of one second."""
+
+    def __init__(self, rate: float) -> None:
+        self.rate = rate
+        self.tokens = rate
+        self.updated_at = time.monotonic()
+
+    def allow(self) -> bool:
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        self.tokens = min(
+            self.rate, self.tokens + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class FakeAutoria(resource.Resource):
+    isLeaf = True
+
+    def __init__(
+        self,
+        listings: list[Listing],
+        page_cap: int,
+        latency: float,
+        jitter: float,
+        error_rate: float,
+        rate_limit: float,
+        throttle_status: int,
+    ) -> None:
+        super().__init__()
+        self.listings = listings
+        self.by_id = {listing.car_id: listing for listing in listings}
+        self.prices = [listing.price_usd for listing in listings]
+        self.page_cap = page_cap
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.limiter = RateLimiter(rate_limit)
+        self.throttle_status = throttle_status
+        self.random = random.Random()
+        self.logger = getLogger(self.__class__.__name__)
+        # Listings only change between runs of the server, which last
+        # modifies all of them when it starts
+        self.last_modified = int(time.time())
+
+    def render_GET(self, request) -> int:
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        call = reactor.callLater(delay, self.respond, request)
+        request.notifyFinish().addErrback(lambda _: call.active() and call.cancel())
+        return server.NOT_DONE_YET
+
+    def respond(self, request) -> None:
+        status, content_type, body = self.route(request)
+        request.setResponseCode(status)
+        request.setHeader(b"Content-Type", content_type)
+        if status == self.throttle_status:
+            request.setHeader(b"Retry-After", b"1")
+        request.write(body)
+        request.finish()
+
+    def route(self, request) -> tuple[int, bytes, bytes]:
+        if not self.limiter.allow():
+            return self.throttle_status, b"text/plain", b"Too Many Requests"
+        if self.random.random() < self.error_rate:
+            return 503, b"text/plain", b"Service Unavailable"
+
+        path = request.path.decode()
+        args = {
+            key.decode(): values[0].decode() for key, values in request.args.items()
+        }
+        host = request.getRequestHostname().decode()
+        base_url = f"http://{host}:{request.getHost().port}"
+        if path == "/uk/car/used/":
+            return 200, b"text/html; charset=utf-8", self.serp(args, base_url).encode()
+
+        match = re.fullmatch(r"/uk/auto_[\w-]+_(\d+)\.html", path)
+        if match and int(match.group(1)) in self.by_id:
+            listing = self.by_id[int(match.group(1))]
+            request.setHeader(b"ETag", listing.etag.encode())
+            request.setHeader(
+                b"Last-Modified",
+                email.utils.formatdate(self.last_modified, usegmt=True).encode(),
+            )
+            if self.not_modified(request, listing):
+                return 304, b"text/html; charset=utf-8", b""
+            body = listing.template.render(listing, expires=int(time.time()) + 3600)
+            return 200, b"text/html; charset=utf-8", body.encode()
+
+        match = re.fullmatch(r"/users/phones/(\d+)", path)
+        if match and int(match.group(1)) in self.by_id:
+            listing = self.by_id[int(match.group(1))]
+            if args.get("hash") != listing.security_hash:
+                return 400, b"application/json", b'{"error": "hash"}'
+            digits = f"{listing.car_id % 10_000_000:07d}"
+            body = {
+                "phoneId": str(listing.car_id),
+                "formattedPhoneNumber": (
+                    f"(067) {digits[:3]} {digits[3:5]} {digits[5:]}"
+                ),
+            }
+            return 200, b"application/json", json.dumps(body).encode()
+
+        return 404, b"text/plain", b"Not Found"
+
+    def not_modified(self, request, listing: Listing) -> bool:
+        # If-None-Match wins over If-Modified-Since, like RFC 9110 asks
+        if_none_match = request.getHeader(b"If-None-Match")
+        if if_none_match is not None:
+            etags = {etag.strip() for etag in if_none_match.decode().split(",")}
+            return listing.etag in etags or "*" in etags
+
+        if_modified_since = request.getHeader(b"If-Modified-Since")
+        if if_modified_since is None:
+            return False
+        try:
+            since = email.utils.parsedate_to_datetime(if_modified_since.decode())
+        except (TypeError, ValueError):
+            return False
+        return since.timestamp() >= self.last_modified
+
+    def serp(self, args: dict[str, str], base_url: str) -> str:
+        start = bisect.bisect_left(self.prices, int(args.get(PRICE_FROM, 0)))
+        end = bisect.bisect_right(self.prices, int(args.get(PRICE_TO, 10**9)))
+        total_pages = max(-(-(end - start) // SERP_PAGE_SIZE), 1)
+        # Like the site, pages past page_cap are never served
+        shown_pages = min(total_pages, self.page_cap) if self.page_cap else total_pages
+        page = int(args.get("page", 1))
+
+        cards = []
+        if page <= shown_pages:
+            offset = start + (page - 1) * SERP_PAGE_SIZE
+            for listing in self.listings[offset : min(offset + SERP_PAGE_SIZE, end)]:
+                url = (
+                    f"{base_url}/uk/auto_{listing.template.slug}_{listing.car_id}.html"
+                )
+                cards.append(
+                    SERP_CARD.format(
+                        car_id=listing.car_id,
+                        url=url,
+                        title=listing.title,
+                        price_usd=listing.price_usd,
+                        price=format_price(listing.price_usd),
+                    )
+                )
+
+        pages = sorted(
+            number
+            for number in {1, page - 1, page, page + 1, shown_pages}
+            if 1 <= number <= shown_pages
+        )
+        pagination = "".join(SERP_PAGE_LINK.format(page=number) for number in pages)
+        return (
+            '<!DOCTYPE html><html lang="uk"><head><meta charset="utf-8">'
+            f"<title>Вживані авто – сторінка {page}</title></head><body>"
+            '<div class="app-content"><div id="searchResults" class="standart-view">'
+            f"{''.join(cards)}</div>"
+            '<div id="pagination" class="pager"><nav class="unstyled">'
+            f"{pagination}</nav></div></div></body></html>"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8770)
+    parser.add_argument("--listings", type=int, default=5000)
+    parser.add_argument(
+        "--page-cap", type=int, default=100, help="deepest SERP page served"
+    )
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds")
+    parser.add_argument("--jitter", type=float, default=0.05, help="seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=0,
+        help="requests per second served before throttling (0: unlimited)",
+    )
+    parser.add_argument("--throttle-status", type=int, default=429)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--changed-rate", type=float, default=0.1)
+    args = parser.parse_args()
+
+    site = server.Site(
+        FakeAutoria(
+            build_listings(args.listings, args.seed, args.changed_rate),
+            page_cap=args.page_cap,
+            latency=args.latency,
+            jitter=args.jitter,
+            error_rate=args.error_rate,
+            rate_limit=args.rate_limit,
+            throttle_status=args.throttle_status,
+        )
+    )
+    site.noisy = False
+    reactor.listenTCP(args.port, site, interface=args.host)
+    print(
+        f"Serving {args.listings} listings on http://{args.host}:{args.port}/",
+        flush=True,
+    )
+    reactor.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+"""End-to-end load benchmark of autoria_serp_spider against a fake auto.ria.
+
+Starts benchmarks.fake_autoria in a subprocess, creates a throwaway database
+next to the one configured in the project settings (the database user needs
+CREATEDB), migrates it and crawls every listing with CarDBPipeline writing to
+it. Reports items/s, peak RSS of the crawler process and the database write
+rate, then drops the database unless --keep-db is given:
+
+    python -m benchmarks.load [--listings 2000] [-s CONCURRENT_REQUESTS=32]
+
+-s NAME=VALUE overrides a setting like `scrapy crawl -s` does, to compare
+concurrency, DB_BATCH_SIZE or DB_WRITER_THREADS values before changing them in
+production. --httpcache crawls twice more with the HTTP cache on: the second
+crawl must revalidate every detail page with a conditional request and parse
+the stored page on its 304, the third evicts the cache by age and by size.
+Exits with status 1 when not every listing ended up in the database or the
+cache was not revalidated or evicted.
+"""
+import argparse
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import Any, Iterator
+
+from alembic import command
+from alembic.config import Config
+from scrapy.crawler import Crawler, CrawlerProcess
+from scrapy.settings import Settings
+from scrapy.utils.project import get_project_settings
+from sqlalchemy import func, make_url, select, text
+from twisted.internet import defer
+
+from app.database.models import Car, CarPriceHistory
+from app.utils import get_engine
+
+# Options passed through to benchmarks.fake_autoria
+SERVER_OPTIONS = (
+    "listings",
+    "page_cap",
+    "latency",
+    "jitter",
+    "error_rate",
+    "rate_limit",
+    "throttle_status",
+)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@contextmanager
+def fake_autoria(args: argparse.Namespace) -> Iterator[str]:
+    port = free_port()
+    command_line = [
+        sys.executable,
+        "-m",
+        "benchmarks.fake_autoria",
+        "--port",
+        str(port),
+    ]
+    for option in SERVER_OPTIONS:
+        command_line += [f"--{option.replace('_', '-')}", str(getattr(args, option))]
+
+    server = subprocess.Popen(command_line, stdout=subprocess.PIPE, text=True)
+    try:
+        # The server prints its address once it listens
+        if not server.stdout.readline():
+            raise RuntimeError("benchmarks.fake_autoria did not start")
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        server.terminate()
+        server.wait()
+
+
+@contextmanager
+def throwaway_database(settings: Settings, keep: bool) -> Iterator[str]:
+    url = make_url(settings["DB_URL"])
+    name = f"{url.database}_load_{os.getpid()}"
+    engine = get_engine(settings, "migrations")
+    # CREATE/DROP DATABASE cannot run inside a transaction
+    admin = engine.execution_options(isolation_level="AUTOCOMMIT")
+    with admin.connect() as connection:
+        connection.execute(text(f'CREATE DATABASE "{name}"'))
+    try:
+        yield url.set(database=name).render_as_string(hide_password=False)
+    finally:
+        if keep:
+            print(f"Kept database {name}")
+        else:
+            with admin.connect() as connection:
+                connection.execute(text(f'DROP DATABASE "{name}" WITH (FORCE)'))
+        engine.dispose()
+
+
+def migrate(settings: Settings) -> None:
+    # Without a config file, so alembic leaves the logging configuration alone
+    config = Config()
+    config.set_main_option("script_location", "app:database")
+    engine = get_engine(settings, "migrations")
+    with engine.begin() as connection:
+        config.attributes["connection"] = connection
+        command.upgrade(config, "head")
+    engine.dispose()
+
+
+def crawl(runs: list[Settings], site: str) -> list[tuple[dict[str, Any], float]]:
+    """Crawls the site once per settings in runs, one after the other."""
+    process = CrawlerProcess(runs[0])
+    # The first crawler installs the reactor the others run in
+    crawlers = [process.create_crawler("autoria_serp_spider")]
+    crawlers += [Crawler(crawlers[0].spidercls, settings) for settings in runs[1:]]
+    results = []
+
+    @defer.inlineCallbacks
+    def crawl_all():
+        for crawler in crawlers:
+            started_at = time.perf_counter()
+            yield process.crawl(
+                crawler,
+                base_url=f"{site}/uk/car/used/",
+                mobile_phone_base_url=f"{site}/users/phones/",
+                allowed_domains=["127.0.0.1"],
+            )
+            elapsed = time.perf_counter() - started_at
+            results.append((crawler.stats.get_stats(), elapsed))
+
+    def stop(_) -> None:
+        from twisted.internet import reactor
+
+        reactor.stop()
+
+    crawl_all().addBoth(stop)
+    process.start(stop_after_crawl=False)
+    return results
+
+
+def count_rows(settings: Settings) -> tuple[int, int]:
+    engine = get_engine(settings, "migrations")
+    with engine.connect() as connection:
+        cars = connection.execute(select(func.count()).select_from(Car)).scalar_one()
+        history = connection.execute(
+            select(func.count()).select_from(CarPriceHistory)
+        ).scalar_one()
+    engine.dispose()
+    return cars, history
+
+
+def report(
+    args: argparse.Namespace,
+    stats: dict[str, Any],
+    elapsed: float,
+    cars: int,
+    history: int,
+) -> None:
+    items = stats.get("item_scraped_count", 0)
+    throttled = stats.get(
+        f"downloader/response_status_count/{args.throttle_status}", 0
+    )
+    server_errors = sum(
+        count
+        for key, count in stats.items()
+        if key.startswith("downloader/response_status_count/5")
+    )
+    rows = stats.get("db/rows_written", 0)
+    flush_time = stats.get("db/flush_time", 0)
+    # ru_maxrss is in KiB on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    print(f"{'listings':<14} {args.listings}")
+    print(f"{'items':<14} {items} ({cars} cars, {history} prices in database)")
+    print(f"{'elapsed':<14} {elapsed:.1f}s")
+    print(f"{'items/s':<14} {items / elapsed:.1f}")
+    print(
+        f"{'requests':<14} {stats.get('downloader/request_count', 0)} "
+        f"({stats.get('retry/count', 0)} retried, {throttled} throttled, "
+        f"{server_errors} server errors)"
+    )
+    print(f"{'peak RSS':<14} {peak_rss:.1f} MiB")
+    print(
+        f"{'db writes':<14} {rows} rows in {stats.get('db/flushes', 0)} flushes, "
+        f"{rows / elapsed:.1f} rows/s, "
+        f"{rows / flush_time if flush_time else 0:.0f} rows/s while flushing"
+    )
+
+
+def cache_runs(settings: Settings, cache_dir: str) -> list[Settings]:
+    # The first crawl fills the cache, the second revalidates it, the third
+    # finds every page expired and keeps none of the pages it stores
+    overrides = [
+        {},
+        {},
+        {"HTTPCACHE_EXPIRATION_SECS": 1, "HTTPCACHE_MAX_SIZE": 1},
+    ]
+    runs = []
+    for run_overrides in overrides:
+        run = settings.copy()
+        run.setdict(
+            {"HTTPCACHE_ENABLED": True, "HTTPCACHE_DIR": cache_dir, **run_overrides},
+            priority="cmdline",
+        )
+        runs.append(run)
+    return runs
+
+
+def report_cache(
+    args: argparse.Namespace, runs: list[tuple[dict[str, Any], float]]
+) -> list[str]:
+    (first, _), (second, elapsed), (third, _) = runs
+    revalidated = second.get("httpcache/revalidate", 0)
+    expired = third.get("httpcache/evicted_expired", 0)
+    oversized = third.get("httpcache/evicted_oversized", 0)
+    print(
+        f"{'httpcache':<14} {first.get('httpcache/store', 0)} stored, "
+        f"{revalidated} revalidated in {elapsed:.1f}s, "
+        f"{expired} expired and {oversized} evicted for size"
+    )
+
+    failures = []
+    if revalidated < args.listings:
+        failures.append(f"only {revalidated} detail pages revalidated")
+    if not expired:
+        failures.append("no expired cache entry evicted")
+    if not oversized:
+        failures.append("no cache entry evicted for size")
+    return failures
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--listings", type=int, default=2000)
+    parser.add_argument("--page-cap", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=float, default=0)
+    parser.add_argument("--throttle-status", type=int, default=429)
+    parser.add_argument("--keep-db", action="store_true")
+    parser.add_argument(
+        "--httpcache",
+        action="store_true",
+        help="crawl twice more to check HTTP cache revalidation and eviction",
+    )
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument(
+        "-s",
+        dest="overrides",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="set/override a setting (may be repeated)",
+    )
+    args = parser.parse_args()
+
+    settings = get_project_settings()
+    with throwaway_database(settings, args.keep_db) as db_url:
+        settings = settings.copy()
+        settings.setdict(
+            {
+                "DB_URL": db_url,
+                "LOG_LEVEL": args.log_level,
+                "SERP_PAGE_CAP": args.page_cap,
+                "HTTPCACHE_ENABLED": False,
+                "CHECKPOINT_FILE": "",
+                "REVISIT_TTL": 0,
+                "PHONE_CACHE_TTL": 0,
+                "TELNETCONSOLE_ENABLED": False,
+            },
+            priority="cmdline",
+        )
+        for override in args.overrides:
+            name, _, value = override.partition("=")
+            settings.set(name, value, priority="cmdline")
+
+        migrate(settings)
+        cache_dir = tempfile.mkdtemp(prefix="httpcache_") if args.httpcache else None
+        runs = cache_runs(settings, cache_dir) if cache_dir else [settings]
+        try:
+            with fake_autoria(args) as site:
+                results = crawl(runs, site)
+        finally:
+            if cache_dir:
+                shutil.rmtree(cache_dir)
+        cars, history = count_rows(settings)
+
+    stats, elapsed = results[0]
+    report(args, stats, elapsed, cars, history)
+    failures = report_cache(args, results) if args.httpcache else []
+    if cars != args.listings:
+        failures.append(f"{args.listings - cars} listings missing from the database")
+    for failure in failures:
+        print(failure)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
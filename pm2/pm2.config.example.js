@@ -4,6 +4,8 @@ const {
     SCRAPY_SCRIPT,
     PROJECT_PREFIX,
     MAX_MEMORY_RESTART,
+    EXPORTER_WORKERS,
+    SPIDER_INSTANCES,
     PYTHON_CWD,
     PM2_LOG_DIRECTORY,
 } = require('./settings/settings');
@@ -14,7 +16,7 @@ const spiders = [
         script: SCRAPY_SCRIPT,
         args: "crawl autoria_serp_spider",
         interpreter: PYTHON_INTERPRETER,
-        instances: 1,
+        instances: SPIDER_INSTANCES,
         cron_restart: "0 12 * * *"
     },
 ];
@@ -23,7 +25,7 @@ const commands = [
     {
         name: `${PROJECT_PREFIX}_exporter`,
         script: SCRAPY_SCRIPT,
-        args: "exporter",
+        args: `exporter --workers ${EXPORTER_WORKERS}`,
         interpreter: PYTHON_INTERPRETER,
         instances: 1,
         cron_restart: "0 0 * * *"
@@ -1,8 +1,12 @@
 const path = require('path');
 const fs = require('fs');
+const os = require('os');
 
 const PROJECT_PREFIX = 'autoria';
 const MAX_MEMORY_RESTART = '512M';
+const EXPORTER_WORKERS = os.cpus().length;
+// More than one needs FRONTIER_ENABLED=True, workers share the Postgres frontier
+const SPIDER_INSTANCES = 1;
 
 const _projectDirectory = path.join(process.cwd(), '..');
 const PM2_LOG_DIRECTORY = path.join(_projectDirectory, 'logs');
@@ -39,6 +43,8 @@ module.exports = {
     SCRAPY_SCRIPT,
     PROJECT_PREFIX,
     MAX_MEMORY_RESTART,
+    EXPORTER_WORKERS,
+    SPIDER_INSTANCES,
     PYTHON_CWD,
     PM2_LOG_DIRECTORY,
 };